@@ -16,10 +16,12 @@
     Contact: code@inmanta.com
 """
 
-import base64
+from collections import defaultdict
 from concurrent.futures.thread import ThreadPoolExecutor
 import datetime
 import hashlib
+import io
+import json
 import logging
 import os
 import random
@@ -36,6 +38,7 @@ from inmanta.protocol import Scheduler, AgentEndPoint
 from inmanta.resources import Resource
 from tornado.concurrent import Future
 from inmanta.agent.cache import AgentCache
+from inmanta.agent.concurrency import ConcurrencyLimiter
 from inmanta.agent import config as cfg
 from inmanta.agent.reporting import collect_report
 
@@ -44,30 +47,72 @@ LOGGER = logging.getLogger(__name__)
 GET_RESOURCE_BACKOFF = 5
 
 
+def hash_snapshot(snapshot):
+    """
+        Hash the data of a snapshot, either bytes or a binary file object, without loading a file in memory.
+
+        :return A tuple with the sha1 hash, the size and a binary file object positioned at the start of the data
+    """
+    if isinstance(snapshot, bytes):
+        snapshot = io.BytesIO(snapshot)
+
+    sha1sum = hashlib.sha1()
+    size = 0
+    chunk = snapshot.read(protocol.STREAM_CHUNK_SIZE)
+    while len(chunk) > 0:
+        sha1sum.update(chunk)
+        size += len(chunk)
+        chunk = snapshot.read(protocol.STREAM_CHUNK_SIZE)
+
+    snapshot.seek(0)
+    return sha1sum.hexdigest(), size, snapshot
+
+
+def desired_state_hash(resource):
+    """
+        Hash the desired state of a resource: the values of its fields and the resources it requires, independent of the
+        version of the resource.
+    """
+    state = {field: getattr(resource, field) for field in resource.__class__.fields}
+    state["requires"] = sorted([x.resource_str() for x in resource.requires])
+    state["id"] = resource.id.resource_str()
+    return hashlib.sha1(json.dumps(state, default=protocol.custom_json_encoder, sort_keys=True).encode()).hexdigest()
+
+
 class ResourceActionResult(object):
 
-    def __init__(self, success, reload, cancel):
+    def __init__(self, success, reload, cancel, changed=False):
         self.success = success
         self.reload = reload
         self.cancel = cancel
+        self.changed = changed
 
     def __add__(self, other):
         return ResourceActionResult(self.success and other.success,
                                     self.reload or other.reload,
-                                    self.cancel or other.cancel)
+                                    self.cancel or other.cancel,
+                                    self.changed or other.changed)
 
     def __str__(self, *args, **kwargs):
-        return "%r %r %r" % (self.success, self.reload, self.cancel)
+        return "%r %r %r %r" % (self.success, self.reload, self.cancel, self.changed)
 
 
 class ResourceAction(object):
+    """
+        The deploy of a resource in a generation of the scheduler
+
+        :param incremental Do not deploy the resource again when its desired state did not change since its last
+                           successful deploy and none of the resources it requires changed.
+    """
 
-    def __init__(self, scheduler, resource, gid):
+    def __init__(self, scheduler, resource, gid, incremental=False, state_hash=None):
         self.scheduler = scheduler
         self.resource = resource
         self.future = Future()
         self.running = False
         self.gid = gid
+        self.incremental = incremental
+        self.state_hash = state_hash
 
     def is_running(self):
         return self.running
@@ -81,25 +126,47 @@ class ResourceAction(object):
             self.future.set_result(ResourceActionResult(False, False, True))
 
     @gen.coroutine
-    def __complete(self, success, reload, changes={}, status="", log_msg=""):
+    def __complete(self, success, reload, changes={}, status="", log_msg="", changed=False, skipped=False):
+        if success:
+            self.scheduler.deployed(self.resource, self.state_hash, skipped)
+        else:
+            self.scheduler.forget(self.resource)
+
         action = "deploy"
         if status == "skipped" or status == "dry" or status == "deployed":
             level = "INFO"
         else:
             level = "ERROR"
 
-        yield self.scheduler.get_client().resource_updated(tid=self.scheduler._env_id,
-                                                           id=str(self.resource.id),
-                                                           level=level,
-                                                           action=action,
-                                                           status=status,
-                                                           message="%s: %s" % (status, log_msg),
-                                                           extra_data=changes)
-
-        self.future.set_result(ResourceActionResult(success, reload, False))
+        self.future.set_result(ResourceActionResult(success, reload, False, changed))
         LOGGER.info("end run %s" % self.resource)
         self.running = False
 
+        # dependents do not wait for the batch that sends the update to the server
+        update = self.scheduler.get_batch_client().resource_updated(tid=self.scheduler._env_id,
+                                                                    id=str(self.resource.id),
+                                                                    level=level,
+                                                                    action=action,
+                                                                    status=status,
+                                                                    message="%s: %s" % (status, log_msg),
+                                                                    extra_data=changes)
+        self.scheduler.agent.add_future(update)
+
+    @gen.coroutine
+    def __skip(self):
+        """
+            Complete the deploy without deploying the resource, because it is still in its desired state. The server is only
+            informed when the resource belongs to a new version.
+        """
+        LOGGER.debug("Resource %s did not change since its last deploy", self.resource.id)
+        if self.scheduler.deployed_version(self.resource) != self.resource.id.version:
+            yield self.__complete(True, False, changes={}, status="deployed", log_msg="unchanged since the last deploy",
+                                  skipped=True)
+            return
+
+        self.future.set_result(ResourceActionResult(True, False, False))
+        self.running = False
+
     @gen.coroutine
     def execute(self, dummy, generation, cache):
         LOGGER.log(3, "Entering %s %s", self.gid, self.resource)
@@ -126,6 +193,9 @@ class ResourceAction(object):
 
             if not result.success:
                 yield self.__complete(False, False, changes={}, status="skipped")
+            elif self.incremental and not result.changed:
+                cache.close_version(self.resource.id.version)
+                yield self.__skip()
             else:
                 resource = self.resource
 
@@ -140,12 +210,14 @@ class ResourceAction(object):
                         provider.close()
 
                     cache.close_version(self.resource.id.version)
+                    self.scheduler.ratelimiter.feedback(False)
                     LOGGER.exception("Unable to find a handler for %s" % resource.id)
                     return (yield self.__complete(False, False, changes={}, status="unavailable"))
 
-                results = yield self.scheduler.agent.thread_pool.submit(provider.execute, resource)
+                results = yield self.scheduler.agent.run_handler(provider, provider.execute, resource)
 
                 status = results["status"]
+                self.scheduler.ratelimiter.feedback(status != "failed")
                 if status == "failed" or status == "skipped":
                     provider.close()
                     cache.close_version(self.resource.id.version)
@@ -156,14 +228,15 @@ class ResourceAction(object):
 
                 if result.reload and provider.can_reload():
                     LOGGER.warning("Reloading %s because of updated dependencies" % resource.id)
-                    yield self.scheduler.agent.thread_pool.submit(provider.do_reload, resource)
+                    yield self.scheduler.agent.run_handler(provider, provider.do_reload, resource)
 
                 provider.close()
                 cache.close_version(self.resource.id.version)
 
                 reload = results["changed"] and hasattr(resource, "reload") and resource.reload
                 return (yield self.__complete(True, reload=reload, changes=results["changes"],
-                                              status=results["status"], log_msg=results["log_msg"]))
+                                              status=results["status"], log_msg=results["log_msg"],
+                                              changed=results["changed"]))
 
                 LOGGER.debug("Finished %s %s" % (self.gid, resource))
 
@@ -210,12 +283,18 @@ class RemoteResourceAction(ResourceAction):
 
     def notify(self):
         if not self.future.done():
-            self.future.set_result(ResourceActionResult(True, False, False))
+            # the remote resource was deployed during this generation, so it may have changed
+            self.future.set_result(ResourceActionResult(True, False, False, True))
 
 
 class ResourceScheduler(object):
+    """
+        Deploy the resources of an agent. For each resource, the scheduler remembers the hash of the desired state, the
+        version and the time of its last successful deploy. An incremental reload skips the resources that did not change
+        since their last deploy, unless that deploy is more than repair_interval seconds ago.
+    """
 
-    def __init__(self, agent, env_id, name, cache, ratelimiter):
+    def __init__(self, agent, env_id, name, cache, ratelimiter, repair_interval=3600):
         self.generation = {}
         self.cad = {}
         self._env_id = env_id
@@ -224,8 +303,43 @@ class ResourceScheduler(object):
         self.name = name
         self.ratelimiter = ratelimiter
         self.version = 0
+        self.repair_interval = repair_interval
+
+        # the desired state hash, version and time of the last successful deploy of each resource
+        self._deployed = {}
+
+    def deployed(self, resource, state_hash, skipped=False):
+        """
+            Remember that the resource is in its desired state. A resource that was skipped because it did not change keeps
+            the time of the deploy that brought it in its desired state.
+        """
+        resource_id = resource.id.resource_str()
+        if state_hash is None:
+            state_hash = desired_state_hash(resource)
+
+        deployed_at = time.time()
+        if skipped and resource_id in self._deployed:
+            deployed_at = self._deployed[resource_id][2]
 
-    def reload(self, resources):
+        self._deployed[resource_id] = (state_hash, resource.id.version, deployed_at)
+
+    def forget(self, resource):
+        self._deployed.pop(resource.id.resource_str(), None)
+
+    def deployed_version(self, resource):
+        """
+            The version of the resource that was deployed last, or None
+        """
+        deployed = self._deployed.get(resource.id.resource_str())
+        if deployed is None:
+            return None
+        return deployed[1]
+
+    def _is_converged(self, resource_id, state_hash):
+        deployed = self._deployed.get(resource_id)
+        return deployed is not None and deployed[0] == state_hash and time.time() - deployed[2] < self.repair_interval
+
+    def reload(self, resources, incremental=False):
         version = resources[0].id.get_version
 
         self.version = version
@@ -233,8 +347,21 @@ class ResourceScheduler(object):
         for ra in self.generation.values():
             ra.cancel()
 
+        hashes = {r.id.resource_str(): desired_state_hash(r) for r in resources}
+        self._deployed = {rid: deployed for rid, deployed in self._deployed.items() if rid in hashes}
+
         gid = uuid.uuid4()
-        self.generation = {r.id.resource_str(): ResourceAction(self, r, gid) for r in resources}
+        self.generation = {}
+        skipped = 0
+        for r in resources:
+            resource_id = r.id.resource_str()
+            skip = incremental and self._is_converged(resource_id, hashes[resource_id])
+            skipped += skip
+            self.generation[resource_id] = ResourceAction(self, r, gid, incremental=skip, state_hash=hashes[resource_id])
+
+        if incremental:
+            LOGGER.info("Incremental deploy of agent %s: %d of %d resources did not change since their last deploy",
+                        self.name, skipped, len(resources))
 
         cross_agent_dependencies = [q for r in resources for q in r.requires if q.get_agent_name() != self.name]
         for cad in cross_agent_dependencies:
@@ -264,6 +391,9 @@ class ResourceScheduler(object):
     def get_client(self):
         return self.agent.get_client()
 
+    def get_batch_client(self):
+        return self.agent.get_batch_client()
+
 
 class AgentInstance():
 
@@ -273,9 +403,10 @@ class AgentInstance():
         self.hostname = hostname
 
         # inherit
-        self.ratelimiter = process.ratelimiter
+        self.ratelimiter = process.limiter.get_instance_limiter(name)
         self.critical_ratelimiter = process.critical_ratelimiter
         self.dryrunlock = locks.Semaphore(1)
+        self._handler_locks = defaultdict(locks.Lock)
 
         self._env_id = process._env_id
         self.thread_pool = process.thread_pool
@@ -283,23 +414,47 @@ class AgentInstance():
 
         # init
         self._cache = AgentCache()
-        self._nq = ResourceScheduler(self, self.process._env_id, name, self._cache, ratelimiter=self.ratelimiter)
+        self._nq = ResourceScheduler(self, self.process._env_id, name, self._cache, ratelimiter=self.ratelimiter,
+                                     repair_interval=cfg.agent_repair_interval.get())
         self._enabled = None
 
         # do regular deploys
         self._deploy_interval = cfg.agent_interval.get()
         self._splay_interval = cfg.agent_splay.get()
         self._splay_value = random.randint(0, self._splay_interval)
+        self._incremental = cfg.agent_incremental_deploy.get()
 
         self._getting_resources = False
         self._get_resource_timeout = 0
 
+        # the last version pulled from the server and its deserialized resources
+        self._last_version = None
+        self._last_resources = []
+
     def get_client(self):
         return self.process._client
 
+    def get_batch_client(self):
+        """
+            Get the client that batches the updates this agent sends to the server
+        """
+        return self.process._batch_client
+
     def get_hostname(self):
         return self.hostname
 
+    @gen.coroutine
+    def run_handler(self, provider, function, *args, **kwargs):
+        """
+            Run a method of a handler in the thread pool. Handlers that are not parallel safe handle one resource of this
+            agent at a time.
+        """
+        if provider.parallel:
+            return (yield self.thread_pool.submit(function, *args, **kwargs))
+
+        with (yield self._handler_locks[provider.__class__].acquire()):
+            return (yield self.thread_pool.submit(function, *args, **kwargs))
+
     def is_local(self):
         return self.get_client().node_name == self.hostname or self.hostname == "localhost"
 
@@ -317,7 +472,7 @@ class AgentInstance():
 
         @gen.coroutine
         def action():
-            yield self.get_latest_version_for_agent()
+            yield self.get_latest_version_for_agent(incremental=self._incremental)
         self._enabled = action
         self.process._sched.add_action(action, self._deploy_interval, self._splay_value)
         return 200, "unpaused"
@@ -347,9 +502,11 @@ class AgentInstance():
         return True
 
     @gen.coroutine
-    def get_latest_version_for_agent(self):
+    def get_latest_version_for_agent(self, incremental=False):
         """
             Get the latest version for the given agent (this is also how we are notified)
+
+            :param incremental Only deploy the resources that changed since their last deploy
         """
         if not self._can_get_resources():
             return
@@ -359,8 +516,11 @@ class AgentInstance():
             LOGGER.debug("Getting latest resources for %s" % self.name)
             self._getting_resources = True
             start = time.time()
+            kwargs = {}
+            if self._last_version is not None:
+                kwargs["known_version"] = self._last_version
             try:
-                result = yield self.get_client().get_resources_for_agent(tid=self._env_id, agent=self.name)
+                result = yield self.get_client().get_resources_for_agent(tid=self._env_id, agent=self.name, **kwargs)
             finally:
                 self._getting_resources = False
             end = time.time()
@@ -368,6 +528,10 @@ class AgentInstance():
             self._get_resource_timeout = GET_RESOURCE_BACKOFF * self._get_resource_duration + end
             if result.code == 404:
                 LOGGER.info("No released configuration model version available for agent %s", self.name)
+            elif result.code == 304:
+                LOGGER.debug("Version %s is still the latest version for agent %s", self._last_version, self.name)
+                if len(self._last_resources) > 0:
+                    self._nq.reload(self._last_resources, incremental=incremental)
             elif result.code != 200:
                 LOGGER.warning("Got an error while pulling resources for agent %s. %s", self.name, result.result)
 
@@ -382,10 +546,15 @@ class AgentInstance():
                         resource = Resource.deserialize(data)
                         resources.append(resource)
                         LOGGER.debug("Received update for %s", resource.id)
+
+                    # only skip the next download when this one was complete
+                    self._last_version = result.result["version"]
+                    self._last_resources = resources
                 except TypeError as e:
                     LOGGER.error("Failed to receive update", e)
+                    self._last_version = None
 
-                self._nq.reload(resources)
+                self._nq.reload(resources, incremental=incremental)
 
     @gen.coroutine
     def dryrun(self, id, version):
@@ -416,6 +585,8 @@ class AgentInstance():
 
                 self._cache.open_version(version)
 
+                client = self.get_batch_client()
+                updates = []
                 for res in resources:
                     provider = None
                     try:
@@ -429,13 +600,13 @@ class AgentInstance():
                             provider.set_cache(self._cache)
                         except Exception:
                             LOGGER.exception("Unable to find a handler for %s" % resource.id)
-                            self._client.dryrun_update(tid=self._env_id, id=id, resource=res["id"],
-                                                       changes={}, log_msg="No handler available")
+                            updates.append(client.dryrun_update(tid=self._env_id, id=id, resource=res["id"],
+                                                                changes={}, log_msg="No handler available"))
                             continue
 
-                        results = yield self.thread_pool.submit(provider.execute, resource, dry_run=True)
-                        yield self.get_client().dryrun_update(tid=self._env_id, id=id, resource=res["id"],
-                                                              changes=results["changes"], log_msg=results["log_msg"])
+                        results = yield self.run_handler(provider, provider.execute, resource, dry_run=True)
+                        updates.append(client.dryrun_update(tid=self._env_id, id=id, resource=res["id"],
+                                                            changes=results["changes"], log_msg=results["log_msg"]))
 
                     except TypeError:
                         LOGGER.exception("Unable to process resource for dryrun.")
@@ -444,6 +615,7 @@ class AgentInstance():
                         if provider is not None:
                             provider.close()
 
+                yield updates
                 self._cache.close_version(version)
 
     @gen.coroutine
@@ -458,6 +630,8 @@ class AgentInstance():
             version = resources[0][1]["id_fields"]["version"]
             self._cache.open_version(version)
 
+            client = self.get_batch_client()
+            updates = []
             for restore, resource in resources:
                 start = datetime.datetime.now()
                 provider = None
@@ -469,41 +643,43 @@ class AgentInstance():
                     provider.set_cache(self._cache)
 
                     if not hasattr(resource_obj, "allow_restore") or not resource_obj.allow_restore:
-                        yield self.get_client().update_restore(tid=self._env_id,
-                                                               id=restore_id,
-                                                               resource_id=str(resource_obj.id),
-                                                               start=start,
-                                                               stop=datetime.datetime.now(),
-                                                               success=False,
-                                                               error=False,
-                                                               msg="Resource %s does not allow restore" % resource["id"])
+                        updates.append(client.update_restore(tid=self._env_id,
+                                                             id=restore_id,
+                                                             resource_id=str(resource_obj.id),
+                                                             start=start,
+                                                             stop=datetime.datetime.now(),
+                                                             success=False,
+                                                             error=False,
+                                                             msg="Resource %s does not allow restore" % resource["id"]))
                         continue
 
                     try:
-                        yield self.thread_pool.submit(provider.restore, resource_obj, restore["content_hash"])
-                        yield self.get_client().update_restore(tid=self._env_id, id=restore_id,
-                                                               resource_id=str(resource_obj.id),
-                                                               success=True, error=False,
-                                                               start=start, stop=datetime.datetime.now(), msg="")
+                        yield self.run_handler(provider, provider.restore, resource_obj, restore["content_hash"])
+                        updates.append(client.update_restore(tid=self._env_id, id=restore_id,
+                                                             resource_id=str(resource_obj.id),
+                                                             success=True, error=False,
+                                                             start=start, stop=datetime.datetime.now(), msg=""))
                     except NotImplementedError:
-                        yield self.get_client().update_restore(tid=self._env_id, id=restore_id,
-                                                               resource_id=str(resource_obj.id),
-                                                               success=False, error=False,
-                                                               start=start, stop=datetime.datetime.now(),
-                                                               msg="The handler for resource "
-                                                               "%s does not support restores" % resource["id"])
+                        updates.append(client.update_restore(tid=self._env_id, id=restore_id,
+                                                             resource_id=str(resource_obj.id),
+                                                             success=False, error=False,
+                                                             start=start, stop=datetime.datetime.now(),
+                                                             msg="The handler for resource "
+                                                             "%s does not support restores" % resource["id"]))
 
                 except Exception:
                     LOGGER.exception("Unable to find a handler for %s", resource["id"])
-                    yield self.get_client().update_restore(tid=self._env_id, id=restore_id,
-                                                           resource_id=resource_obj.id.resource_str(),
-                                                           success=False, error=False,
-                                                           start=start, stop=datetime.datetime.now(),
-                                                           msg="Unable to find a handler to restore a snapshot of resource %s" %
-                                                           resource["id"])
+                    updates.append(client.update_restore(tid=self._env_id, id=restore_id,
+                                                         resource_id=resource_obj.id.resource_str(),
+                                                         success=False, error=False,
+                                                         start=start, stop=datetime.datetime.now(),
+                                                         msg="Unable to find a handler to restore a snapshot of resource %s" %
+                                                         resource["id"]))
                 finally:
                     if provider is not None:
                         provider.close()
+
+            yield updates
             self._cache.close_version(version)
 
             return 200
@@ -519,6 +695,8 @@ class AgentInstance():
             version = resources[0]["id_fields"]["version"]
             self._cache.open_version(version)
 
+            client = self.get_batch_client()
+            updates = []
             for resource in resources:
                 start = datetime.datetime.now()
                 provider = None
@@ -530,98 +708,117 @@ class AgentInstance():
                     provider.set_cache(self._cache)
 
                     if not hasattr(resource_obj, "allow_snapshot") or not resource_obj.allow_snapshot:
-                        yield self.get_client().update_snapshot(tid=self._env_id, id=snapshot_id,
-                                                                resource_id=resource_obj.id.resource_str(), snapshot_data="",
-                                                                start=start, stop=datetime.datetime.now(), size=0,
-                                                                success=False, error=False,
-                                                                msg="Resource %s does not allow snapshots" % resource["id"])
+                        updates.append(client.update_snapshot(tid=self._env_id, id=snapshot_id,
+                                                              resource_id=resource_obj.id.resource_str(), snapshot_data="",
+                                                              start=start, stop=datetime.datetime.now(), size=0,
+                                                              success=False, error=False,
+                                                              msg="Resource %s does not allow snapshots" % resource["id"]))
                         continue
 
                     try:
-                        result = yield self.thread_pool.submit(provider.snapshot, resource_obj)
+                        result = yield self.run_handler(provider, provider.snapshot, resource_obj)
                         if result is not None:
-                            sha1sum = hashlib.sha1()
-                            sha1sum.update(result)
-                            content_id = sha1sum.hexdigest()
-                            yield self.get_client().upload_file(id=content_id, content=base64.b64encode(result).decode("ascii"))
-
-                            yield self.get_client().update_snapshot(tid=self._env_id, id=snapshot_id,
-                                                                    resource_id=resource_obj.id.resource_str(),
-                                                                    snapshot_data=content_id,
-                                                                    start=start, stop=datetime.datetime.now(),
-                                                                    size=len(result), success=True, error=False,
-                                                                    msg="")
+                            content_id, size, stream = yield self.thread_pool.submit(hash_snapshot, result)
+                            try:
+                                yield self.get_client().upload_file_stream(id=content_id, stream=stream)
+                            finally:
+                                stream.close()
+
+                            updates.append(client.update_snapshot(tid=self._env_id, id=snapshot_id,
+                                                                  resource_id=resource_obj.id.resource_str(),
+                                                                  snapshot_data=content_id,
+                                                                  start=start, stop=datetime.datetime.now(),
+                                                                  size=size, success=True, error=False,
+                                                                  msg=""))
                         else:
                             raise Exception("Snapshot returned no data")
 
                     except NotImplementedError:
-                        yield self.get_client().update_snapshot(tid=self._env_id, id=snapshot_id, error=False,
-                                                                resource_id=resource_obj.id.resource_str(),
-                                                                snapshot_data="",
-                                                                start=start, stop=datetime.datetime.now(),
-                                                                size=0, success=False,
-                                                                msg="The handler for resource "
-                                                                "%s does not support snapshots" % resource["id"])
+                        updates.append(client.update_snapshot(tid=self._env_id, id=snapshot_id, error=False,
+                                                              resource_id=resource_obj.id.resource_str(),
+                                                              snapshot_data="",
+                                                              start=start, stop=datetime.datetime.now(),
+                                                              size=0, success=False,
+                                                              msg="The handler for resource "
+                                                              "%s does not support snapshots" % resource["id"]))
                     except Exception:
                         LOGGER.exception("An exception occurred while creating the snapshot of %s", resource["id"])
-                        yield self.get_client().update_snapshot(tid=self._env_id, id=snapshot_id, snapshot_data="",
-                                                                resource_id=resource_obj.id.resource_str(), error=True,
-                                                                start=start,
-                                                                stop=datetime.datetime.now(),
-                                                                size=0, success=False,
-                                                                msg="The handler for resource "
-                                                                "%s does not support snapshots" % resource["id"])
+                        updates.append(client.update_snapshot(tid=self._env_id, id=snapshot_id, snapshot_data="",
+                                                              resource_id=resource_obj.id.resource_str(), error=True,
+                                                              start=start,
+                                                              stop=datetime.datetime.now(),
+                                                              size=0, success=False,
+                                                              msg="The handler for resource "
+                                                              "%s does not support snapshots" % resource["id"]))
 
                 except Exception:
                     LOGGER.exception("Unable to find a handler for %s", resource["id"])
-                    yield self.get_client().update_snapshot(tid=self._env_id,
-                                                            id=snapshot_id, snapshot_data="",
-                                                            resource_id=resource_obj.id.resource_str(), error=False,
-                                                            start=start, stop=datetime.datetime.now(),
-                                                            size=0, success=False,
-                                                            msg="Unable to find a handler for %s" % resource["id"])
+                    updates.append(client.update_snapshot(tid=self._env_id,
+                                                          id=snapshot_id, snapshot_data="",
+                                                          resource_id=resource_obj.id.resource_str(), error=False,
+                                                          start=start, stop=datetime.datetime.now(),
+                                                          size=0, success=False,
+                                                          msg="Unable to find a handler for %s" % resource["id"]))
                 finally:
                     if provider is not None:
                         provider.close()
 
+            yield updates
             self._cache.close_version(version)
             return 200
 
     @gen.coroutine
     def get_facts(self, resource):
-        with (yield self.ratelimiter.acquire()):
-            yield self.process._ensure_code(self._env_id, resource["id_fields"]["version"],
-                                            [resource["id_fields"]["entity_type"]])
+        return (yield self.get_facts_batch([resource]))
 
-            provider = None
-            try:
-                data = resource["fields"]
-                data["id"] = resource["id"]
-                resource_obj = Resource.deserialize(data)
+    @gen.coroutine
+    def get_facts_batch(self, resources):
+        """
+            Get the facts of the given resources and report all of them to the server with one call
+        """
+        code = 200
+        parameters = []
+        with (yield self.ratelimiter.acquire()):
+            types_per_version = defaultdict(set)
+            for resource in resources:
+                types_per_version[resource["id_fields"]["version"]].add(resource["id_fields"]["entity_type"])
 
-                version = resource_obj.version
+            for version, types in types_per_version.items():
+                yield self.process._ensure_code(self._env_id, version, list(types))
 
+            for resource in resources:
+                provider = None
                 try:
-                    self._cache.open_version(version)
-                    provider = Commander.get_provider(self._cache, self, resource_obj)
-                    provider.set_cache(self._cache)
-                    result = yield self.thread_pool.submit(provider.check_facts, resource_obj)
-                    parameters = [{"id": name, "value": value, "resource_id": resource_obj.id.resource_str(), "source": "fact"}
-                                  for name, value in result.items()]
-                    yield self.get_client().set_parameters(tid=self._env_id, parameters=parameters)
+                    data = resource["fields"]
+                    data["id"] = resource["id"]
+                    resource_obj = Resource.deserialize(data)
+
+                    version = resource_obj.version
+
+                    try:
+                        self._cache.open_version(version)
+                        provider = Commander.get_provider(self._cache, self, resource_obj)
+                        provider.set_cache(self._cache)
+                        result = yield self.run_handler(provider, provider.check_facts, resource_obj)
+                        parameters.extend([{"id": name, "value": value, "resource_id": resource_obj.id.resource_str(),
+                                            "source": "fact"} for name, value in result.items()])
+
+                    except Exception:
+                        LOGGER.exception("Unable to retrieve fact")
+                    finally:
+                        self._cache.close_version(version)
 
                 except Exception:
-                    LOGGER.exception("Unable to retrieve fact")
+                    LOGGER.exception("Unable to find a handler for %s", resource["id"])
+                    code = 500
                 finally:
-                    self._cache.close_version(version)
+                    if provider is not None:
+                        provider.close()
 
-            except Exception:
-                LOGGER.exception("Unable to find a handler for %s", resource["id"])
-                return 500
-            finally:
-                if provider is not None:
-                    provider.close()
-            return 200
+        if len(parameters) > 0:
+            yield self.get_client().set_parameters(tid=self._env_id, parameters=parameters)
+
+        return code
 
 
 class Agent(AgentEndPoint):
@@ -630,11 +827,19 @@ class Agent(AgentEndPoint):
         message bus for changes.
     """
 
-    def __init__(self, io_loop, hostname=None, agent_map=None, code_loader=True, env_id=None, poolsize=1, cricital_pool_size=5):
-        super().__init__("agent", io_loop, timeout=cfg.server_timeout.get(), reconnect_delay=cfg.agent_reconnect_delay.get())
+    def __init__(self, io_loop, hostname=None, agent_map=None, code_loader=True, env_id=None, poolsize=None,
+                 cricital_pool_size=5, instance_poolsize=None):
+        super().__init__("agent", io_loop, timeout=cfg.server_timeout.get(), reconnect_delay=cfg.agent_reconnect_delay.get(),
+                         batch_window=cfg.agent_batch_window.get() / 1000, batch_size=cfg.agent_batch_size.get(),
+                         websocket=cfg.agent_websocket.get())
+
+        if poolsize is None:
+            poolsize = cfg.agent_max_concurrency.get()
+        if instance_poolsize is None:
+            instance_poolsize = cfg.agent_instance_concurrency.get()
 
         self.poolsize = poolsize
-        self.ratelimiter = locks.Semaphore(poolsize)
+        self.limiter = ConcurrencyLimiter(poolsize, instance_poolsize)
         self.critical_ratelimiter = locks.Semaphore(cricital_pool_size)
         self._sched = Scheduler(io_loop=self._io_loop)
         self.thread_pool = ThreadPoolExecutor(poolsize)
@@ -861,6 +1066,14 @@ class Agent(AgentEndPoint):
 
         return (yield self._instances[agent].get_facts(resource))
 
+    @protocol.handle(methods.AgentParametersMethod.get_parameters)
+    @gen.coroutine
+    def get_facts_batch(self, tid, agent, resources):
+        if agent not in self._instances:
+            return 200
+
+        return (yield self._instances[agent].get_facts_batch(resources))
+
     @protocol.handle(methods.AgentReporting.get_status)
     @gen.coroutine
     def get_status(self):
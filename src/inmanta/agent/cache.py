@@ -19,6 +19,7 @@
 import time
 import sys
 import bisect
+import threading
 
 
 class Scope(object):
@@ -50,6 +51,8 @@ class AgentCache():
 
         versions are opened and closed
         when a version is closed as many times as it was opened, all cache items linked to this version are dropped
+
+        handlers use the cache from the threads of the agent, all access to the cache is serialized with a lock
     """
 
     def __init__(self):
@@ -58,6 +61,7 @@ class AgentCache():
         self.keysforVersion = {}
         self.timerqueue = []
         self.nextAction = sys.maxsize
+        self._lock = threading.RLock()
 
     def open_version(self, version: int):
         """
@@ -65,11 +69,12 @@ class AgentCache():
 
             :param verion the version id to open the cache for
         """
-        if version in self.counterforVersion:
-            self.counterforVersion[version] += 1
-        else:
-            self.counterforVersion[version] = 1
-            self.keysforVersion[version] = set()
+        with self._lock:
+            if version in self.counterforVersion:
+                self.counterforVersion[version] += 1
+            else:
+                self.counterforVersion[version] = 1
+                self.keysforVersion[version] = set()
 
     def close_version(self, version: int):
         """
@@ -79,6 +84,10 @@ class AgentCache():
 
             :param verion the version id to close the cache for
         """
+        with self._lock:
+            self._close_version(version)
+
+    def _close_version(self, version: int):
         if version not in self.counterforVersion:
             raise Exception("Closed version that does not exist")
 
@@ -111,10 +120,15 @@ class AgentCache():
                 self.nextAction = sys.maxsize
 
     def _get(self, key):
-        self._advance_time()
-        return self.cache[key]
+        with self._lock:
+            self._advance_time()
+            return self.cache[key]
 
     def _cache(self, item: CacheItem):
+        with self._lock:
+            self._cache_item(item)
+
+    def _cache_item(self, item: CacheItem):
         scope = item.scope
 
         if item.key in self.cache:
@@ -192,5 +206,10 @@ class AgentCache():
         except KeyError:
             value = function(**kwargs)
             if cache_none or value is not None:
-                self.cache_value(key, value, timeout=timeout, **args)
+                with self._lock:
+                    # another thread may have produced the value in the mean time
+                    try:
+                        return self.find(key, **args)
+                    except KeyError:
+                        self.cache_value(key, value, timeout=timeout, **args)
             return value
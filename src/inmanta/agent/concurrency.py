@@ -0,0 +1,166 @@
+"""
+    Copyright 2016 Inmanta
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Contact: code@inmanta.com
+"""
+
+import collections
+import logging
+
+from tornado.concurrent import Future
+
+LOGGER = logging.getLogger(__name__)
+
+
+class _Slot(object):
+    """
+        A slot acquired from a ConcurrencyLimiter. The slot is released when the with block it is used in ends.
+    """
+
+    def __init__(self, limiter, name):
+        self._limiter = limiter
+        self._name = name
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._limiter.release(self._name)
+
+
+class _InstanceState(object):
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.running = 0
+        self.waiting = collections.deque()
+        self.last_started = 0
+        self.started = 0
+        self.failed = 0
+
+
+class ConcurrencyLimiter(object):
+    """
+        Limit the number of resources that the agent instances of an agent process work on at the same time.
+
+        The process runs at most limit resources at the same time. Each agent instance runs at most instance_limit resources
+        at the same time. The limit of an instance adapts to how its resources deploy: it starts at one, grows by one after
+        each successful run and is halved after a failed run, so an instance of which the target is overloaded or
+        unreachable uses fewer slots. When a slot becomes free, it goes to the waiting instance that runs the fewest
+        resources and, between instances that run as many resources, to the one that started a resource the longest ago.
+        This way one busy or slow agent instance can not starve the others.
+
+        :param limit The maximal number of resources the process runs at the same time
+        :param instance_limit The maximal number of resources one agent instance runs at the same time
+    """
+
+    def __init__(self, limit, instance_limit):
+        self._limit = max(limit, 1)
+        self._instance_limit = max(min(instance_limit, self._limit), 1)
+        self._running = 0
+        self._counter = 0
+        self._instances = {}
+
+    def _get_instance(self, name):
+        if name not in self._instances:
+            self._instances[name] = _InstanceState(1)
+        return self._instances[name]
+
+    def get_instance_limiter(self, name):
+        """
+            Get the limiter for the agent instance with the given name
+        """
+        self._get_instance(name)
+        return InstanceLimiter(self, name)
+
+    def acquire(self, name):
+        """
+            Acquire a slot for the agent instance with the given name
+
+            :return A future that resolves to the slot, use it in a with block to release it
+        """
+        future = Future()
+        self._get_instance(name).waiting.append(future)
+        self._dispatch()
+        return future
+
+    def release(self, name):
+        self._running -= 1
+        self._instances[name].running -= 1
+        self._dispatch()
+
+    def feedback(self, name, success):
+        """
+            Adapt the limit of an agent instance to the result of a run of a handler
+        """
+        instance = self._get_instance(name)
+        if success:
+            instance.limit = min(instance.limit + 1, self._instance_limit)
+        else:
+            instance.failed += 1
+            if instance.limit > 1:
+                instance.limit = max(instance.limit // 2, 1)
+                LOGGER.debug("Reduced the concurrency of agent %s to %d", name, instance.limit)
+
+    def _dispatch(self):
+        while self._running < self._limit:
+            selected = None
+            for name, instance in self._instances.items():
+                if len(instance.waiting) == 0 or instance.running >= instance.limit:
+                    continue
+
+                if selected is None or (instance.running, instance.last_started) < (selected.running, selected.last_started):
+                    selected = instance
+                    selected_name = name
+
+            if selected is None:
+                return
+
+            name, instance = selected_name, selected
+            self._counter += 1
+            self._running += 1
+            instance.running += 1
+            instance.started += 1
+            instance.last_started = self._counter
+            instance.waiting.popleft().set_result(_Slot(self, name))
+
+    def to_dict(self):
+        return {"limit": self._limit,
+                "instance_limit": self._instance_limit,
+                "running": self._running,
+                "waiting": sum([len(i.waiting) for i in self._instances.values()]),
+                "instances": {name: {"limit": i.limit,
+                                     "running": i.running,
+                                     "waiting": len(i.waiting),
+                                     "started": i.started,
+                                     "failed": i.failed,
+                                     } for name, i in self._instances.items()},
+                }
+
+
+class InstanceLimiter(object):
+    """
+        The slots of one agent instance in a ConcurrencyLimiter
+    """
+
+    def __init__(self, limiter, name):
+        self._limiter = limiter
+        self._name = name
+
+    def acquire(self):
+        return self._limiter.acquire(self._name)
+
+    def feedback(self, success):
+        self._limiter.feedback(self._name, success)
@@ -70,6 +70,41 @@ server_timeout = \
     Option("config", "server-timeout", 125,
            "Amount of time to wait for a response from the server before we try to reconnect, must be smaller than server.agent-hold", is_time)
 
+agent_batch_window = \
+    Option("config", "agent-batch-window", 100,
+           """Time in milliseconds the agent collects resource updates, dryrun results and snapshot and restore updates to
+send them to the server in one call. Set this to 0 to send every update in its own call.""", is_int)
+
+agent_batch_size = \
+    Option("config", "agent-batch-size", 250,
+           "Maximal number of updates the agent sends to the server in one call", is_int)
+
+agent_websocket = \
+    Option("config", "agent-websocket", False,
+           """Receive the calls of the server over a websocket instead of polling for them with heartbeat calls. The agent
+uses heartbeat calls when the server does not support websockets.""", is_bool)
+
+agent_incremental_deploy = \
+    Option("config", "agent-incremental-deploy", False,
+           """Only deploy the resources that changed since their last successful deploy, or that depend on a resource that
+changed, during the periodic deploys of the agent. Deploys that are triggered by the server always deploy all resources.""",
+           is_bool)
+
+agent_repair_interval = \
+    Option("config", "agent-repair-interval", 3600,
+           """Time in seconds after which a periodic incremental deploy deploys a resource again, even when it did not
+change since its last successful deploy. This repairs resources that were changed outside of the orchestrator.""", is_time)
+
+agent_max_concurrency = \
+    Option("config", "agent-max-concurrency", 10,
+           "Maximal number of resources the agent process deploys at the same time, over all agents it runs", is_int)
+
+agent_instance_concurrency = \
+    Option("config", "agent-instance-concurrency", 1,
+           """Maximal number of resources of one agent that are deployed at the same time. The agent lowers this number for
+an agent of which the resources fail to deploy. Handlers that are not parallel safe still handle one resource of an agent
+at a time.""", is_int)
+
 
 ##############################
 # agent_rest_transport
@@ -20,7 +20,7 @@ from collections import defaultdict
 import hashlib
 import inspect
 import logging
-import base64
+import io
 from concurrent.futures import Future
 
 
@@ -102,7 +102,11 @@ def cache(f=None, ignore=[], timeout=5000, forVersion=True, cacheNone=True):
 class ResourceHandler(object):
     """
         A baseclass for classes that handle resource on a platform
+
+        The agent deploys several resources of an agent at the same time. A handler that can not handle several resources of
+        the same agent at the same time, for example because the tool it uses locks the host, sets parallel to False.
     """
+    parallel = True
 
     def __init__(self, agent, io=None):
         self._agent = agent
@@ -279,7 +283,8 @@ class ResourceHandler(object):
             Create a new snapshot and upload it to the server
 
             :param resource The state of the resource for which a snapshot is created
-            :return The data that needs to be uploaded to the server
+            :return The data that needs to be uploaded to the server. Large snapshots can be returned as a binary file
+                    object, which is streamed to the server without loading it in memory.
         """
         raise NotImplementedError()
 
@@ -293,17 +298,40 @@ class ResourceHandler(object):
         """
             Retrieve a file from the fileserver identified with the given hash
         """
+        content = io.BytesIO()
+        if not self.stream_file(hash_id, content):
+            return None
+
+        return content.getvalue()
+
+    def stream_file(self, hash_id, fd):
+        """
+            Retrieve a file from the fileserver identified with the given hash and write it to the binary file object fd
+
+            :return False when the file does not exist
+            :raise Exception The content of the file does not match its hash
+        """
+        sha1sum = hashlib.new("sha1")
+
+        class HashingWriter(object):
+            def write(self, chunk):
+                sha1sum.update(chunk)
+                fd.write(chunk)
+
         def call():
-            return self.get_client().get_file(hash_id)
+            return self.get_client().get_file_stream(id=hash_id, stream=HashingWriter())
 
         result = self.run_sync(call)
         if result.code == 404:
-            return None
-        elif result.code == 200:
-            return base64.b64decode(result.result["content"])
-        else:
+            return False
+        elif result.code != 200:
             raise Exception("An error occurred while retrieving file %s" % hash_id)
 
+        if sha1sum.hexdigest() != hash_id:
+            raise Exception("The content of file %s does not match its hash" % hash_id)
+
+        return True
+
     def stat_file(self, hash_id):
         """
             Check if a file exists on the server
@@ -317,9 +345,14 @@ class ResourceHandler(object):
     def upload_file(self, hash_id, content):
         """
             Upload a file to the server
+
+            :param content The content as bytes or a binary file object
         """
+        if isinstance(content, bytes):
+            content = io.BytesIO(content)
+
         def call():
-            return self.get_client().upload_file(id=hash_id, content=base64.b64encode(content).decode("ascii"))
+            return self.get_client().upload_file_stream(id=hash_id, stream=content)
 
         try:
             self.run_sync(call)
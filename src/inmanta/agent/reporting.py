@@ -24,6 +24,8 @@ File containing auto reporting functionality for the agent
 import platform
 import resource
 
+from inmanta import protocol
+
 LOGGER = logging.getLogger(__name__)
 
 reports = {}
@@ -114,3 +116,15 @@ def report_resources(agent):
     return out
 
 reports["resources"] = report_resources
+
+
+def report_http_clients(agent):
+    return protocol.get_client_pool_stats()
+
+reports["http_clients"] = report_http_clients
+
+
+def report_concurrency(agent):
+    return agent.limiter.to_dict()
+
+reports["concurrency"] = report_concurrency
@@ -18,6 +18,7 @@
 
 from argparse import ArgumentParser
 import logging
+import os
 import sys
 import time
 
@@ -63,6 +64,23 @@ def start_agent(options):
         a.stop()
 
 
+@command("migrate-files", help_msg="Move the files of the server to the sharded file store. Only run this when the server "
+         "is stopped.")
+def migrate_files(options):
+    from inmanta.server import config as opt
+    from inmanta.server.filestore import FileStore
+
+    store = FileStore(os.path.join(opt.state_dir.get(), "server", "files"), compress=opt.server_compress_files.get())
+    count = store.migrate()
+    LOGGER.info("Migrated %d files to %s", count, store.path)
+
+
+@command("compiler-service", help_msg="Run a compiler service for the server. It reads compile requests from stdin.")
+def compiler_service(options):
+    from inmanta.server.compilerservice import serve
+    serve()
+
+
 def compiler_config(parser):
     """
         Configure the compiler of the export function
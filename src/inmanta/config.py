@@ -253,6 +253,16 @@ log_dir = \
            "The directory where the server stores log file. Currently this is only for the output of embedded agents.")
 
 
+json_codec = \
+    Option("config", "json-codec", "auto",
+           "The library that encodes and decodes the json bodies of api calls: json, orjson or auto to use orjson when it "
+           "is installed")
+
+http_compression = \
+    Option("config", "http-compression", True,
+           "Compress the bodies of api calls with gzip when the other side supports it", is_bool)
+
+
 def get_executable():
     """os.path.abspath(sys.argv[0]) """
     try:
@@ -295,6 +305,16 @@ class TransportConfig(object):
             self.prefix, "password", None, "Password used to connect to the server", is_str_opt)
         self.username = Option(
             self.prefix, "username", None, "Username used to connect to the server", is_str_opt)
+        self.request_timeout = Option(
+            self.prefix, "request-timeout", 120, "Time to wait for the response of the server to a call", is_time)
+        self.max_clients = Option(
+            self.prefix, "max-clients", 10, "Maximal number of concurrent calls to the server", is_int)
+        self.keep_alive = Option(
+            self.prefix, "keep-alive", True,
+            "Reuse connections to the server. Only the curl http client keeps connections open", is_bool)
+        self.http_client = Option(
+            self.prefix, "http-client", "simple",
+            "The http client used to call the server: simple or curl. The curl client requires pycurl", is_str)
 
 TransportConfig("compiler")
 TransportConfig("client")
@@ -16,6 +16,9 @@
     Contact: code@inmanta.com
 """
 
+from collections import defaultdict
+import datetime
+import hashlib
 import json
 import logging
 
@@ -23,14 +26,25 @@ import logging
 from motorengine import Document
 from motorengine.fields import (StringField, ReferenceField, DateTimeField, IntField, UUIDField, BooleanField)
 from motorengine.fields.json_field import JsonField
+from motorengine.fields.dynamic_field import DynamicField
 from inmanta.resources import Id
 from tornado import gen
 from motorengine.fields.list_field import ListField
 from motorengine.fields.embedded_document_field import EmbeddedDocumentField
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError, OperationFailure
 
 LOGGER = logging.getLogger(__name__)
 
 
+def query_spec(query):
+    """
+        Get the raw mongodb filter of a motorengine queryset. This is used for atomic operations that motorengine does not
+        provide.
+    """
+    return query.get_query_from_filters(query._filters)
+
+
 class IdDocument(Document):
     """
         A document that has a uuid as id that is required and unique
@@ -100,6 +114,7 @@ class Environment(IdDocument):
         for model in models:
             yield model.delete_cascade()
 
+        yield ResourceAttributes.objects.filter(environment=self).delete()
         yield self.delete()
 
 
@@ -337,8 +352,11 @@ class Report(Document):
         :param completed when it ended
         :param command the command that was executed
         :param name The name of this step
-        :param errstream what was reported on system err
-        :param outstream what was reported on system out
+        :param errstream what was reported on system err, only set by older versions of the server
+        :param outstream what was reported on system out, only set by older versions of the server
+        :param uuid The id of the output of the step, which is stored in ReportOutput chunks
+        :param errsize The number of characters reported on system err
+        :param outsize The number of characters reported on system out
     """
     started = DateTimeField(required=True)
     completed = DateTimeField(required=True)
@@ -347,17 +365,99 @@ class Report(Document):
     errstream = StringField(default="")
     outstream = StringField(default="")
     returncode = IntField()
+    uuid = UUIDField()
+    errsize = IntField(default=0)
+    outsize = IntField(default=0)
     # compile = ReferenceField(reference_document_type="inmanta.data.Compile")
 
     def to_dict(self):
-        return {"started": self.started.isoformat(),
-                "completed": self.completed.isoformat(),
-                "command": self.command,
-                "name": self.name,
-                "errstream": self.errstream,
-                "outstream": self.outstream,
-                "returncode": self.returncode
-                }
+        """
+            A summary of the report. The output is retrieved separately, except for reports that embed their output.
+        """
+        result = {"started": self.started.isoformat(),
+                  "completed": self.completed.isoformat(),
+                  "command": self.command,
+                  "name": self.name,
+                  "returncode": self.returncode
+                  }
+
+        if self.uuid is None:
+            result["errstream"] = self.errstream
+            result["outstream"] = self.outstream
+        else:
+            result["id"] = self.uuid
+            result["errsize"] = self.errsize
+            result["outsize"] = self.outsize
+
+        return result
+
+
+class ReportOutput(Document):
+    """
+        A chunk of the output of a substep of compilation. The output is stored while the step runs, so it can be followed
+        and it never has to be held in memory as a whole.
+
+        :param environment The environment that was compiled
+        :param report The id of the report of the step
+        :param stream out or err
+        :param index The sequence number of the chunk in the stream
+        :param offset The offset of the first character of the chunk in the stream
+        :param end The offset of the character after the chunk
+        :param content The output
+    """
+    environment = ReferenceField(reference_document_type=Environment)
+    report = UUIDField(required=True)
+    stream = StringField(required=True)
+    index = IntField(required=True)
+    offset = IntField(required=True)
+    end = IntField(required=True)
+    content = StringField(default="")
+
+    @classmethod
+    @gen.coroutine
+    def create_indexes(cls):
+        """
+            Create the index that orders the chunks of a stream
+        """
+        yield cls.objects.coll().create_index([("report", ASCENDING), ("stream", ASCENDING), ("index", ASCENDING)],
+                                              unique=True)
+
+    @classmethod
+    @gen.coroutine
+    def get_output(cls, report_id, stream, start=None, limit=1024 * 1024):
+        """
+            Get a page of the output of a stream
+
+            :param start The offset of the first character to return. When it is not set, the last limit characters are
+                         returned.
+            :param limit The maximal number of characters to return
+            :return A dict with the output, the offsets of its start and end, the size of the stream and the offset of the
+                    first character that is still stored. Older output is removed when a stream grows beyond the output
+                    limit of the server.
+        """
+        query = cls.objects.filter(report=report_id, stream=stream)
+        last = yield query.order_by("index", direction=DESCENDING).limit(1).find_all()
+        if len(last) == 0:
+            return {"output": "", "start": 0, "end": 0, "size": 0, "available": 0}
+
+        query = cls.objects.filter(report=report_id, stream=stream)
+        first = yield query.order_by("index", direction=ASCENDING).limit(1).find_all()
+
+        size = last[0].end
+        available = first[0].offset
+        if start is None:
+            start = size - limit
+        start = min(max(start, available), size)
+
+        chunks = yield (cls.objects.filter(report=report_id, stream=stream, end__gt=start, offset__lt=start + limit).
+                        order_by("index", direction=ASCENDING).find_all())
+
+        output = ""
+        if len(chunks) > 0:
+            output = "".join([chunk.content for chunk in chunks])
+            output = output[start - chunks[0].offset:start - chunks[0].offset + limit]
+
+        return {"output": output, "start": start, "end": start + len(output), "size": size, "available": available}
 
 
 class Compile(Document):
@@ -487,19 +587,22 @@ class ResourceAction(Document):
     """
         Log related to actions performed on a specific resource version by Inmanta.
 
+        :param environment The environment of the resource version, used to apply the retention policy
         :param resource_version The resource on which the actions are performed
         :param action The action performed on the resource
         :param timestamp When did the action occur
         :param message The log message associated with this action
         :param level The "urgency" of this action
-        :param data A python dictionary that can be serialized to json with additional data
+        :param data A python dictionary with additional data. It is stored as a sub document, unless it contains keys that
+                    mongodb does not accept. Those are stored as a json string.
     """
+    environment = ReferenceField(reference_document_type=Environment, sparse=True)
     resource_version = ReferenceField(reference_document_type="inmanta.data.ResourceVersion", sparse=True)
     action = StringField(required=True, sparse=True)
     timestamp = DateTimeField(required=True)
     message = StringField()
     level = StringField(default="INFO")
-    data = StringField()
+    data = DynamicField()
     status = StringField()
 
     def to_dict(self):
@@ -508,9 +611,241 @@ class ResourceAction(Document):
                 "message": self.message,
                 "level": self.level,
                 "status": self.status,
-                "data": json.loads(self.data) if self.data is not None else None,
+                "data": json.loads(self.data) if isinstance(self.data, str) else self.data,
                 }
 
+    @staticmethod
+    def encode_data(value):
+        """
+            Get the value to store in the data field: the value itself when mongodb accepts all keys in it, otherwise the
+            value serialized to json.
+        """
+        def valid(value):
+            if isinstance(value, dict):
+                return all(isinstance(k, str) and "." not in k and not k.startswith("$") and valid(v)
+                           for k, v in value.items())
+
+            if isinstance(value, list):
+                return all(valid(v) for v in value)
+
+            return True
+
+        if valid(value):
+            return value
+
+        return json.dumps(value)
+
+    @classmethod
+    @gen.coroutine
+    def create_indexes(cls):
+        """
+            Create the compound indexes for the queries of the dashboard on the log of a resource version and for the
+            retention policy.
+        """
+        coll = cls.objects.coll()
+        yield [coll.create_index([("resource_version", ASCENDING), ("action", ASCENDING), ("timestamp", DESCENDING)]),
+               coll.create_index([("resource_version", ASCENDING), ("timestamp", DESCENDING)]),
+               coll.create_index([("environment", ASCENDING), ("timestamp", DESCENDING)])]
+
+    @classmethod
+    @gen.coroutine
+    def purge(cls, environment, max_age=0, max_count=0):
+        """
+            Delete the actions of the given environment that are older than max_age seconds and all but the max_count most
+            recent actions. A limit of 0 disables it. Returns the number of deleted actions.
+        """
+        spec = query_spec(cls.objects.filter(environment=environment))
+        cutoff = None
+        if max_age > 0:
+            cutoff = datetime.datetime.now() - datetime.timedelta(seconds=max_age)
+
+        if max_count > 0:
+            # actions that are stored together share their timestamp, the id orders them within the same timestamp
+            oldest = yield cls.objects.coll().find_one(spec, fields=["timestamp"], skip=max_count,
+                                                       sort=[("timestamp", DESCENDING), ("_id", DESCENDING)])
+            if oldest is not None and (cutoff is None or oldest["timestamp"] >= cutoff):
+                # also delete the action at the cutoff, it is not within the max_count most recent actions
+                spec["$or"] = [{"timestamp": {"$lt": oldest["timestamp"]}},
+                               {"timestamp": oldest["timestamp"], "_id": {"$lte": oldest["_id"]}}]
+                cutoff = None
+
+        if cutoff is not None:
+            spec["timestamp"] = {"$lt": cutoff}
+
+        if "timestamp" not in spec and "$or" not in spec:
+            return 0
+
+        result = yield cls.objects.coll().remove(spec)
+        return result["n"]
+
+    @classmethod
+    @gen.coroutine
+    def set_missing_environments(cls, batch_size=1000):
+        """
+            Set the environment on actions stored before this field was introduced, to the environment of their resource
+            version. Actions of which the resource version no longer exists are deleted. Returns the number of updated
+            actions.
+        """
+        coll = cls.objects.coll()
+        missing = {"environment": {"$exists": False}}
+        count = 0
+        while True:
+            result = yield coll.aggregate([{"$match": missing}, {"$limit": batch_size},
+                                           {"$group": {"_id": "$resource_version"}}])
+            rv_ids = [x["_id"] for x in result["result"]]
+            if len(rv_ids) == 0:
+                return count
+
+            result = yield ResourceVersion.objects.coll().aggregate([{"$match": {"_id": {"$in": rv_ids}}},
+                                                                     {"$group": {"_id": "$environment",
+                                                                                 "rvs": {"$push": "$_id"}}}])
+            found = set()
+            for group in result["result"]:
+                spec = dict(missing, resource_version={"$in": group["rvs"]})
+                updated = yield coll.update(spec, {"$set": {"environment": group["_id"]}}, multi=True)
+                count += updated["n"]
+                found.update(group["rvs"])
+
+            orphans = [rv_id for rv_id in rv_ids if rv_id not in found]
+            if len(orphans) > 0:
+                yield coll.remove(dict(missing, resource_version={"$in": orphans}))
+
+    @classmethod
+    @gen.coroutine
+    def get_for_resource_versions(cls, resource_versions, action=None, limit=None):
+        """
+            Get the actions of the given resource versions with one query, the latest action first.
+
+            :param action Only return actions of this type
+            :param limit The maximal number of actions to return for each resource version
+            :return A dict with the id of the resource version as key and a list of actions as value
+        """
+        query = cls.objects.filter(resource_version__in=resource_versions)
+        if action is not None:
+            query = query.filter(action=action)
+
+        pipeline = [{"$match": query_spec(query)},
+                    {"$sort": {"timestamp": -1}},
+                    {"$group": {"_id": "$resource_version", "actions": {"$push": "$$ROOT"}}}]
+        if limit is not None:
+            pipeline.append({"$project": {"actions": {"$slice": ["$actions", limit]}}})
+
+        result = yield cls.objects.coll().aggregate(pipeline, allowDiskUse=True)
+        return {group["_id"]: [cls.from_son(action) for action in group["actions"]] for group in result["result"]}
+
+
+class ResourceAttributes(Document):
+    """
+        The attributes of resource versions, stored once for each distinct content. The version is removed from the
+        attributes and from the requires of the resource, so a resource that did not change between two versions of the
+        configuration model references the same document.
+
+        :param environment The environment these attributes are defined in
+        :param hash The hash of the normalized attributes
+        :param attributes The normalized attributes
+    """
+    environment = ReferenceField(reference_document_type=Environment, required=True, sparse=True)
+    hash = StringField(required=True, sparse=True)
+    attributes = JsonField()
+
+    @staticmethod
+    def normalize(attributes, version):
+        """
+            Remove the version from the attributes of a resource version
+        """
+        normalized = attributes.copy()
+        if normalized.get("version") == version:
+            del normalized["version"]
+
+        if "requires" in normalized:
+            suffix = ",v=%s" % version
+            normalized["requires"] = [req[:-len(suffix)] if req.endswith(suffix) else req for req in normalized["requires"]]
+
+        return normalized
+
+    @staticmethod
+    def denormalize(attributes, version):
+        """
+            Add the version to normalized attributes again
+        """
+        attributes = attributes.copy()
+        if "version" not in attributes:
+            attributes["version"] = version
+        if "requires" in attributes:
+            attributes["requires"] = [req + ",v=%s" % version if req.endswith("]") else req for req in attributes["requires"]]
+
+        return attributes
+
+    @staticmethod
+    def hash_attributes(attributes):
+        return hashlib.sha1(json.dumps(attributes, sort_keys=True).encode()).hexdigest()
+
+    @classmethod
+    @gen.coroutine
+    def store(cls, environment, attribute_list):
+        """
+            Store the given normalized attributes, unless the environment already has attributes with the same content.
+
+            :param attribute_list A list of (hash, normalized attributes) tuples
+        """
+        new = dict(attribute_list)
+        if len(new) == 0:
+            return
+
+        existing = yield (cls.objects.filter(environment=environment, hash__in=list(new.keys()))
+                          .only("hash").limit(len(new)).find_all())
+        for attr in existing:
+            del new[attr.hash]
+
+        if len(new) > 0:
+            # the unique index rejects attributes that a concurrent store inserted, the others are inserted anyway
+            docs = [cls(environment=environment, hash=h, attributes=a).to_son() for h, a in new.items()]
+            try:
+                yield cls.objects.coll().insert(docs, continue_on_error=True)
+            except DuplicateKeyError:
+                pass
+
+    @classmethod
+    @gen.coroutine
+    def create_indexes(cls):
+        """
+            Create the unique index on the hash of the attributes of an environment
+        """
+        try:
+            yield cls.objects.coll().create_index([("environment", ASCENDING), ("hash", ASCENDING)], unique=True)
+        except OperationFailure:
+            LOGGER.exception("Unable to create the unique index on resource attributes, the collection contains duplicates")
+
+    @classmethod
+    @gen.coroutine
+    def delete_unused(cls, environment, batch_size=1000):
+        """
+            Delete all attributes of the given environment that are no longer used by a resource version. The attributes
+            are checked in batches of batch_size hashes, so no query or result grows with the size of the environment. The
+            caller has to make sure that no version of the environment is stored at the same time.
+
+            :return The number of deleted attributes
+        """
+        count = 0
+        last_hash = ""
+        while True:
+            attrs = yield (cls.objects.filter(environment=environment, hash__gt=last_hash).order_by("hash")
+                           .only("hash").limit(batch_size).find_all())
+            if len(attrs) == 0:
+                return count
+
+            hashes = [attr.hash for attr in attrs]
+            last_hash = hashes[-1]
+            used = yield ResourceVersion.objects.coll().aggregate([
+                {"$match": {"environment": environment._id, "attribute_hash": {"$in": hashes}}},
+                {"$group": {"_id": "$attribute_hash"}}])
+            unused = set(hashes) - set([x["_id"] for x in used["result"]])
+            if len(unused) > 0:
+                spec = query_spec(cls.objects.filter(environment=environment))
+                spec["hash"] = {"$in": list(unused)}
+                result = yield cls.objects.coll().remove(spec)
+                count += result["n"]
+
 
 class ResourceVersion(Document):
     """
@@ -520,12 +855,17 @@ class ResourceVersion(Document):
         :param rid The id of the resource and its version
         :param resource The resource for which this defines the state
         :param model The configuration model (versioned) this resource state is associated with
-        :param attributes The state of this version of the resource
+        :param agent The agent that manages this resource (derived from the rid, stored to query on it)
+        :param attribute_hash The hash of the ResourceAttributes that contain the state of this version of the resource
+        :param attributes The state of this version of the resource. Only stored for resource versions that were created
+                          before attributes were deduplicated, for all others it is set by load_attributes.
     """
     environment = ReferenceField(reference_document_type=Environment, required=True, sparse=True)
     rid = StringField(required=True, sparse=True)
     resource = ReferenceField(reference_document_type=Resource, required=True, sparse=True)
     model = ReferenceField(reference_document_type="inmanta.data.ConfigurationModel", required=True)
+    agent = StringField(sparse=True)
+    attribute_hash = StringField(sparse=True)
     attributes = JsonField()
     status = StringField(default="")
     # internal field to handle cross agent dependencies
@@ -536,6 +876,7 @@ class ResourceVersion(Document):
     def to_dict(self):
         data = {}
         data["fields"] = self.attributes
+        data["attribute_hash"] = self.attribute_hash
         data["id"] = self.rid
         data["id_fields"] = Id.parse_id(self.rid).to_dict()
         data["status"] = self.status
@@ -544,11 +885,85 @@ class ResourceVersion(Document):
 
     @gen.coroutine
     def delete_cascade(self):
-        resource_actions = yield ResourceAction.objects.filter(resource_version=self).find_all()
-        for r in resource_actions:
-            yield r.delete()
+        yield ResourceAction.objects.filter(resource_version=self).delete()
         yield self.delete()
 
+    @classmethod
+    @gen.coroutine
+    def load_attributes(cls, environment, resource_versions):
+        """
+            Set the attributes of the given resource versions from the deduplicated attributes they reference
+        """
+        hashes = set([rv.attribute_hash for rv in resource_versions if rv.attribute_hash is not None])
+        if len(hashes) == 0:
+            return
+
+        attrs = yield (ResourceAttributes.objects.filter(environment=environment, hash__in=list(hashes))
+                       .limit(len(hashes) * 2).find_all())
+        attr_dict = {attr.hash: attr.attributes for attr in attrs}
+        for rv in resource_versions:
+            if rv.attribute_hash in attr_dict:
+                rv.attributes = ResourceAttributes.denormalize(attr_dict[rv.attribute_hash],
+                                                               Id.parse_id(rv.rid).get_version())
+
+    @classmethod
+    @gen.coroutine
+    def delete_for_model(cls, model, batch_size=1000):
+        """
+            Delete all resource versions of a configuration model and their actions. Each batch of batch_size resource
+            versions is removed with one delete of the actions and one delete of the resource versions. Returns the number
+            of deleted resource versions.
+        """
+        count = 0
+        while True:
+            rvs = yield cls.objects.filter(model=model).only("rid").limit(batch_size).find_all()
+            if len(rvs) == 0:
+                return count
+
+            ids = [rv._id for rv in rvs]
+            # remove the actions first, so an interrupted delete does not leave orphaned actions
+            yield ResourceAction.objects.coll().remove({"resource_version": {"$in": ids}})
+            yield cls.objects.coll().remove({"_id": {"$in": ids}})
+            count += len(ids)
+
+    @classmethod
+    @gen.coroutine
+    def set_missing_agents(cls, batch_size=10000):
+        """
+            Set the agent field on resource versions stored before this field was introduced, batch_size resource versions
+            at a time. Returns the number of updated resource versions.
+        """
+        coll = cls.objects.coll()
+        missing = {"agent": {"$exists": False}}
+        count = 0
+        while True:
+            result = yield coll.aggregate([{"$match": missing}, {"$limit": batch_size},
+                                           {"$project": {"rid": True, "environment": True}}])
+            if len(result["result"]) == 0:
+                return count
+
+            per_agent = defaultdict(list)
+            for rv in result["result"]:
+                per_agent[(rv.get("environment"), Id.parse_id(rv["rid"]).get_agent_name())].append(rv["rid"])
+
+            for (environment, agent), rids in per_agent.items():
+                spec = dict(missing, environment=environment, rid={"$in": rids})
+                updated = yield coll.update(spec, {"$set": {"agent": agent}}, multi=True)
+                count += updated["n"]
+
+    @gen.coroutine
+    def set_status(self, status):
+        """
+            Atomically set the status of this resource version and return the status it had before the update.
+        """
+        old = yield ResourceVersion.objects.coll().find_and_modify({"_id": self._id}, {"$set": {"status": status}},
+                                                                   fields={"status": True})
+        self.status = status
+        if old is None:
+            return ""
+
+        return old.get("status", "")
+
 
 class ConfigurationModel(Document):
     """
@@ -560,6 +975,8 @@ class ConfigurationModel(Document):
         :param released Is this model released and available for deployment?
         :param deployed Is this model deployed?
         :param result The result of the deployment. Success or error.
+        :param resources_done The number of resources that reported a deploy result
+        :param resources_failed The number of resources that reported a result other than deployed
     """
     version = IntField(required=True)
     environment = ReferenceField(reference_document_type=Environment, required=True)
@@ -573,6 +990,7 @@ class ConfigurationModel(Document):
 
     resources_total = IntField(default=0)
     resources_done = IntField(default=0)
+    resources_failed = IntField(default=0)
 
     @classmethod
     @gen.coroutine
@@ -583,16 +1001,63 @@ class ConfigurationModel(Document):
 
         return versions[0]
 
+    @classmethod
     @gen.coroutine
-    def to_dict(self):
-        yield self.load_references()
+    def update_progress(cls, environment, version, old_status, new_status):
+        """
+            Account for a resource in the given version that changed its status from old_status to new_status. The counters
+            are updated with atomic increments, so concurrent reports do not need a lock. When all resources have reported,
+            the model is marked as deployed and its result is set.
+
+            :return True when this report marked the model as deployed
+        """
+        inc = {}
+        if old_status == "":
+            inc["resources_done"] = 1
+
+        failed = int(new_status != "deployed") - int(old_status not in ("", "deployed"))
+        if failed != 0:
+            inc["resources_failed"] = failed
+
+        coll = cls.objects.coll()
+        spec = query_spec(cls.objects.filter(environment=environment, version=version))
+        if len(inc) > 0:
+            model = yield coll.find_and_modify(spec, {"$inc": inc}, new=True)
+        else:
+            model = yield coll.find_one(spec)
+
+        if model is None:
+            return False
+
+        done = model.get("resources_done", 0)
+        failed = model.get("resources_failed", 0)
+        if done < model.get("resources_total", 0):
+            return False
+
+        # only set the result when no other report changed the counters in the mean time. That report sets the result
+        # based on its own view of the counters.
+        spec = {"_id": model["_id"], "resources_done": done, "deployed": False}
+        if "resources_failed" in model:
+            spec["resources_failed"] = failed
+        result = yield coll.update(spec, {"$set": {"deployed": True, "result": "success" if failed == 0 else "failed"}})
+        return result["n"] > 0
+
+    @gen.coroutine
+    def to_dict(self, environment=None):
+        """
+            :param environment The environment of this model. When it is given, it is not loaded from the database again.
+        """
+        if environment is None:
+            yield self.load_references()
+            environment = self.environment
+
         return {"version": self.version,
-                "environment": str(self.environment.uuid),
+                "environment": str(environment.uuid),
                 "date": self.date,
                 "released": self.released,
                 "deployed": self.deployed,
                 "result": self.result,
-                "status": self.status,
+                "status": self.status if self.status is not None else {},
                 "total": self.resources_total,
                 "done": self.resources_done,
                 "version_info": self.version_info,
@@ -601,25 +1066,19 @@ class ConfigurationModel(Document):
     @gen.coroutine
     def delete_cascade(self):
         yield self.load_references()
-        res_versions = yield ResourceVersion.objects.filter(model=self).find_all()
-        for resv in res_versions:
-            yield resv.delete_cascade()
+        yield ResourceVersion.delete_for_model(self)
 
         snapshots = yield Snapshot.objects.filter(model=self).find_all()
         for snapshot in snapshots:
             yield snapshot.delete_cascade()
 
-        unknowns = yield UnknownParameter.objects.filter(environment=self.environment, version=self.version).find_all()
-        for u in unknowns:
-            yield u.delete()
-
-        code = yield Code.objects.filter(environment=self.environment, version=self.version).find_all()
-        for c in code:
-            yield c.delete()
+        dryruns = yield DryRun.objects.filter(model=self).find_all()  # @UndefinedVariable
+        if len(dryruns) > 0:
+            yield DryRunResource.objects.filter(dryrun__in=dryruns).delete()  # @UndefinedVariable
 
-        drs = yield DryRun.objects.filter(model=self).find_all()
-        for d in drs:
-            yield d.delete()
+        yield [UnknownParameter.objects.filter(environment=self.environment, version=self.version).delete(),
+               Code.objects.filter(environment=self.environment, version=self.version).delete(),
+               DryRun.objects.filter(model=self).delete()]
 
         yield self.delete()
 
@@ -658,7 +1117,8 @@ class DryRun(IdDocument):
         :param date The date the run was requested
         :param resource_total The number of resources that do a dryrun for
         :param resource_todo The number of resources left to do
-        :param resources Changes for each of the resources in the version
+        :param resources Changes for each of the resources in the version. Only used by dryruns of older versions of the
+                         server, the results are now stored as DryRunResource documents.
     """
     environment = ReferenceField(reference_document_type=Environment)
     model = ReferenceField(reference_document_type=ConfigurationModel)
@@ -668,17 +1128,93 @@ class DryRun(IdDocument):
     resources = JsonField()
 
     @gen.coroutine
-    def to_dict(self):
+    def to_dict(self, resource_start=0, resource_limit=None):
+        """
+            :param resource_start The index of the first result to include, sorted on resource id
+            :param resource_limit The maximal number of results to include. All results are included when None.
+        """
         yield self.load_references()
+        resources = dict(self.resources) if self.resources is not None else {}
+        if resource_limit is None:
+            resource_limit = self.resource_total
+
+        if resource_limit > 0:
+            results = yield (DryRunResource.objects.filter(dryrun=self).order_by("resource_id")  # @UndefinedVariable
+                             .skip(resource_start).limit(resource_limit).find_all())
+            for result in results:
+                resources[result.resource_id] = result.to_dict()
+
         return {"id": self.uuid,
                 "environment": str(self.environment.uuid),
                 "model": str(self.model.version),
                 "date": self.date.isoformat(),
                 "total": self.resource_total,
                 "todo": self.resource_todo,
-                "resources": self.resources,
+                "resources": resources,
+                }
+
+    @gen.coroutine
+    def add_result(self, resource_id, changes, log_msg=None):
+        """
+            Store the result of a resource and decrement the number of resources to do. Both updates are atomic, so results
+            of concurrent agents do not need to be serialized.
+
+            :return False when a result was already stored for the resource
+        """
+        stored = yield DryRunResource.store(self, resource_id, changes, log_msg)
+        if stored:
+            yield DryRun.objects.coll().update({"_id": self._id}, {"$inc": {"resource_todo": -1}})  # @UndefinedVariable
+
+        return stored
+
+
+class DryRunResource(Document):
+    """
+        The result of a dryrun for a single resource
+
+        :param environment The environment of the dryrun
+        :param dryrun The dryrun this result belongs to
+        :param resource_id The id of the resource
+        :param changes The changes the resource requires
+        :param log An optional log message, for example to report an error
+    """
+    environment = ReferenceField(reference_document_type=Environment)
+    dryrun = ReferenceField(reference_document_type=DryRun)
+    resource_id = StringField(required=True)
+    changes = JsonField()
+    log = StringField()
+
+    def to_dict(self):
+        return {"changes": self.changes,
+                "log": self.log,
+                "id_fields": Id.parse_id(self.resource_id).to_dict()
                 }
 
+    @classmethod
+    @gen.coroutine
+    def create_indexes(cls):
+        """
+            Create the unique index on the results of a dryrun
+        """
+        yield cls.objects.coll().create_index([("dryrun", ASCENDING), ("resource_id", ASCENDING)], unique=True)
+
+    @classmethod
+    @gen.coroutine
+    def store(cls, dryrun, resource_id, changes, log_msg=None):
+        """
+            Insert the result for a resource of the given dryrun unless it already exists
+
+            :return True when the result was inserted
+        """
+        environment = dryrun.get_field_value("environment")
+        if isinstance(environment, Document):
+            environment = environment._id
+
+        key = {"dryrun": dryrun._id, "resource_id": resource_id}
+        values = {"environment": environment, "changes": json.dumps(changes), "log": log_msg}
+        result = yield cls.objects.coll().update(key, {"$setOnInsert": values}, upsert=True)  # @UndefinedVariable
+        return result.get("upserted") is not None
+
 
 class ResourceSnapshot(Document):
     """
@@ -763,10 +1299,7 @@ class SnapshotRestore(IdDocument):
 
     @gen.coroutine
     def delete_cascade(self):
-        restores = yield ResourceRestore.objects.filter(restore=self).find_all()
-        for restore in restores:
-            yield restore.delete()
-
+        yield ResourceRestore.objects.filter(restore=self).delete()
         yield self.delete()
 
 
@@ -802,9 +1335,7 @@ class Snapshot(IdDocument):
 
     @gen.coroutine
     def delete_cascade(self):
-        snapshots = yield ResourceSnapshot.objects.filter(snapshot=self).find_all()
-        for snap in snapshots:
-            yield snap.delete()
+        yield ResourceSnapshot.objects.filter(snapshot=self).delete()
 
         restores = yield SnapshotRestore.objects.filter(snapshot=self).find_all()
         for restore in restores:
@@ -212,7 +212,8 @@ class Deploy(object):
         yield self._wait(lambda: self._environment_id is not None, "environment setup")
 
         # start the agent
-        self._agent = agent.Agent(self._io_loop, env_id=self._environment_id, code_loader=True, poolsize=5)
+        self._agent = agent.Agent(self._io_loop, env_id=self._environment_id, code_loader=True, poolsize=5,
+                                  instance_poolsize=5)
         self._agent.start()
 
         self._agent_ready = True
@@ -23,7 +23,7 @@ import logging
 import os
 import time
 import glob
-import base64
+import io
 
 from inmanta import protocol
 from inmanta.agent.handler import Commander
@@ -428,7 +428,7 @@ class Exporter(object):
             content = self._file_store[hash_id]
 
             def call():
-                return conn.upload_file(id=hash_id, content=base64.b64encode(content).decode("ascii"))
+                return conn.upload_file_stream(id=hash_id, stream=io.BytesIO(content))
 
             res = self.run_sync(call)
 
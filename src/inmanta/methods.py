@@ -23,9 +23,16 @@ import datetime
 from inmanta.data import ACTIONS, LOGLEVEL
 from tornado import gen
 
+PRIORITY_LOW = 0
+PRIORITY_NORMAL = 1
+PRIORITY_HIGH = 2
+
+PRIORITY_NAMES = {PRIORITY_LOW: "low", PRIORITY_NORMAL: "normal", PRIORITY_HIGH: "high"}
+
 
 def protocol(index=False, id=False, broadcast=False, operation="POST", data_type="message", reply=True, destination="",
-             mt=False, timeout=None, api=None, server_agent=False, agent_server=False, validate_sid=None):
+             mt=False, timeout=None, api=None, server_agent=False, agent_server=False, validate_sid=None,
+             priority=PRIORITY_NORMAL):
     """
         Decorator to identify a method as a RPC call. The arguments of the decorator are used by each transport to build
         and model the protocol.
@@ -34,7 +41,9 @@ def protocol(index=False, id=False, broadcast=False, operation="POST", data_type
         :param id This method requires an id of a resource. The python function should have an id parameter.
         :param reply This method returns data
         :param operation The type of HTTP operation (verb)
-        :param data_type The type of data (message or blob) (not used at the moment)
+        :param data_type The type of data: message, blob (not used at the moment) or stream. The body of a stream method is
+                         not json encoded but transferred as raw binary data. The method should have a stream
+                         argument: a binary file object on the client side, a reader or a writer on the server side.
         :param destination If destination is empty only the server should get the message. When destination is *, the server
                            will forward it to all other clients as well.
         :param mt Is this a multi-tenant call? If it is multi-tenant a tenant id is required. This id is transported as an
@@ -44,6 +53,8 @@ def protocol(index=False, id=False, broadcast=False, operation="POST", data_type
         :param server_agent This is a call from the Server to the Agent
         :param agent_server This is a call from the Agent to the Server
         :param validate_sid This call requires a valid session, true by default if agent_server and not api
+        :param priority The priority of a server to agent call in the queue of the session: PRIORITY_HIGH, PRIORITY_NORMAL
+                        or PRIORITY_LOW. Queued calls are delivered to the agent in order of priority.
     """
     if api is None:
         api = not server_agent and not agent_server
@@ -63,7 +74,8 @@ def protocol(index=False, id=False, broadcast=False, operation="POST", data_type
         "api": api,
         "server_agent": server_agent,
         "agent_server": agent_server,
-        "validate_sid": validate_sid
+        "validate_sid": validate_sid,
+        "priority": priority,
     }
 
     def wrapper(func):
@@ -235,6 +247,24 @@ class HeartBeatMethod(Method):
         """
 
 
+class BatchMethod(Method):
+    """
+        Execute several agent to server calls in one request
+    """
+    __method_name__ = "batch"
+
+    @protocol(operation="POST", mt=True, agent_server=True)
+    def batch(self, tid: uuid.UUID, calls: list):
+        """
+            Execute a list of agent to server calls, in the order of the list
+
+            :param tid The environment of the calls
+            :param calls The calls. Each call is a dict with the url, method, headers and body of the call, as the transport
+                         of the agent builds them.
+            :return A list with a dict with the code and the result of each call
+        """
+
+
 class FileMethod(Method):
     """
         Upload, retrieve and check for file. A file is identified by a hash of its content.
@@ -276,6 +306,31 @@ class FileMethod(Method):
         """
 
 
+class FileStreamMethod(Method):
+    """
+        Upload and retrieve files as raw binary streams. A file is identified by the sha1 hash of its content.
+    """
+    __method_name__ = "filestream"
+
+    @protocol(operation="PUT", id=True, data_type="stream", api=True, agent_server=True, timeout=3600)
+    def upload_file_stream(self, id: str, stream):
+        """
+            Upload a new file. The upload is rejected when the hash of the content does not match the id.
+
+            :param id The id of the file
+            :param stream A binary file object to read the content from
+        """
+
+    @protocol(operation="GET", id=True, data_type="stream", api=True, agent_server=True, timeout=3600)
+    def get_file_stream(self, id: str, stream):
+        """
+            Retrieve a file
+
+            :param id The id of the file to retrieve
+            :param stream A binary file object to write the content to
+        """
+
+
 class ResourceMethod(Method):
     """
         Manage resources on the server
@@ -294,7 +349,7 @@ class ResourceMethod(Method):
         """
 
     @protocol(operation="GET", mt=True, index=True, agent_server=True)
-    def get_resources_for_agent(self, tid: uuid.UUID, agent: str, version: int=None):
+    def get_resources_for_agent(self, tid: uuid.UUID, agent: str, version: int=None, known_version: int=None):
         """
             Return the most recent state for the resources associated with agent, or the version requested
 
@@ -302,6 +357,8 @@ class ResourceMethod(Method):
             :param agent The agent
             :param version The version to retrieve. If none, the latest available version is returned. With a specific version
                            that version is returned, even if it has not been released yet.
+            :param known_version The version the agent already has. If the latest available version is the same, the server
+                                 returns 304 (not modified) without the resources.
         """
 
     @protocol(operation="POST", mt=True, id=True, agent_server=True)
@@ -341,7 +398,8 @@ class CMVersionMethod(Method):
         """
 
     @protocol(operation="GET", id=True, mt=True)
-    def get_version(self, tid: uuid.UUID, id: int, include_logs: bool=None, log_filter: str=None, limit: int=None):
+    def get_version(self, tid: uuid.UUID, id: int, include_logs: bool=None, log_filter: str=None, limit: int=None,
+                    resource_start: int=None, resource_limit: int=None):
         """
             Get a particular version and a list of all resources in this version
 
@@ -350,6 +408,8 @@ class CMVersionMethod(Method):
             :param include_logs If true, a log of all operations on all resources is included
             :param log_filter Filter log to only include actions of the specified type
             :param limit The maximal number of actions to return per resource (starting from the latest)
+            :param resource_start Optional, the index of the first resource to return, sorted on resource id
+            :param resource_limit Optional, the maximal number of resources to return. Should be set with resource_start.
         """
 
     @protocol(operation="DELETE", id=True, mt=True)
@@ -409,12 +469,14 @@ class DryRunMethod(Method):
         """
 
     @protocol(operation="GET", mt=True, id=True)
-    def dryrun_report(self, tid: uuid.UUID, id: uuid.UUID):
+    def dryrun_report(self, tid: uuid.UUID, id: uuid.UUID, resource_start: int=None, resource_limit: int=None):
         """
             Create a dryrun report
 
             :param tid The id of the environment
             :param id The version dryrun to report
+            :param resource_start Optional, the index of the first resource to return, sorted on resource id
+            :param resource_limit Optional, the maximal number of resources to return
         """
 
     @protocol(operation="PUT", mt=True, id=True, agent_server=True)
@@ -543,7 +605,7 @@ class AgentParameterMethod(Method):
     """
     __method_name__ = "agent_parameter"
 
-    @protocol(operation="POST", mt=True, server_agent=True, timeout=5)
+    @protocol(operation="POST", mt=True, server_agent=True, timeout=5, priority=PRIORITY_LOW)
     def get_parameter(self, tid: uuid.UUID, agent: str, resource: dict):
         """
             Get all parameters/facts known by the agents for the given resource
@@ -554,6 +616,24 @@ class AgentParameterMethod(Method):
         """
 
 
+class AgentParametersMethod(Method):
+    """
+        Get parameters of multiple resources from the agent
+    """
+    __method_name__ = "agent_parameters"
+
+    @protocol(operation="POST", mt=True, server_agent=True, timeout=5, priority=PRIORITY_LOW)
+    def get_parameters(self, tid: uuid.UUID, agent: str, resources: list):
+        """
+            Get all parameters/facts known by the agents for the given resources. The agent reports the facts of all
+            resources with one call to the server.
+
+            :param tid The environment
+            :param agent The agent get the parameters from
+            :param resources The resources to query the parameters from
+        """
+
+
 class FormMethod(Method):
     """
         Methods for creating and manipulating forms
@@ -682,7 +762,8 @@ class CompileReport(Method):
     @protocol(operation="GET", index=True)
     def get_reports(self, environment: uuid.UUID=None, start: str=None, end: str=None, limit: int=None):
         """
-            Return compile reports newer then start
+            Return compile reports newer then start. The reports of the stages are summaries, get_report_output returns
+            their output. When an environment is given, the stage it is compiling is returned as running.
 
             :param environment The id of the environment to get a report from
             :param start Reports after start
@@ -690,6 +771,18 @@ class CompileReport(Method):
             :param limit Maximum number of results
         """
 
+    @protocol(operation="GET", id=True)
+    def get_report_output(self, id: uuid.UUID, stream: str="out", start: int=None, limit: int=None):
+        """
+            Return a page of the output of a compile stage. The output is available while the stage runs.
+
+            :param id The id of the report of the stage
+            :param stream out or err
+            :param start The offset of the first character to return. When it is not set, the tail of the output is
+                         returned.
+            :param limit The maximal number of characters to return
+        """
+
 
 class Snapshot(Method):
     """
@@ -877,26 +970,39 @@ class AgentReporting(Method):
     """
     __method_name__ = "status"
 
-    @protocol(operation="GET", server_agent=True, timeout=5)
+    @protocol(operation="GET", server_agent=True, timeout=5, priority=PRIORITY_LOW)
     def get_status(self):
         """
             Report status to the server
         """
 
 
+class ServerStatus(Method):
+    """
+        Reporting of the server
+    """
+    __method_name__ = "serverstatus"
+
+    @protocol(operation="GET", index=True)
+    def get_server_status(self):
+        """
+            Get the status of the server, such as the hit and miss counters of its caches
+        """
+
+
 class AgentState(Method):
     """
         Methods to allow the server to set the agents state
     """
     __method_name__ = "agentstate"
 
-    @protocol(operation="POST", server_agent=True, timeout=5)
+    @protocol(operation="POST", server_agent=True, timeout=5, priority=PRIORITY_HIGH)
     def set_state(self, agent: str, enabled: bool):
         """
             Set the state of the agent.
         """
 
-    @protocol(operation="POST", id=True, mt=True, server_agent=True, timeout=5)
+    @protocol(operation="POST", id=True, mt=True, server_agent=True, timeout=5, priority=PRIORITY_HIGH)
     def trigger(self, tid: uuid.UUID, id: str):
         """
             Request an agent to reload resources
@@ -33,8 +33,11 @@ from inmanta.ast.statements.assign import CreateList, IndexLookup, StringFormat
 from inmanta.ast.variables import Reference, AttributeReference
 from inmanta.parser import plyInmantaLex, ParserException
 from inmanta.ast.blocks import BasicBlock
-import re
+import io
 import logging
+import os
+import pickle
+import re
 
 
 LOGGER = logging.getLogger()
@@ -663,8 +666,56 @@ def myparse(ns, tfile, content):
         raise e
 
 
+# Parse results of unchanged files, reused by long running compiler processes. The statements are stored pickled, with
+# the namespace of the file left out. Restoring them into a new namespace is much faster than parsing the file again.
+cache = None
+
+
+def enable_cache():
+    global cache
+    if cache is None:
+        cache = {}
+
+
+class StatementPickler(pickle.Pickler):
+
+    def __init__(self, file, namespace):
+        pickle.Pickler.__init__(self, file, pickle.HIGHEST_PROTOCOL)
+        self.namespace = namespace
+
+    def persistent_id(self, obj):
+        if obj is self.namespace:
+            return "namespace"
+        return None
+
+
+class StatementUnpickler(pickle.Unpickler):
+
+    def __init__(self, file, namespace):
+        pickle.Unpickler.__init__(self, file)
+        self.namespace = namespace
+
+    def persistent_load(self, pid):
+        return self.namespace
+
+
 def parse(namespace, filename, content=None):
+    if cache is None or content is not None:
+        return myparse(namespace, filename, content)
+
+    key = (os.path.abspath(filename), namespace.get_full_name())
+    stat = os.stat(filename)
+    if key in cache:
+        mtime, size, data = cache[key]
+        if mtime == stat.st_mtime and size == stat.st_size:
+            return StatementUnpickler(io.BytesIO(data), namespace).load()
 
     statements = myparse(namespace, filename, content)
-    # self.cache(filename, statements)
+    try:
+        data = io.BytesIO()
+        StatementPickler(data, namespace).dump(statements)
+        cache[key] = (stat.st_mtime, stat.st_size, data.getvalue())
+    except Exception:
+        LOGGER.exception("Unable to cache the statements of %s", filename)
+
     return statements
@@ -23,25 +23,31 @@ import inspect
 import urllib
 import uuid
 import json
-import re
 import base64
+import gzip
 import os
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, deque
 
 import tornado.web
+import tornado.websocket
 from tornado import gen, queues, locks
 from inmanta import methods
-from inmanta.config import Config, nodename
+from inmanta import util
+from inmanta.config import Config, nodename, json_codec, http_compression
 from tornado.httpserver import HTTPServer
-from tornado.httpclient import HTTPRequest, AsyncHTTPClient, HTTPError
+from tornado.httpclient import HTTPRequest, HTTPError
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
 from tornado.ioloop import IOLoop
-from tornado.web import decode_signed_value, create_signed_value
+from tornado.web import decode_signed_value, create_signed_value, GZipContentEncoding
 import ssl
 
 LOGGER = logging.getLogger(__name__)
 INMANTA_MT_HEADER = "X-Inmanta-tid"
 INMANTA_AUTH_HEADER = "X-Inmanta-user"
+STREAM_CHUNK_SIZE = 64 * 1024
+MAX_STREAM_SIZE = 10 * 1024 ** 3
+COMPRESS_MIN_LENGTH = GZipContentEncoding.MIN_LENGTH
 
 
 class Result(object):
@@ -191,7 +197,7 @@ class Transport(object):
             Decode a response body
         """
         if body is not None and len(body) > 0:
-            body = json.loads(tornado.escape.to_basestring(body))
+            body = get_codec().decode(body)
         else:
             body = None
 
@@ -224,9 +230,81 @@ def custom_json_encoder(o):
     raise TypeError(repr(o) + " is not JSON serializable")
 
 
+class JsonCodec(object):
+    """
+        Encodes and decodes the json bodies of the protocol with the json module of the standard library
+    """
+
+    def encode(self, value):
+        """
+            Encode a value to a utf-8 encoded json document
+        """
+        # see json_encode in tornado.escape
+        return json.dumps(value, default=custom_json_encoder).replace("</", "<\\/").encode()
+
+    def decode(self, body):
+        """
+            Decode a json document, given as bytes or str
+        """
+        return json.loads(tornado.escape.to_basestring(body))
+
+
+class OrjsonCodec(JsonCodec):
+    """
+        Encodes and decodes json with orjson, which also serializes uuids and datetimes natively. Values that orjson can
+        not encode, such as dicts with keys that are not strings, are encoded with the json module.
+    """
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def encode(self, value):
+        try:
+            return self._orjson.dumps(value, default=custom_json_encoder).replace(b"</", b"<\\/")
+        except TypeError:
+            return JsonCodec.encode(self, value)
+
+    def decode(self, body):
+        return self._orjson.loads(body)
+
+
+# The available json codecs, in order of preference
+CODECS = [("orjson", OrjsonCodec), ("json", JsonCodec)]
+_codec = None
+
+
+def create_codec(name="auto"):
+    """
+        Create the json codec with the given name. The auto codec is the first codec of which the library is installed.
+    """
+    for codec_name, codec_class in CODECS:
+        if name == codec_name:
+            return codec_class()
+
+        if name == "auto":
+            try:
+                return codec_class()
+            except ImportError:
+                continue
+
+    raise Exception("Json codec %s does not exist or is not available" % name)
+
+
+def get_codec():
+    """
+        Get the json codec that is configured with the json-codec option
+    """
+    global _codec
+    if _codec is None:
+        _codec = create_codec(json_codec.get())
+        LOGGER.debug("Using json codec %s", _codec.__class__.__name__)
+
+    return _codec
+
+
 def json_encode(value):
-    # see json_encode in tornado.escape
-    return json.dumps(value, default=custom_json_encoder).replace("</", "<\\/")
+    return get_codec().encode(value)
 
 
 class LoginHandler(tornado.web.RequestHandler):
@@ -366,8 +444,19 @@ class RESTHandler(tornado.web.RequestHandler):
         for header, value in headers.items():
             self.set_header(header, value)
 
+        if self.settings.get("compress_response", False):
+            # tell clients they can compress their request bodies (RFC 7694)
+            self.set_header("Accept-Encoding", "gzip")
+
         self.set_status(status)
 
+    def _add_query_arguments(self, message):
+        for key, value in self.request.query_arguments.items():
+            if len(value) == 1:
+                message[key] = value[0].decode("latin-1")
+            else:
+                message[key] = [v.decode("latin-1") for v in value]
+
     @gen.coroutine
     def _call(self, kwargs, http_method, config):
         """
@@ -384,12 +473,7 @@ class RESTHandler(tornado.web.RequestHandler):
             if message is None:
                 message = {}
 
-            for key, value in self.request.query_arguments.items():
-                if len(value) == 1:
-                    message[key] = value[0].decode("latin-1")
-                else:
-                    message[key] = [v.decode("latin-1") for v in value]
-
+            self._add_query_arguments(message)
             request_headers = self.request.headers
 
             if self._aa.authorization.auth(self.get_current_user(request_headers), http_method, request_headers, config):
@@ -435,18 +519,488 @@ class RESTHandler(tornado.web.RequestHandler):
         self.set_status(200)
 
 
+class StreamAborted(Exception):
+    """
+        The client closed the connection before the whole body of an upload was received
+    """
+
+
+class StreamReader(object):
+    """
+        The body of an upload to a stream method. Chunks are queued as they arrive, at most max_chunks at a time, so a slow
+        method throttles the client instead of buffering the upload in memory.
+    """
+
+    def __init__(self, max_chunks=4):
+        self._queue = queues.Queue(maxsize=max_chunks)
+        self._eof = False
+        self._complete = False
+        self._aborted = False
+        self._discard = False
+        self.size = 0
+
+    @gen.coroutine
+    def feed(self, chunk):
+        """
+            Queue a chunk of the body. None marks the end of the body.
+        """
+        if chunk is None:
+            self._complete = True
+
+        if not self._discard:
+            yield self._queue.put(chunk)
+
+    @gen.coroutine
+    def read(self):
+        """
+            Read the next chunk of the body. An empty bytes object is returned at the end of the body.
+
+            :raise StreamAborted: The connection was closed before the end of the body
+        """
+        if self._aborted:
+            raise StreamAborted("The connection was closed after %d bytes of the body" % self.size)
+
+        if self._eof:
+            return b""
+
+        chunk = yield self._queue.get()
+        if self._aborted:
+            raise StreamAborted("The connection was closed after %d bytes of the body" % self.size)
+
+        if chunk is None:
+            self._eof = True
+            return b""
+
+        self.size += len(chunk)
+        return chunk
+
+    def discard(self):
+        """
+            Drop the remainder of the body once the method no longer reads it
+        """
+        self._discard = True
+        while self._queue.qsize() > 0:
+            self._queue.get_nowait()
+
+    def abort(self):
+        """
+            The connection was closed before the whole body was received. A pending and all later reads raise StreamAborted.
+        """
+        if self._complete:
+            return
+
+        self._aborted = True
+        self.discard()
+        # wake up a pending read
+        self._queue.put_nowait(None)
+
+
+class StreamWriter(object):
+    """
+        The body of a download from a stream method. Every chunk is flushed to the client before the next one is
+        accepted. Once the first chunk is written, the status of the response is 200.
+    """
+
+    def __init__(self, handler):
+        self._handler = handler
+        self.started = False
+
+    @gen.coroutine
+    def write(self, chunk):
+        if not self.started:
+            self._handler.set_header("Content-Type", "application/octet-stream")
+            self._handler.set_status(200)
+            self.started = True
+
+        self._handler.write(chunk)
+        yield self._handler.flush()
+
+
+@tornado.web.stream_request_body
+class RESTStreamHandler(RESTHandler):
+    """
+        The handler for methods with data_type stream. The request body is handed to the method as it arrives and the
+        response body is written to the client while the method produces it.
+    """
+
+    def prepare(self):
+        self._reader = None
+        self._result = None
+
+        if self.request.method not in ("POST", "PUT"):
+            return
+
+        config = self._get_config(self.request.method)
+        if config is None:
+            return
+
+        self.request.connection.set_max_body_size(Config.get("server", "max-file-size", MAX_STREAM_SIZE))
+        self._reader = StreamReader()
+        self._result = self._call_stream(self.path_kwargs, self.request.method, config, self._reader)
+
+    def data_received(self, chunk):
+        if self._reader is not None:
+            return self._reader.feed(chunk)
+
+    def on_connection_close(self):
+        # the client disconnected or the body exceeded the maximal size before the upload was complete
+        reader = getattr(self, "_reader", None)
+        if reader is not None:
+            reader.abort()
+        super().on_connection_close()
+
+    @gen.coroutine
+    def _call_stream(self, kwargs, http_method, config, stream):
+        self.set_header("Access-Control-Allow-Origin", "*")
+        try:
+            message = {"stream": stream}
+            self._add_query_arguments(message)
+
+            request_headers = self.request.headers
+            if not self._aa.authorization.auth(self.get_current_user(request_headers), http_method, request_headers, config):
+                return self._transport.return_error_msg(403, "Access denied.")
+
+            result = yield self._transport._execute_call(kwargs, http_method, config, message, request_headers)
+            return result
+        finally:
+            if isinstance(stream, StreamReader):
+                stream.discard()
+
+    @gen.coroutine
+    def _upload(self):
+        if self._result is None:
+            self.respond(*self._transport.return_error_msg(404, "This method does not exist."))
+            return
+
+        yield self._reader.feed(None)
+        result = yield self._result
+        self.respond(*result)
+
+    @gen.coroutine
+    def get(self, *args, **kwargs):
+        config = self._get_config("GET")
+        if config is None:
+            self.respond(*self._transport.return_error_msg(404, "This method does not exist."))
+            return
+
+        writer = StreamWriter(self)
+        result = yield self._call_stream(kwargs, "GET", config, writer)
+        if not writer.started:
+            self.respond(*result)
+        elif result[2] != 200:
+            LOGGER.error("Stream method %s failed after sending data: %s", config[1][1], result[0])
+
+    @gen.coroutine
+    def post(self, *args, **kwargs):
+        yield self._upload()
+
+    @gen.coroutine
+    def put(self, *args, **kwargs):
+        yield self._upload()
+
+
 def sh(msg, max_len=10):
     if len(msg) < max_len:
         return msg
     return msg[0:max_len - 3] + "..."
 
 
+ID_PATTERN = "(?P<id>[^/]+)"
+
+
+class SessionChannelHandler(tornado.websocket.WebSocketHandler):
+    """
+        A websocket between the server and an agent. The server sends the calls for the session of the agent over the
+        websocket as soon as they are made and the agent sends back the replies, instead of polling for calls with heartbeat
+        calls. The agent sends a heartbeat message to open the session and keeps sending one every interval seconds to
+        keep it alive.
+    """
+
+    def initialize(self, transport, aa):
+        self._transport = transport
+        self._aa = aa
+        self._session = None
+
+    def get(self, *args, **kwargs):
+        _, config = self._transport.match_call("/%s" % methods.HeartBeatMethod.__method_name__, "POST")
+        user = None
+        if INMANTA_AUTH_HEADER in self.request.headers:
+            user = decode_signed_value(self._aa.secret, "user", self.request.headers[INMANTA_AUTH_HEADER])
+
+        if not self._aa.authorization.auth(user, "POST", self.request.headers, config):
+            self.set_status(403)
+            self.finish()
+            return
+
+        return super().get(*args, **kwargs)
+
+    def send(self, message):
+        """
+            Send a message to the agent
+        """
+        self.write_message(json_encode(message).decode())
+
+    def on_message(self, message):
+        try:
+            message = self._transport._decode(message)
+            if message["type"] == "heartbeat":
+                endpoint = self._transport.endpoint
+                session = endpoint.get_or_create_session(uuid.UUID(message["sid"]), uuid.UUID(message["tid"]),
+                                                         message["endpoint_names"], message["nodename"])
+                if session is not self._session:
+                    self._session = session
+                    session.set_channel(self)
+
+                self.send({"type": "session", "interval": endpoint.hangtime})
+
+            elif message["type"] == "reply" and self._session is not None:
+                self._session.set_reply(uuid.UUID(message["reply_id"]), message["data"])
+
+            else:
+                LOGGER.warning("Received an invalid message of type %s on the channel of session %s", message["type"],
+                               self._session.id if self._session is not None else None)
+        except Exception:
+            LOGGER.exception("Unable to handle a message on the channel of session %s",
+                             self._session.id if self._session is not None else None)
+
+    def on_close(self):
+        if self._session is not None:
+            self._session.remove_channel(self)
+
+
+class MethodSignature(object):
+    """
+        The arguments of a protocol method, their defaults and the types they are converted to. The signature is read once
+        from the definition of the method, so validating a call does not have to inspect the method again.
+    """
+
+    def __init__(self, function):
+        argspec = inspect.getfullargspec(function)
+        self.args = [arg for arg in argspec.args if arg != "self"]
+        self.varkw = argspec.varkw is not None
+
+        self.defaults = {}
+        if argspec.defaults is not None:
+            self.defaults = dict(zip(self.args[len(self.args) - len(argspec.defaults):], argspec.defaults))
+
+        self.types = [(arg, argspec.annotations[arg]) for arg in self.args if arg in argspec.annotations]
+
+    def validate(self, message):
+        """
+            Add the defaults of missing arguments to the message and convert the arguments to their type.
+
+            :return An error message when the message does not match the signature, None otherwise
+        """
+        for arg in self.args:
+            if arg not in message:
+                if arg not in self.defaults:
+                    return "Invalid request. Field '%s' is required." % arg
+
+                message[arg] = self.defaults[arg]
+
+        for arg, arg_type in self.types:
+            value = message[arg]
+            if value is not None and not isinstance(value, arg_type):
+                try:
+                    if arg_type == datetime:
+                        message[arg] = datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%f")
+                    else:
+                        message[arg] = arg_type(value)
+                except (ValueError, TypeError):
+                    return "Invalid type for argument %s. Expected %s but received %s" % (arg, arg_type, value.__class__)
+
+        if not self.varkw and len(message) > len(self.args):
+            extra = set(message.keys()) - set(self.args)
+            return ("Request contains fields %s " % extra) + \
+                "that are not declared in method and no kwargs argument is provided."
+
+        return None
+
+
+@util.memoize
+def get_signature(function):
+    """
+        Get the signature of a protocol method
+    """
+    return MethodSignature(function)
+
+
+class Router(object):
+    """
+        Maps the url and http method of a call to the configuration of the method that handles it. The urls of all
+        methods are either the name of the method or the name followed by an id, so a call is matched with a lookup
+        instead of trying the url pattern of every method.
+
+        :param url_map The mapping of url patterns to methods, as created by RESTTransport.create_op_mapping
+    """
+
+    def __init__(self, url_map):
+        self._names = {}
+        self._ids = {}
+
+        id_suffix = "/" + ID_PATTERN
+        for url, handlers in url_map.items():
+            if url.endswith(id_suffix):
+                self._ids[url[1:-len(id_suffix)]] = handlers
+            else:
+                self._names[url[1:]] = handlers
+
+    def match(self, url, method):
+        """
+            Get the arguments in the url and the configuration of the method that handles a call
+
+            :return A tuple with the arguments and the configuration, or None, None when no method matches
+        """
+        path = url.split("?", 1)[0]
+        parts = path[1:].split("/")
+        if len(parts) == 1:
+            handlers = self._names.get(parts[0])
+            kwargs = {}
+        elif len(parts) == 2 and parts[1] != "":
+            handlers = self._ids.get(parts[0])
+            kwargs = {"id": urllib.parse.unquote(parts[1])}
+        else:
+            return None, None
+
+        if handlers is None or method not in handlers:
+            return None, None
+
+        return kwargs, handlers[method]
+
+
+def can_batch(properties):
+    """
+        Can calls of the method with the given protocol properties be sent in a batch call. These are the agent to server
+        calls of an agent session that send and receive json messages.
+    """
+    return (properties["agent_server"] and properties["mt"] and properties["validate_sid"] and
+            properties["data_type"] == "message" and properties["method_name"] != methods.BatchMethod.__method_name__)
+
+
+class ClientPool(object):
+    """
+        The http client that all transports on an io loop use to call one server. The number of concurrent requests is
+        limited by max_clients. Requests that arrive when all clients are busy wait in the pool, where the time they wait
+        is measured, instead of in the queue of the tornado http client.
+
+        :param max_clients The maximal number of concurrent requests
+        :param keep_alive Reuse connections for later requests. Only the curl backend keeps connections open.
+        :param backend simple for the tornado http client or curl for the curl based client
+    """
+
+    def __init__(self, max_clients=10, keep_alive=True, backend="simple"):
+        self.io_loop = IOLoop.current()
+        self.max_clients = max_clients
+        self.keep_alive = keep_alive
+        self.backend = backend
+        self._client = self._create_client()
+        self._semaphore = locks.Semaphore(max_clients)
+
+        self.requests = 0
+        self.active = 0
+        self.waiting = 0
+        self.queued = 0
+        self.wait_time = 0
+        self.max_wait_time = 0
+
+    def _create_client(self):
+        if self.backend == "curl":
+            try:
+                from tornado.curl_httpclient import CurlAsyncHTTPClient
+                return CurlAsyncHTTPClient(force_instance=True, max_clients=self.max_clients)
+            except ImportError:
+                LOGGER.warning("The curl http client requires pycurl, falling back to the simple http client")
+                self.backend = "simple"
+        elif self.backend != "simple":
+            LOGGER.warning("Unknown http client %s, using the simple http client", self.backend)
+            self.backend = "simple"
+
+        return SimpleAsyncHTTPClient(force_instance=True, max_clients=self.max_clients)
+
+    def close(self):
+        self._client.close()
+
+    @gen.coroutine
+    def fetch(self, request):
+        """
+            Execute a request as soon as a client is available
+        """
+        if not self.keep_alive:
+            request.headers["Connection"] = "close"
+
+        if self.active >= self.max_clients:
+            self.queued += 1
+
+        start = time.time()
+        self.waiting += 1
+        try:
+            yield self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        try:
+            wait_time = time.time() - start
+            self.requests += 1
+            self.wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+            self.active += 1
+
+            response = yield self._client.fetch(request)
+            return response
+        finally:
+            self.active -= 1
+            self._semaphore.release()
+
+    def to_dict(self):
+        return {"backend": self.backend,
+                "max_clients": self.max_clients,
+                "keep_alive": self.keep_alive,
+                "requests": self.requests,
+                "active": self.active,
+                "waiting": self.waiting,
+                "queued": self.queued,
+                "wait_time": self.wait_time,
+                "max_wait_time": self.max_wait_time,
+                "avg_wait_time": self.wait_time / self.requests if self.requests > 0 else 0,
+                }
+
+
+_client_pools = {}
+
+
+def get_client_pool(section, url):
+    """
+        Get the client pool for the server at url, configured in the given transport config section. A pool is shared by
+        all transports of the section on the current io loop.
+    """
+    key = (section, url)
+    pool = _client_pools.get(key)
+    if pool is not None and pool.io_loop is IOLoop.current():
+        return pool
+
+    if pool is not None:
+        pool.close()
+
+    pool = ClientPool(max_clients=int(Config.get(section, "max-clients", 10)),
+                      keep_alive=Config.getboolean(section, "keep-alive", True),
+                      backend=Config.get(section, "http-client", "simple"))
+    _client_pools[key] = pool
+    return pool
+
+
+def get_client_pool_stats():
+    """
+        Get the metrics of all client pools, per transport config section and server
+    """
+    return {"%s %s" % key: pool.to_dict() for key, pool in _client_pools.items()}
+
+
 class RESTTransport(Transport):
     """"
         A REST (json body over http) transport. Only methods that operate on resource can use all
         HTTP verbs. For other methods the POST verb is used.
     """
-    __data__ = ("message", "blob")
+    __data__ = ("message", "blob", "stream")
     __transport_name__ = "rest"
 
     def __init__(self, endpoint, connection_timout=120):
@@ -456,6 +1010,8 @@ class RESTTransport(Transport):
         self.token = None
         self.token_lock = locks.Lock()
         self.connection_timout = connection_timout
+        self._router = None
+        self._compress_requests = False
 
     def _create_base_url(self, properties, msg=None):
         """
@@ -464,7 +1020,7 @@ class RESTTransport(Transport):
         url = ""
         if "id" in properties and properties["id"]:
             if msg is None:
-                url = "/%s/(?P<id>[^/]+)" % properties["method_name"]
+                url = "/%s/%s" % (properties["method_name"], ID_PATTERN)
             else:
                 url = "/%s/%s" % (properties["method_name"], urllib.parse.quote(str(msg["id"]), safe=""))
 
@@ -493,15 +1049,10 @@ class RESTTransport(Transport):
         """
             Get the method call for the given url and http method
         """
-        url_map = self.create_op_mapping()
-        for url_re, handlers in url_map.items():
-            if not url_re.endswith("$"):
-                url_re += "$"
-            match = re.match(url_re, url)
-            if match and method in handlers:
-                return match.groupdict(), handlers[method]
+        if self._router is None:
+            self._router = Router(self.create_op_mapping())
 
-        return None, None
+        return self._router.match(url, method)
 
     def return_error_msg(self, status=500, msg="", headers={}):
         body = {"message": msg}
@@ -544,53 +1095,17 @@ class RESTTransport(Transport):
                     return self.return_error_msg(500, "The sid %s is not valid." % message['sid'], headers)
 
             # validate message against the arguments
-            argspec = inspect.getfullargspec(config[2])
-            args = argspec.args
+            signature = get_signature(config[2])
+            if config[0]["agent_server"] and "sid" in message and "sid" not in signature.args:
+                del message["sid"]
 
-            if "self" in args:
-                args.remove("self")
+            error = signature.validate(message)
+            if error is not None:
+                return self.return_error_msg(500, error, headers)
 
-            all_fields = set(message.keys())
-            if argspec.defaults is not None:
-                defaults_start = len(args) - len(argspec.defaults)
-            else:
-                defaults_start = -1
-
-            for i in range(len(args)):
-                arg = args[i]
-                if arg not in message:
-                    if (defaults_start >= 0 and (i - defaults_start) < len(argspec.defaults)):
-                        message[arg] = argspec.defaults[i - defaults_start]
-                    else:
-                        return self.return_error_msg(500, "Invalid request. Field '%s' is required." % arg, headers)
-
-                else:
-                    all_fields.remove(arg)
-
-                # validate the type
-                if arg in argspec.annotations:
-                    arg_type = argspec.annotations[arg]
-                    if message[arg] is not None and not isinstance(message[arg], arg_type):
-                        try:
-                            if arg_type == datetime:
-                                message[arg] = datetime.strptime(message[arg], "%Y-%m-%dT%H:%M:%S.%f")
-                            else:
-                                message[arg] = arg_type(message[arg])
-                        except (ValueError, TypeError):
-                            return self.return_error_msg(500, "Invalid type for argument %s. Expected %s but received %s" %
-                                                         (arg, arg_type, message[arg].__class__), headers)
-
-            if config[0]["agent_server"]:
-                if 'sid' in all_fields:
-                    del message['sid']
-                    all_fields.remove('sid')
-
-            if len(all_fields) > 0 and argspec.varkw is None:
-                return self.return_error_msg(500, ("Request contains fields %s " % all_fields) +
-                                             "that are not declared in method and no kwargs argument is provided.", headers)
-
-            LOGGER.debug("Calling method %s(%s)", config[1][1], ", ".join(["%s='%s'" % (name, sh(str(value)))
-                                                                           for name, value in message.items()]))
+            if LOGGER.isEnabledFor(logging.DEBUG):
+                LOGGER.debug("Calling method %s(%s)", config[1][1], ", ".join(["%s='%s'" % (name, sh(str(value)))
+                                                                               for name, value in message.items()]))
             method_call = getattr(config[1][0], config[1][1])
 
             result = yield method_call(**message)
@@ -622,6 +1137,50 @@ class RESTTransport(Transport):
             LOGGER.exception("An exception occured")
             return self.return_error_msg(500, "An exception occured: " + str(e.args), headers)
 
+    def get_call_message(self, call):
+        """
+            Get the message of a call that was built with build_call: its body and the arguments in its query string
+        """
+        message = {}
+        if "body" in call and call["body"] is not None:
+            message = call["body"]
+
+        query_string = urllib.parse.urlparse(call["url"]).query
+        for key, value in urllib.parse.parse_qs(query_string, keep_blank_values=True).items():
+            if len(value) == 1:
+                message[key] = value[0]
+            else:
+                message[key] = value
+
+        return message
+
+    @gen.coroutine
+    def execute_batch(self, tid, calls):
+        """
+            Execute the calls of a batch in order. Only calls of agent to server methods of the environment tid can be
+            batched.
+
+            :return A list with the code and the result of each call
+        """
+        results = []
+        for call in calls:
+            kwargs, config = self.match_call(call["url"], call["method"])
+            if config is None:
+                results.append({"code": 404, "result": {"message": "No such method %s %s" % (call["method"], call["url"])}})
+                continue
+
+            if not can_batch(config[0]):
+                results.append({"code": 400, "result": {"message": "Method %s %s can not be batched" %
+                                                                   (call["method"], call["url"])}})
+                continue
+
+            headers = dict(call.get("headers", {}))
+            headers[INMANTA_MT_HEADER] = str(tid)
+            body, _, code = yield self._execute_call(kwargs, call["method"], config, self.get_call_message(call), headers)
+            results.append({"code": code, "result": body})
+
+        return results
+
     def add_static_handler(self, location, path, default_filename=None, start=False):
         """
             Configure a static handler to serve data from the specified path.
@@ -654,16 +1213,27 @@ class RESTTransport(Transport):
             for op, cfg in configs.items():
                 handler_config[op] = cfg
 
-            self._handlers.append((url, RESTHandler, {"transport": self, "config": handler_config, "aa": aa}))
+            streams = [cfg[0]["data_type"] == "stream" for cfg in handler_config.values()]
+            if all(streams):
+                handler = RESTStreamHandler
+            elif any(streams):
+                raise Exception("Stream methods can not share url %s with other methods" % url)
+            else:
+                handler = RESTHandler
+
+            self._handlers.append((url, handler, {"transport": self, "config": handler_config, "aa": aa}))
             LOGGER.debug("Registering handler(s) for url %s and methods %s" % (url, ", ".join(handler_config.keys())))
 
         self._handlers.append((r"/login", LoginHandler, {"aa": aa, "transport": self}))
+        if isinstance(self.endpoint, ServerEndpoint):
+            self._handlers.append((r"/channel", SessionChannelHandler, {"aa": aa, "transport": self}))
 
         port = 8888
         if self.id in Config.get() and "port" in Config.get()[self.id]:
             port = Config.get()[self.id]["port"]
 
-        application = tornado.web.Application(self._handlers)
+        compress = http_compression.get()
+        application = tornado.web.Application(self._handlers, compress_response=compress)
 
         crt = Config.get("server", "ssl_cert_file", None)
         key = Config.get("server", "ssl_key_file", None)
@@ -672,9 +1242,9 @@ class RESTTransport(Transport):
             ssl_ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
             ssl_ctx.load_cert_chain(crt, key)
 
-            self.http_server = HTTPServer(application, ssl_options=ssl_ctx)
+            self.http_server = HTTPServer(application, ssl_options=ssl_ctx, decompress_request=compress)
         else:
-            self.http_server = HTTPServer(application)
+            self.http_server = HTTPServer(application, decompress_request=compress)
 
         self.http_server.listen(port)
 
@@ -703,6 +1273,16 @@ class RESTTransport(Transport):
         LOGGER.debug("Using %s:%d", host, port)
         return "%s://%s:%d" % (protocol, host, port)
 
+    def _get_request_timeout(self, properties=None):
+        """
+            Get the request timeout of a call: the timeout of the method when it has one, otherwise the request_timeout of
+            the client configuration.
+        """
+        if properties is not None and properties["timeout"] is not None:
+            return properties["timeout"]
+
+        return int(Config.get(self.id, "request-timeout", 120))
+
     def build_call(self, properties, args, kwargs={}):
         """
             Build a call from the given arguments. This method returns the url, headers, method and body for the call.
@@ -713,9 +1293,9 @@ class RESTTransport(Transport):
         msg = kwargs
 
         # map the argument in arg to names
-        argspec = inspect.getfullargspec(properties["method"])
+        signature = get_signature(properties["method"])
         for i in range(len(args)):
-            msg[argspec.args[i + 1]] = args[i]
+            msg[signature.args[i]] = args[i]
 
         url = self._create_base_url(properties, msg)
 
@@ -727,11 +1307,14 @@ class RESTTransport(Transport):
             headers[INMANTA_MT_HEADER] = str(msg["tid"])
             del msg["tid"]
 
-        if not (method == "POST" or method == "PUT" or method == "PATCH"):
+        if properties["data_type"] == "stream" or not (method == "POST" or method == "PUT" or method == "PATCH"):
             qs_map = msg.copy()
             if "id" in qs_map:
                 del qs_map["id"]
 
+            if "stream" in qs_map:
+                del qs_map["stream"]
+
             # encode arguments in url
             if len(qs_map) > 0:
                 url += "?" + urllib.parse.urlencode(qs_map)
@@ -744,6 +1327,10 @@ class RESTTransport(Transport):
 
     @gen.coroutine
     def call(self, properties, args, kwargs={}, reauth=True):
+        if properties["data_type"] == "stream":
+            result = yield self._call_stream(properties, args, kwargs)
+            return result
+
         url, method, headers, body = self.build_call(properties, args, kwargs)
 
         url_host = self._get_client_config()
@@ -763,10 +1350,14 @@ class RESTTransport(Transport):
         try:
             if body is not None:
                 body = json_encode(body)
+                if self._compress_requests and len(body) >= COMPRESS_MIN_LENGTH:
+                    body = gzip.compress(body, GZipContentEncoding.GZIP_LEVEL)
+                    headers["Content-Encoding"] = "gzip"
+
             request = HTTPRequest(url=url, method=method, headers=headers, body=body, connect_timeout=self.connection_timout,
-                                  request_timeout=120, ca_certs=ca_certs)
-            client = AsyncHTTPClient()
-            response = yield client.fetch(request)
+                                  request_timeout=self._get_request_timeout(properties), ca_certs=ca_certs,
+                                  decompress_response=True)
+            response = yield get_client_pool(self.id, url_host).fetch(request)
         except HTTPError as e:
             if e.response is not None and len(e.response.body) > 0:
                 try:
@@ -784,8 +1375,83 @@ class RESTTransport(Transport):
         except Exception as e:
             return Result(code=500, result={"message": str(e)})
 
+        if "gzip" in response.headers.get("Accept-Encoding", "") and http_compression.get():
+            self._compress_requests = True
+
         return Result(code=response.code, result=self._decode(response.body))
 
+    @gen.coroutine
+    def _call_stream(self, properties, args, kwargs):
+        """
+            Call a method with data_type stream. The stream argument is a binary file object. An upload reads the request
+            body from it and a download writes the response body to it, one chunk at a time.
+        """
+        url, method, headers, _ = self.build_call(properties, args, kwargs)
+        stream = kwargs["stream"]
+        url_host = self._get_client_config()
+        url = url_host + url
+
+        if self.token is None:
+            yield self.get_token()
+
+        if self.token is not None:
+            headers[INMANTA_AUTH_HEADER] = self.token
+
+        upload = method in ("POST", "PUT")
+        status = {}
+        error_body = []
+
+        @gen.coroutine
+        def body_producer(write):
+            chunk = stream.read(STREAM_CHUNK_SIZE)
+            while len(chunk) > 0:
+                yield write(chunk)
+                chunk = stream.read(STREAM_CHUNK_SIZE)
+
+        def header_callback(line):
+            if line.startswith("HTTP/"):
+                status["code"] = int(line.split(" ")[1])
+
+        def streaming_callback(chunk):
+            if status.get("code") == 200:
+                stream.write(chunk)
+            else:
+                error_body.append(chunk)
+
+        if upload:
+            options = {"body_producer": body_producer}
+        else:
+            options = {"header_callback": header_callback, "streaming_callback": streaming_callback}
+
+        ca_certs = Config.get(self.id, "ssl_ca_cert_file", None)
+        LOGGER.debug("Streaming %s %s", method, url)
+
+        try:
+            request = HTTPRequest(url=url, method=method, headers=headers, connect_timeout=self.connection_timout,
+                                  request_timeout=self._get_request_timeout(properties), ca_certs=ca_certs, **options)
+            response = yield get_client_pool(self.id, url_host).fetch(request)
+        except HTTPError as e:
+            body = b"".join(error_body)
+            if e.response is not None and len(e.response.body) > 0:
+                body = e.response.body
+
+            try:
+                result = self._decode(body)
+            except ValueError:
+                result = None
+
+            if result is None:
+                result = {"message": str(e)}
+
+            return Result(code=e.code, result=result)
+        except Exception as e:
+            return Result(code=500, result={"message": str(e)})
+
+        if upload:
+            return Result(code=response.code, result=self._decode(response.body))
+
+        return Result(code=response.code, result={})
+
     @gen.coroutine
     def get_token(self):
         with (yield self.token_lock.acquire()):
@@ -806,10 +1472,9 @@ class RESTTransport(Transport):
                 url = url_host + "/login"
 
                 try:
-                    request = HTTPRequest(url=url, method="POST", body=body, connect_timeout=120, request_timeout=120,
-                                          ca_certs=ca_certs)
-                    client = AsyncHTTPClient()
-                    response = yield client.fetch(request)
+                    request = HTTPRequest(url=url, method="POST", body=body, connect_timeout=self.connection_timout,
+                                          request_timeout=self._get_request_timeout(), ca_certs=ca_certs)
+                    response = yield get_client_pool(self.id, url_host).fetch(request)
                     response = self._decode(response.body)
                     self.token = response["token"]
                 except HTTPError as e:
@@ -817,6 +1482,28 @@ class RESTTransport(Transport):
                 except Exception as e:
                     LOGGER.error("Login failed: %s", str(e))
 
+    @gen.coroutine
+    def connect_channel(self, on_message):
+        """
+            Open a websocket to the session channel of the server
+
+            :param on_message A callback that is called with each message of the server and with None when the websocket is
+                              closed
+        """
+        url = self._get_client_config().replace("http", "ws", 1) + "/channel"
+
+        if self.token is None:
+            yield self.get_token()
+
+        headers = {}
+        if self.token is not None:
+            headers[INMANTA_AUTH_HEADER] = self.token
+
+        ca_certs = Config.get(self.id, "ssl_ca_cert_file", None)
+        request = HTTPRequest(url=url, headers=headers, connect_timeout=self.connection_timout, ca_certs=ca_certs)
+        connection = yield tornado.websocket.websocket_connect(request, on_message_callback=on_message)
+        return connection
+
     def validate_sid(self, sid):
         return self.endpoint.validate_sid(sid)
 
@@ -976,12 +1663,22 @@ class Endpoint(object):
     node_name = property(get_node_name)
 
 
+CALL_PRIORITIES = [methods.PRIORITY_HIGH, methods.PRIORITY_NORMAL, methods.PRIORITY_LOW]
+
+
+class CallQueueFull(Exception):
+    """
+        A call to an agent was rejected because the call queue of its session is full
+    """
+
+
 class Session(object):
     """
         An environment that segments agents connected to the server
     """
 
-    def __init__(self, sessionstore, io_loop, sid, hang_interval, timout, tid, endpoint_names, nodename):
+    def __init__(self, sessionstore, io_loop, sid, hang_interval, timout, tid, endpoint_names, nodename, max_queue=1000,
+                 max_batch=100):
         self._sid = sid
         self._interval = hang_interval
         self._timeout = timout
@@ -998,7 +1695,17 @@ class Session(object):
 
         self._replies = {}
         self.check_expire()
-        self._queue = queues.Queue()
+        self._channel = None
+
+        # queued calls per priority, as (queued time, call spec, reply future)
+        self._queues = {priority: deque() for priority in CALL_PRIORITIES}
+        self._queued = locks.Condition()
+        self._max_queue = max_queue
+        self._max_batch = max_batch
+        self.delivered = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.max_depth = 0
 
         self.client = ReturnClient(str(sid), self)
 
@@ -1020,6 +1727,9 @@ class Session(object):
         self.expired = True
         if self._callhandle is not None:
             self._io_loop.remove_timeout(self._callhandle)
+        if self._channel is not None:
+            self._channel.close()
+            self._channel = None
         self._sessionstore.expire(self, timeout)
 
     def seen(self):
@@ -1034,41 +1744,133 @@ class Session(object):
         timeout_handle = self._io_loop.add_timeout(self._io_loop.time() + timeout, on_timeout)
         future.add_done_callback(lambda _: self._io_loop.remove_timeout(timeout_handle))
 
-    def put_call(self, call_spec, timeout=10):
+    def put_call(self, call_spec, timeout=10, priority=methods.PRIORITY_NORMAL):
+        """
+            Send a call to the agent of this session. When the session has no channel, the call is queued for the next
+            heartbeat. A call is rejected with a CallQueueFull exception when the queue of its priority is full.
+
+            :return A future with the reply of the agent
+        """
         future = tornado.concurrent.Future()
 
         id = uuid.uuid4()
+        call_spec["reply_id"] = id
 
-        LOGGER.debug("Putting call %s: %s %s for agent %s in queue", id, call_spec["method"], call_spec["url"], self._sid)
+        if not self._send_call(call_spec):
+            queue = self._queues[priority]
+            if len(queue) >= self._max_queue:
+                LOGGER.warning("Rejected call %s: %s %s for agent %s, the queue is full", id, call_spec["method"],
+                               call_spec["url"], self._sid)
+                self.rejected += 1
+                future.set_exception(CallQueueFull("The call queue of agent %s is full" % self._sid))
+                return future
+
+            LOGGER.debug("Putting call %s: %s %s for agent %s in queue", id, call_spec["method"], call_spec["url"], self._sid)
+            queue.append((time.time(), call_spec, future))
+            self.max_depth = max(self.max_depth, self.get_queue_depth())
+            self._queued.notify_all()
 
-        q = self._queue
-        call_spec["reply_id"] = id
-        q.put(call_spec)
         self._set_timeout(future, timeout,
                           "Call %s: %s %s for agent %s timed out." % (id, call_spec["method"], call_spec["url"], self._sid))
         self._replies[call_spec["reply_id"]] = future
 
         return future
 
+    def _next_call(self):
+        """
+            Remove the next call to deliver from the queues: the oldest call with the highest priority. Calls that timed out
+            while they were queued are dropped.
+        """
+        for priority in CALL_PRIORITIES:
+            queue = self._queues[priority]
+            while len(queue) > 0:
+                _, call_spec, future = queue.popleft()
+                if not future.done():
+                    return call_spec
+                self.dropped += 1
+
+        return None
+
     @gen.coroutine
     def get_calls(self):
         """
-            Get all calls queued for a node. If no work is available, wait until timeout. This method returns none if a call
-            fails.
+            Get the calls queued for a node, at most max_batch calls and highest priority first. If no work is available,
+            wait until timeout. This method returns none if no calls are available.
         """
-        try:
-            q = self._queue
-            call_list = []
-            call = yield q.get(timeout=self._io_loop.time() + self._interval)
-            call_list.append(call)
-            while q.qsize() > 0:
-                call = yield q.get()
-                call_list.append(call)
+        deadline = self._io_loop.time() + self._interval
+        call_list = []
+        while len(call_list) == 0:
+            while len(call_list) < self._max_batch:
+                call_spec = self._next_call()
+                if call_spec is None:
+                    break
+                call_list.append(call_spec)
 
-            return call_list
+            if len(call_list) == 0 and not (yield self._queued.wait(timeout=deadline)):
+                return None
 
-        except gen.TimeoutError:
-            return None
+        self.delivered += len(call_list)
+        return call_list
+
+    def get_queue_depth(self):
+        return sum([len(queue) for queue in self._queues.values()])
+
+    def get_queue_stats(self):
+        """
+            Get the depth of the call queue per priority, the age of its oldest call and the number of delivered, rejected
+            and dropped calls
+        """
+        now = time.time()
+        oldest = [queue[0][0] for queue in self._queues.values() if len(queue) > 0]
+        return {"depth": {methods.PRIORITY_NAMES[priority]: len(queue) for priority, queue in self._queues.items()},
+                "max_depth": self.max_depth,
+                "oldest_call": now - min(oldest) if len(oldest) > 0 else 0,
+                "delivered": self.delivered,
+                "rejected": self.rejected,
+                "dropped": self.dropped,
+                "channel": self._channel is not None,
+                }
+
+    def set_channel(self, channel):
+        """
+            Send the calls for this session over the given channel instead of queueing them for the next heartbeat. The
+            calls that are already queued are sent immediately.
+        """
+        if self._channel is not None and self._channel is not channel:
+            self._channel.close()
+
+        self._channel = channel
+        for priority in CALL_PRIORITIES:
+            queue = self._queues[priority]
+            while len(queue) > 0:
+                _, call_spec, future = queue[0]
+                if not future.done() and not self._send_call(call_spec):
+                    return
+                queue.popleft()
+
+    def remove_channel(self, channel):
+        """
+            Queue calls for the next heartbeat again once the channel is closed
+        """
+        if self._channel is channel:
+            self._channel = None
+
+    def _send_call(self, call_spec):
+        """
+            Send a call over the channel
+
+            :return True when the call was sent
+        """
+        if self._channel is None:
+            return False
+
+        try:
+            self._channel.send(dict(call_spec, type="call"))
+            self.delivered += 1
+            return True
+        except tornado.websocket.WebSocketClosedError:
+            self._channel = None
+            return False
 
     def set_reply(self, reply_id, data):
         LOGGER.log(3, "Received Reply: %s", reply_id)
@@ -1090,7 +1892,7 @@ class ServerEndpoint(Endpoint, metaclass=EndpointMeta):
     """
     __methods__ = {}
 
-    def __init__(self, name, io_loop, transport=RESTTransport, interval=60, hangtime=None):
+    def __init__(self, name, io_loop, transport=RESTTransport, interval=60, hangtime=None, max_queue=1000, max_batch=100):
         super().__init__(io_loop, name)
         self._transport = transport
 
@@ -1104,6 +1906,8 @@ class ServerEndpoint(Endpoint, metaclass=EndpointMeta):
         if hangtime is None:
             hangtime = interval * 3 / 4
         self.hangtime = hangtime
+        self.max_queue = max_queue
+        self.max_batch = max_batch
 
     def schedule(self, call, interval=60):
         self._sched.add_action(call, interval)
@@ -1147,7 +1951,8 @@ class ServerEndpoint(Endpoint, metaclass=EndpointMeta):
 
     def new_session(self, sid, tid, endpoint_names, nodename):
         LOGGER.debug("New session with id %s on node %s for env %s with endpoints %s" % (sid, nodename, tid, endpoint_names))
-        return Session(self, self._io_loop, sid, self.hangtime, self.interval, tid, endpoint_names, nodename)
+        return Session(self, self._io_loop, sid, self.hangtime, self.interval, tid, endpoint_names, nodename,
+                       max_queue=self.max_queue, max_batch=self.max_batch)
 
     def expire(self, session: Session, timeout):
         LOGGER.debug("Expired session with id %s, last seen %d seconds ago" % (session.get_id(), timeout))
@@ -1185,6 +1990,12 @@ class ServerEndpoint(Endpoint, metaclass=EndpointMeta):
         except Exception:
             LOGGER.warning("could not deliver agent reply with sid=%s and reply_id=%s" % (sid, reply_id), exc_info=True)
 
+    @handle(methods.BatchMethod.batch)
+    @gen.coroutine
+    def batch(self, tid, calls):
+        results = yield self._transport_instance.execute_batch(tid, calls)
+        return 200, {"results": results}
+
     def get_security_policy(self):
 
         secret = Config.get("server", "shared-secret", base64.b64encode(os.urandom(50)).decode('ascii'))
@@ -1210,10 +2021,15 @@ class AgentEndPoint(Endpoint, metaclass=EndpointMeta):
         An endpoint for clients that make calls to a server and that receive calls back from the server using long-poll
     """
 
-    def __init__(self, name, io_loop, timeout=120, transport=RESTTransport, reconnect_delay=5):
+    def __init__(self, name, io_loop, timeout=120, transport=RESTTransport, reconnect_delay=5, batch_window=0.1,
+                 batch_size=250, websocket=False):
         super().__init__(io_loop, name)
         self._transport = transport
+        self._call_transport = None
         self._client = None
+        self._batch_client = None
+        self.batch_window = batch_window
+        self.batch_size = batch_size
         self._sched = Scheduler(self._io_loop)
 
         self._env_id = None
@@ -1222,6 +2038,8 @@ class AgentEndPoint(Endpoint, metaclass=EndpointMeta):
         self.running = True
         self.server_timeout = timeout
         self.reconnect_delay = reconnect_delay
+        self.websocket = websocket
+        self._connected = False
 
     def get_environment(self):
         return self._env_id
@@ -1244,10 +2062,18 @@ class AgentEndPoint(Endpoint, metaclass=EndpointMeta):
         assert self._env_id is not None
         LOGGER.log(3, "Starting agent for %s", str(self.sessionid))
         self._client = AgentClient(self.name, self.sessionid, transport=self._transport, timeout=self.server_timeout)
+        if self.batch_window > 0:
+            self._batch_client = BatchClient(self.name, self.sessionid, transport=self._transport,
+                                             timeout=self.server_timeout, window=self.batch_window,
+                                             max_calls=self.batch_size)
+        else:
+            self._batch_client = self._client
         self._io_loop.add_callback(self.perform_heartbeat)
 
     def stop(self):
         self.running = False
+        if isinstance(self._batch_client, BatchClient):
+            self._batch_client.flush()
 
     @gen.coroutine
     def on_reconnect(self):
@@ -1256,10 +2082,15 @@ class AgentEndPoint(Endpoint, metaclass=EndpointMeta):
     @gen.coroutine
     def perform_heartbeat(self):
         """
-            Start a continuous heartbeat call
+            Start a continuous heartbeat call. When websocket is set, the agent receives calls over a websocket and only
+            uses heartbeat calls while the websocket can not be opened.
         """
-        connected = False
         while self.running:
+            if self.websocket:
+                opened = yield self._run_channel()
+                if opened:
+                    continue
+
             LOGGER.log(3, "sending heartbeat for %s", str(self.sessionid))
             result = yield self._client.heartbeat(sid=str(self.sessionid),
                                                   tid=str(self._env_id),
@@ -1267,23 +2098,96 @@ class AgentEndPoint(Endpoint, metaclass=EndpointMeta):
                                                   nodename=self.node_name)
             LOGGER.log(3, "returned heartbeat for %s", str(self.sessionid))
             if result.code == 200:
-                if not connected:
-                    connected = True
-                    self.add_future(self.on_reconnect())
+                self._set_connected(True)
                 if result.result is not None:
                     if "method_calls" in result.result:
                         method_calls = result.result["method_calls"]
-                        transport = self._transport(self)
-
                         for method_call in method_calls:
-                            self.dispatch_method(transport, method_call)
+                            self.dispatch_method(self._get_call_transport(), method_call)
             else:
                 LOGGER.warning("Heartbeat failed with status %d and message: %s, going to sleep for %d s",
                                result.code, result.result, self.reconnect_delay)
-                connected = False
+                self._set_connected(False)
                 yield gen.sleep(self.reconnect_delay)
 
-    def dispatch_method(self, transport, method_call):
+    def _set_connected(self, connected):
+        if connected and not self._connected:
+            self.add_future(self.on_reconnect())
+        self._connected = connected
+
+    def _get_call_transport(self):
+        if self._call_transport is None:
+            self._call_transport = self._transport(self)
+        return self._call_transport
+
+    @gen.coroutine
+    def _run_channel(self):
+        """
+            Open a websocket to the server and handle the calls the server sends over it until it is closed.
+
+            :return True when the websocket was opened
+        """
+        messages = queues.Queue()
+        try:
+            connection = yield self._client._transport_instance.connect_channel(messages.put_nowait)
+        except Exception as e:
+            if isinstance(e, HTTPError) and e.code == 404:
+                LOGGER.warning("The server does not support websockets, using heartbeat calls")
+                self.websocket = False
+            else:
+                LOGGER.debug("Unable to open a websocket to the server: %s", str(e))
+            return False
+
+        def send(message):
+            connection.write_message(json_encode(message).decode())
+
+        def send_reply(reply_id, data):
+            try:
+                send({"type": "reply", "reply_id": reply_id, "data": data})
+            except tornado.websocket.WebSocketClosedError:
+                LOGGER.warning("Unable to send the reply to call %s, the websocket is closed", reply_id)
+
+        heartbeat = {"type": "heartbeat", "sid": str(self.sessionid), "tid": str(self._env_id),
+                     "endpoint_names": self.end_point_names, "nodename": self.node_name}
+        interval = self.server_timeout
+        next_heartbeat = 0
+        last_message = time.time()
+        try:
+            while self.running:
+                if time.time() - last_message > self.server_timeout:
+                    LOGGER.warning("The server did not answer heartbeats on the websocket for %d s", self.server_timeout)
+                    break
+
+                if time.time() >= next_heartbeat:
+                    send(heartbeat)
+                    next_heartbeat = time.time() + interval
+
+                try:
+                    message = yield messages.get(timeout=self._io_loop.time() + next_heartbeat - time.time())
+                except gen.TimeoutError:
+                    continue
+
+                if message is None:
+                    LOGGER.warning("The websocket to the server was closed")
+                    break
+
+                last_message = time.time()
+                message = get_codec().decode(message)
+                if message["type"] == "session":
+                    self._set_connected(True)
+                    interval = message["interval"]
+                    next_heartbeat = min(next_heartbeat, time.time() + interval)
+                elif message["type"] == "call":
+                    self.dispatch_method(self._get_call_transport(), message, send_reply)
+        except tornado.websocket.WebSocketClosedError:
+            LOGGER.warning("The websocket to the server was closed")
+        finally:
+            connection.close()
+
+        self._set_connected(False)
+        return True
+
+    def dispatch_method(self, transport, method_call, send_reply=None):
         LOGGER.debug("Received call through heartbeat: %s %s %s", method_call[
                      "reply_id"], method_call["method"], method_call["url"])
         kwargs, config = transport.match_call(method_call["url"], method_call["method"])
@@ -1294,20 +2198,10 @@ class AgentEndPoint(Endpoint, metaclass=EndpointMeta):
             LOGGER.error(msg)
             self.add_future(self._client.heartbeat_reply(self.sessionid, method_call["reply_id"],
                                                          {"result": msg, "code": 500}))
+            return
 
-        body = {}
-        if "body" in method_call and method_call["body"] is not None:
-            body = method_call["body"]
-
-        query_string = urllib.parse.urlparse(method_call["url"]).query
-        for key, value in urllib.parse.parse_qs(query_string, keep_blank_values=True):
-            if len(value) == 1:
-                body[key] = value[0].decode("latin-1")
-            else:
-                body[key] = [v.decode("latin-1") for v in value]
-
-        call_result = self._transport(self)._execute_call(kwargs, method_call["method"], config, body,
-                                                          method_call["headers"])
+        body = transport.get_call_message(method_call)
+        call_result = transport._execute_call(kwargs, method_call["method"], config, body, method_call["headers"])
 
         def submit_result(future):
             if future is None:
@@ -1320,8 +2214,11 @@ class AgentEndPoint(Endpoint, metaclass=EndpointMeta):
                     msg = result_body["message"]
                 LOGGER.error("An error occurred during heartbeat method call (%s %s %s): %s",
                              method_call["reply_id"], method_call["method"], method_call["url"], msg)
-            self._client.heartbeat_reply(self.sessionid, method_call["reply_id"],
-                                         {"result": result_body, "code": status})
+            data = {"result": result_body, "code": status}
+            if send_reply is not None:
+                send_reply(method_call["reply_id"], data)
+            else:
+                self._client.heartbeat_reply(self.sessionid, method_call["reply_id"], data)
 
         self._io_loop.add_future(call_result, submit_result)
 
@@ -1411,6 +2308,93 @@ class AgentClient(Endpoint, metaclass=ClientMeta):
         return result
 
 
+class BatchClient(AgentClient, metaclass=ClientMeta):
+    """
+        An agent client that sends the calls that are made within window seconds of each other in one batch call. Calls
+        of methods that can not be batched are sent directly. When the server does not support batch calls, all calls are
+        sent directly.
+
+        :param window The number of seconds a call waits for other calls to send along
+        :param max_calls The maximal number of calls in a batch
+    """
+
+    def __init__(self, name, sid, ioloop=None, transport=RESTTransport, timeout=120, window=0.1, max_calls=250):
+        super().__init__(name, sid, ioloop, transport, timeout)
+        self._window = window
+        self._max_calls = max_calls
+        self._pending = defaultdict(list)
+        self._flush_timeout = None
+        self._supported = True
+
+        self.calls = 0
+        self.batches = 0
+
+    @gen.coroutine
+    def _call(self, args, kwargs, protocol_properties):
+        protocol_properties["method_name"] = get_method_name(protocol_properties)
+        if not self._supported or not can_batch(protocol_properties):
+            result = yield super()._call(args, kwargs, protocol_properties)
+            return result
+
+        if 'sid' not in kwargs:
+            kwargs['sid'] = self._sid
+
+        url, method, headers, body = self._transport_instance.build_call(protocol_properties, args, kwargs)
+        tid = headers[INMANTA_MT_HEADER]
+        future = tornado.concurrent.Future()
+        self._pending[tid].append(({"url": url, "method": method, "headers": headers, "body": body},
+                                   (args, kwargs, protocol_properties), future))
+
+        if len(self._pending[tid]) >= self._max_calls:
+            self._send(tid)
+        elif self._flush_timeout is None:
+            self._flush_timeout = self._io_loop.call_later(self._window, self.flush)
+
+        result = yield future
+        return result
+
+    def flush(self):
+        """
+            Send all pending calls
+        """
+        if self._flush_timeout is not None:
+            self._io_loop.remove_timeout(self._flush_timeout)
+            self._flush_timeout = None
+
+        for tid in list(self._pending.keys()):
+            self._send(tid)
+
+    def _send(self, tid):
+        calls = self._pending.pop(tid, [])
+        if len(calls) > 0:
+            self.add_future(self._send_batch(tid, calls))
+
+    @gen.coroutine
+    def _send_batch(self, tid, calls):
+        try:
+            result = yield self.batch(tid=tid, calls=[call for call, _, _ in calls])
+        except Exception as e:
+            result = Result(code=500, result={"message": str(e)})
+
+        if result.code == 404 and (result.result is None or "results" not in result.result):
+            LOGGER.warning("The server does not support batch calls, sending calls one by one")
+            self._supported = False
+            for _, call_args, future in calls:
+                tornado.concurrent.chain_future(super()._call(*call_args), future)
+            return
+
+        self.calls += len(calls)
+        self.batches += 1
+
+        if result.code != 200 or len(result.result["results"]) != len(calls):
+            for _, _, future in calls:
+                future.set_result(Result(code=result.code, result=result.result))
+            return
+
+        for (_, _, future), call_result in zip(calls, result.result["results"]):
+            future.set_result(Result(code=call_result["code"], result=call_result["result"]))
+
+
 class ReturnClient(Client, metaclass=ClientMeta):
     """
         A client that uses a return channel to connect to its destination. This client is used by the server to communicate
@@ -1429,8 +2413,10 @@ class ReturnClient(Client, metaclass=ClientMeta):
         call_spec = {"url": url, "method": method, "headers": headers, "body": body}
         timeout = protocol_properties["timeout"]
         try:
-            return_value = yield self.session.put_call(call_spec, timeout=timeout)
+            return_value = yield self.session.put_call(call_spec, timeout=timeout, priority=protocol_properties["priority"])
         except gen.TimeoutError:
             return Result(code=500, result="Call timed out")
+        except CallQueueFull as e:
+            return Result(code=503, result={"message": str(e)})
 
         return Result(code=return_value["code"], result=return_value["result"])
@@ -19,13 +19,13 @@
 
 from tornado import gen
 from tornado import locks
-from motorengine import DESCENDING
 
 from inmanta.config import Config, executable
 from inmanta.agent.io.remote import RemoteIO
-from inmanta.resources import HostNotFoundException
+from inmanta.resources import HostNotFoundException, Id
 from inmanta import data
 from inmanta.server.config import server_agent_autostart
+from inmanta.server.cache import ServerCache
 from inmanta.protocol import Session
 from inmanta.data import AgentProcess, AgentInstance, Agent, Environment
 from inmanta.asyncutil import retry_limited
@@ -39,6 +39,7 @@ import sys
 import subprocess
 import uuid
 from uuid import UUID
+from collections import defaultdict
 
 
 LOGGER = logging.getLogger(__name__)
@@ -76,9 +77,15 @@ class AgentManager(object):
     This class contains all server functionality related to the management of agents
     '''
 
-    def __init__(self, server, autostart=True, closesessionsonstart=True, fact_back_off=60):
+    def __init__(self, server, autostart=True, closesessionsonstart=True, fact_back_off=60, cache=None,
+                 fact_request_concurrency=10):
         self._server = server
 
+        # the server cache for environment and version lookups, without a cache all lookups go to the database
+        if cache is None:
+            cache = ServerCache(0)
+        self._cache = cache
+
         self._requires_agents = {}
         if autostart:
             server.add_future(self.start_agents())
@@ -87,6 +94,8 @@ class AgentManager(object):
         self._fact_resource_block = fact_back_off
         # per resource time of last fact request
         self._fact_resource_block_set = {}
+        # limit the number of batched fact requests that are sent to agents at the same time
+        self._fact_request_limit = locks.Semaphore(fact_request_concurrency)
 
         self._server_storage = server._server_storage
 
@@ -159,7 +168,7 @@ class AgentManager(object):
 
             self.sessions[sid] = session
 
-            env = yield data.Environment.get_uuid(tid)
+            env = yield self._cache.get_environment(tid)
             if env is None:
                 LOGGER.warning("The environment id %s, for agent %s does not exist!", tid, sid)
 
@@ -195,7 +204,7 @@ class AgentManager(object):
 
             del self.sessions[sid]
 
-            env = yield data.Environment.get_uuid(tid)
+            env = yield self._cache.get_environment(tid)
             if env is None:
                 LOGGER.warning("The environment id %s, for agent %s does not exist!", tid, sid)
 
@@ -225,7 +234,7 @@ class AgentManager(object):
         tid = session.tid
         sid = session.id
 
-        env = yield data.Environment.get_uuid(tid)
+        env = yield self._cache.get_environment(tid)
         if env is None:
             LOGGER.warning("The environment id %s, for agent %s does not exist!", tid, sid)
             return
@@ -315,7 +324,7 @@ class AgentManager(object):
     @gen.coroutine
     def list_agent_processes(self, tid, expired):
         if tid is not None:
-            env = yield data.Environment.get_uuid(tid)
+            env = yield self._cache.get_environment(tid)
             if env is None:
                 return 404, {"message": "The given environment id does not exist!"}
             if expired:
@@ -355,7 +364,7 @@ class AgentManager(object):
     @gen.coroutine
     def list_agents(self, tid):
         if tid is not None:
-            env = yield data.Environment.get_uuid(tid)
+            env = yield self._cache.get_environment(tid)
             if env is None:
                 return 404, {"message": "The given environment id does not exist!"}
             ags = yield Agent.by_env(env)
@@ -540,14 +549,10 @@ ssl_ca_cert_file=%s
 
         if resource_id is not None and resource_id != "":
             # get the latest version
-            versions = yield (data.ConfigurationModel.objects.filter(environment=env, released=True).  # @UndefinedVariable
-                              order_by("version", direction=DESCENDING).limit(1).find_all())  # @UndefinedVariable
-
-            if len(versions) == 0:
+            version = yield self._cache.get_latest_version(env)
+            if version is None:
                 return 404, {"message": "The environment associated with this parameter does not have any releases."}
 
-            version = versions[0]
-
             # get the associated resource
             resources = yield data.Resource.objects.filter(environment=env,  # @UndefinedVariable
                                                            resource_id=resource_id).find_all()  # @UndefinedVariable
@@ -564,6 +569,8 @@ ssl_ca_cert_file=%s
             if len(rvs) == 0:
                 return 404, {"message": "The resource has no recent version."}
 
+            yield data.ResourceVersion.load_attributes(env, rvs)
+
             # only request facts of a resource every _fact_resource_block time
             now = time.time()
             if (resource_id not in self._fact_resource_block_set or
@@ -584,6 +591,49 @@ ssl_ca_cert_file=%s
         else:
             return 404, {"message": "resource_id parameter is required."}
 
+    @gen.coroutine
+    def _request_parameters(self, env, resource_ids):
+        """
+            Request the facts of the given resources in the latest version of the environment. The resource versions are
+            loaded with one query and each agent receives one request for all of its resources.
+        """
+        tid = str(env.uuid)
+
+        version = yield self._cache.get_latest_version(env)
+        if version is None:
+            LOGGER.debug("Environment %s does not have any releases, not requesting facts.", tid)
+            return
+
+        # only request facts of a resource every _fact_resource_block time
+        now = time.time()
+        resource_ids = [r for r in set(resource_ids) if r is not None and r != "" and
+                        (r not in self._fact_resource_block_set or
+                         (self._fact_resource_block_set[r] + self._fact_resource_block) < now)]
+        if len(resource_ids) == 0:
+            return
+
+        rids = ["%s,v=%s" % (resource_id, version.version) for resource_id in resource_ids]
+        rvs = yield (data.ResourceVersion.objects.filter(environment=env, model=version, rid__in=rids)  # @UndefinedVariable
+                     .limit(len(rids)).find_all())
+        yield data.ResourceVersion.load_attributes(env, rvs)
+
+        per_agent = defaultdict(list)
+        for rv in rvs:
+            per_agent[rv.agent].append(rv.to_dict())
+            self._fact_resource_block_set[Id.parse_id(rv.rid).resource_str()] = now
+
+        yield self._ensure_agents(tid, per_agent.keys())
+        for agent, resources in per_agent.items():
+            client = self.get_agent_client(env.uuid, agent)
+            if client is not None:
+                LOGGER.debug("Requesting facts of %d resources from agent %s in env %s", len(resources), agent, tid)
+                self.add_future(self._send_fact_request(client, tid, agent, resources))
+
+    @gen.coroutine
+    def _send_fact_request(self, client, tid, agent, resources):
+        with (yield self._fact_request_limit.acquire()):
+            yield client.get_parameters(tid, agent, resources)
+
     @gen.coroutine
     def get_agent_info(self, id):
         node = yield data.Node.get_by_hostname(id)
@@ -611,7 +661,7 @@ ssl_ca_cert_file=%s
 
     @gen.coroutine
     def trigger_agent(self, tid, id):
-        env = yield data.Environment.get_uuid(tid)
+        env = yield self._cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
@@ -0,0 +1,214 @@
+"""
+    Copyright 2016 Inmanta
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Contact: code@inmanta.com
+"""
+
+from collections import OrderedDict
+import time
+
+from tornado import gen
+from motorengine import DESCENDING
+
+from inmanta import data
+
+
+class TTLCache(object):
+    """
+        A dict based cache in which every entry expires after a fixed time to live. Hits and misses are counted.
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items = {}
+
+    def __contains__(self, key):
+        if key not in self._items:
+            return False
+
+        if self._items[key][0] < time.time():
+            del self._items[key]
+            return False
+
+        return True
+
+    def get(self, key):
+        """
+            Get the value for the given key and count the lookup as a hit or a miss.
+
+            :return A tuple with a boolean that indicates a hit and the cached value
+        """
+        if key in self:
+            self.hits += 1
+            return True, self._items[key][1]
+
+        self.misses += 1
+        return False, None
+
+    def put(self, key, value):
+        if self.ttl <= 0:
+            return
+
+        self._items[key] = (time.time() + self.ttl, value)
+
+    def remove(self, key):
+        if key in self._items:
+            del self._items[key]
+
+    def remove_if(self, predicate):
+        """
+            Remove all entries for which predicate(key) is true
+        """
+        for key in [k for k in self._items.keys() if predicate(k)]:
+            del self._items[key]
+
+    def to_dict(self):
+        return {"hits": self.hits, "misses": self.misses, "hit_ratio": hit_ratio(self.hits, self.misses),
+                "size": len(self._items)}
+
+
+def hit_ratio(hits, misses):
+    if hits + misses == 0:
+        return 0.0
+
+    return hits / (hits + misses)
+
+
+class LRUCache(object):
+    """
+        A cache bounded by the total size of its values. When the cache is full, the least recently used entries are
+        evicted. Values larger than max_item_size are never cached.
+
+        :param max_size The maximal total size of the cached values. 0 disables the cache.
+        :param size_of A function that returns the size of a value
+    """
+
+    def __init__(self, max_size: int, max_item_size: int=None, size_of=len):
+        self.max_size = max_size
+        self.max_item_size = max_size if max_item_size is None else min(max_item_size, max_size)
+        self.size_of = size_of
+        self.hits = 0
+        self.misses = 0
+        self.total_size = 0
+        self._items = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key):
+        """
+            Get the value for the given key and count the lookup as a hit or a miss.
+
+            :return A tuple with a boolean that indicates a hit and the cached value
+        """
+        if key in self._items:
+            self.hits += 1
+            self._items.move_to_end(key)
+            return True, self._items[key][1]
+
+        self.misses += 1
+        return False, None
+
+    def put(self, key, value):
+        size = self.size_of(value)
+        if size > self.max_item_size:
+            return
+
+        self.remove(key)
+        self._items[key] = (size, value)
+        self.total_size += size
+
+        while self.total_size > self.max_size:
+            _, (old_size, _) = self._items.popitem(last=False)
+            self.total_size -= old_size
+
+    def remove(self, key):
+        if key in self._items:
+            size, _ = self._items.pop(key)
+            self.total_size -= size
+
+    def to_dict(self):
+        return {"hits": self.hits, "misses": self.misses, "hit_ratio": hit_ratio(self.hits, self.misses),
+                "size": len(self._items), "bytes": self.total_size, "max_bytes": self.max_size}
+
+
+class ServerCache(object):
+    """
+        Cache for hot and rarely changing lookups of the server: environments and the latest released or deployed
+        configuration model of an environment. Entries expire after ttl seconds. The handlers that change this data
+        invalidate the cache explicitly.
+
+        Cached documents are shared between handlers and should not be modified.
+    """
+
+    def __init__(self, ttl: int):
+        self._environments = TTLCache(ttl)
+        self._versions = TTLCache(ttl)
+
+    @gen.coroutine
+    def get_environment(self, tid):
+        """
+            Get the environment with the given id or None when it does not exist. Unknown environments are not cached.
+        """
+        key = str(tid)
+        hit, env = self._environments.get(key)
+        if hit:
+            return env
+
+        env = yield data.Environment.get_uuid(tid)
+        if env is not None:
+            self._environments.put(key, env)
+
+        return env
+
+    @gen.coroutine
+    def get_latest_version(self, env, deployed=False):
+        """
+            Get the latest released configuration model of the given environment, or the latest deployed model when
+            deployed is True. Returns None when no such version exists.
+        """
+        key = (str(env.uuid), deployed)
+        hit, model = self._versions.get(key)
+        if hit:
+            return model
+
+        if deployed:
+            query = data.ConfigurationModel.objects.filter(environment=env, deployed=True)  # @UndefinedVariable
+        else:
+            query = data.ConfigurationModel.objects.filter(environment=env, released=True)  # @UndefinedVariable
+
+        versions = yield query.order_by("version", direction=DESCENDING).limit(1).find_all()
+        model = versions[0] if len(versions) > 0 else None
+        self._versions.put(key, model)
+        return model
+
+    def invalidate_environment(self, tid):
+        """
+            Drop the environment and all versions cached for it
+        """
+        self._environments.remove(str(tid))
+        self.invalidate_versions(tid)
+
+    def invalidate_versions(self, tid):
+        """
+            Drop the latest released and deployed versions cached for the given environment
+        """
+        tid = str(tid)
+        self._versions.remove_if(lambda key: key[0] == tid)
+
+    def to_dict(self):
+        return {"environments": self._environments.to_dict(), "versions": self._versions.to_dict()}
@@ -0,0 +1,121 @@
+"""
+    Copyright 2016 Inmanta
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Contact: code@inmanta.com
+"""
+
+import codecs
+import collections
+import time
+
+from tornado import gen
+from tornado.iostream import StreamClosedError
+
+from inmanta import data
+
+CHUNK_SIZE = 64 * 1024
+FLUSH_INTERVAL = 1
+
+
+class OutputCollector(object):
+    """
+        Store the output of a stream of a compile stage in ReportOutput chunks while the stage runs. A chunk is stored when
+        it is full or when output has been buffered for longer than flush_interval seconds. Only the last limit characters
+        are kept: when the stored output grows beyond limit, the oldest chunks are removed.
+
+        :param environment The environment that is compiled
+        :param report_id The id of the report of the stage
+        :param stream out or err
+        :param limit The maximal number of characters to keep
+    """
+
+    def __init__(self, environment, report_id, stream, limit, chunk_size=CHUNK_SIZE, flush_interval=FLUSH_INTERVAL):
+        self._environment = environment
+        self._report_id = report_id
+        self._stream = stream
+        self._limit = limit
+        self._chunk_size = chunk_size
+        self._flush_interval = flush_interval
+
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._buffer = ""
+        self._buffered_since = None
+        self._index = 0
+        self._chunks = collections.deque()
+        self._stored = 0
+
+        self.size = 0
+
+    @gen.coroutine
+    def write(self, output, final=False):
+        """
+            Add output to the stream
+
+            :param output The output as bytes or str
+            :param final Store all buffered output
+        """
+        if isinstance(output, bytes):
+            output = self._decoder.decode(output, final)
+
+        if len(output) > 0:
+            if self._buffered_since is None:
+                self._buffered_since = time.time()
+            self._buffer += output
+
+        while len(self._buffer) >= self._chunk_size:
+            yield self._store(self._buffer[:self._chunk_size])
+            self._buffer = self._buffer[self._chunk_size:]
+
+        if len(self._buffer) > 0 and (final or time.time() - self._buffered_since >= self._flush_interval):
+            yield self._store(self._buffer)
+            self._buffer = ""
+
+        if len(self._buffer) == 0:
+            self._buffered_since = None
+
+    @gen.coroutine
+    def read_from(self, stream):
+        """
+            Store everything that is read from the given tornado stream until it is closed
+        """
+        while True:
+            try:
+                output = yield stream.read_bytes(self._chunk_size, partial=True)
+            except StreamClosedError:
+                break
+
+            yield self.write(output)
+
+        yield self.write(b"", final=True)
+
+    @gen.coroutine
+    def _store(self, content):
+        chunk = data.ReportOutput(environment=self._environment, report=self._report_id, stream=self._stream,
+                                  index=self._index, offset=self.size, end=self.size + len(content), content=content)
+        yield chunk.save()
+
+        self._chunks.append((self._index, len(content)))
+        self._stored += len(content)
+        self._index += 1
+        self.size += len(content)
+
+        removed = None
+        while self._stored > self._limit and len(self._chunks) > 1:
+            removed, length = self._chunks.popleft()
+            self._stored -= length
+
+        if removed is not None:
+            yield data.ReportOutput.objects.filter(report=self._report_id, stream=self._stream,  # @UndefinedVariable
+                                                   index__lte=removed).delete()
@@ -0,0 +1,193 @@
+"""
+    Copyright 2016 Inmanta
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Contact: code@inmanta.com
+"""
+
+import datetime
+import logging
+import time
+
+from tornado import gen, locks
+
+LOGGER = logging.getLogger(__name__)
+
+PRIORITY_LOW = 0
+PRIORITY_NORMAL = 1
+PRIORITY_HIGH = 2
+
+
+class CompileRequest(object):
+    """
+        A pending compile of an environment. Requests for the same environment are merged into one request.
+    """
+
+    def __init__(self, environment_id, update_repo, priority, not_before):
+        self.environment_id = environment_id
+        self.update_repo = update_repo
+        self.priority = priority
+        self.not_before = not_before
+        self.requested = time.time()
+        self.merged = 0
+
+    def merge(self, update_repo, priority, not_before):
+        self.update_repo = self.update_repo or update_repo
+        self.priority = max(self.priority, priority)
+        self.not_before = min(self.not_before, not_before)
+        self.merged += 1
+
+
+class CompileQueue(object):
+    """
+        Run the compiles of all environments on a fixed number of workers.
+
+        Each environment has at most one pending request and at most one running compile. A request for an environment
+        that already has a pending request is merged into it. A request that arrives while the environment is compiling
+        stays pending until that compile is done, so it results in exactly one follow-up compile. Pending requests are
+        started in order of priority and then of arrival.
+
+        :param compile_function A coroutine that compiles an environment. It is called with the environment id and
+                                whether the repository should be updated.
+        :param workers The maximal number of concurrent compiles
+        :param min_interval The minimal number of seconds between the end of a compile of an environment and the start of
+                            the next one.
+    """
+
+    def __init__(self, io_loop, compile_function, workers=1, min_interval=0):
+        self._io_loop = io_loop
+        self._compile_function = compile_function
+        self._workers = max(workers, 1)
+        self._min_interval = min_interval
+        self._condition = locks.Condition()
+        self._running = False
+
+        self._pending = {}
+        self._compiling = {}
+        self._last_compile = {}
+
+        self.completed = 0
+        self.failed = 0
+        self.coalesced = 0
+        self.max_depth = 0
+
+    def start(self):
+        if self._running:
+            return
+
+        self._running = True
+        for _ in range(self._workers):
+            self._io_loop.add_callback(self._work)
+
+    def stop(self):
+        self._running = False
+        self._condition.notify_all()
+
+    def request(self, environment_id, update_repo=False, wait=0, priority=PRIORITY_NORMAL):
+        """
+            Request a compile of an environment
+
+            :param wait The number of seconds to wait before the compile may start
+        """
+        environment_id = str(environment_id)
+        not_before = time.time() + wait
+        last_compile = self._last_compile.get(environment_id)
+        if last_compile is not None:
+            not_before = max(not_before, last_compile + self._min_interval)
+
+        if environment_id in self._pending:
+            LOGGER.info("Merging compile request for environment %s with the pending request", environment_id)
+            self._pending[environment_id].merge(update_repo, priority, not_before)
+            self.coalesced += 1
+        else:
+            self._pending[environment_id] = CompileRequest(environment_id, update_repo, priority, not_before)
+            self.max_depth = max(self.max_depth, len(self._pending))
+
+        self._condition.notify()
+
+    def is_compiling(self, environment_id):
+        """
+            Is a compile of the environment pending or running
+        """
+        environment_id = str(environment_id)
+        return environment_id in self._pending or environment_id in self._compiling
+
+    def _next_request(self):
+        """
+            Remove the pending request that should be compiled next from the queue.
+
+            :return The request, or None and the number of seconds until a delayed request may start.
+        """
+        now = time.time()
+        selected = None
+        next_start = None
+        for request in self._pending.values():
+            if request.environment_id in self._compiling:
+                continue
+
+            if request.not_before > now:
+                if next_start is None or request.not_before < next_start:
+                    next_start = request.not_before
+                continue
+
+            if selected is None or (request.priority, -request.requested) > (selected.priority, -selected.requested):
+                selected = request
+
+        if selected is not None:
+            del self._pending[selected.environment_id]
+            return selected, None
+
+        if next_start is None:
+            return None, None
+
+        return None, next_start - now
+
+    @gen.coroutine
+    def _work(self):
+        while self._running:
+            request, delay = self._next_request()
+            if request is None:
+                timeout = datetime.timedelta(seconds=delay) if delay is not None else None
+                yield self._condition.wait(timeout=timeout)
+                continue
+
+            environment_id = request.environment_id
+            self._compiling[environment_id] = request
+            LOGGER.info("Compiling environment %s (waited %.1f seconds, %d requests merged)", environment_id,
+                        time.time() - request.requested, request.merged)
+            try:
+                yield self._compile_function(environment_id, request.update_repo)
+                self.completed += 1
+            except Exception:
+                LOGGER.exception("An exception occurred while compiling environment %s", environment_id)
+                self.failed += 1
+            finally:
+                del self._compiling[environment_id]
+                self._last_compile[environment_id] = time.time()
+                if environment_id in self._pending:
+                    self._pending[environment_id].not_before = max(self._pending[environment_id].not_before,
+                                                                   time.time() + self._min_interval)
+                    self._condition.notify()
+
+    def to_dict(self):
+        now = time.time()
+        return {"workers": self._workers,
+                "depth": len(self._pending),
+                "max_depth": self.max_depth,
+                "oldest_request": max([now - r.requested for r in self._pending.values()], default=0),
+                "compiling": sorted(self._compiling.keys()),
+                "completed": self.completed,
+                "failed": self.failed,
+                "coalesced": self.coalesced,
+                }
@@ -0,0 +1,295 @@
+"""
+    Copyright 2016 Inmanta
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Contact: code@inmanta.com
+"""
+
+import codecs
+import importlib
+import json
+import logging
+import os
+import selectors
+import sys
+import time
+import traceback
+
+from tornado import gen, process
+from tornado.iostream import StreamClosedError
+
+LOGGER = logging.getLogger(__name__)
+READ_SIZE = 64 * 1024
+
+
+class CompilerService(object):
+    """
+        A long running compiler process that runs compiles on request of the server. The process has the compiler loaded
+        and keeps the parsed model files of the projects it compiled, so a compile only has to parse the files that
+        changed.
+
+        The service replies with one json document per line: an output frame for each chunk of output the compile writes
+        while it runs and a final frame with the return code.
+
+        :param cmd The command that starts the compiler service
+    """
+
+    def __init__(self, cmd):
+        self._cmd = cmd
+        self._process = None
+        self._started = False
+        self.compiles = 0
+        self.restarts = 0
+
+    def start(self):
+        if self._process is not None:
+            return
+
+        LOGGER.info("Starting compiler service")
+        self._started = True
+        self._process = process.Subprocess(self._cmd, stdin=process.Subprocess.STREAM, stdout=process.Subprocess.STREAM,
+                                           env=os.environ.copy())
+
+    def stop(self):
+        if self._process is None:
+            return
+
+        self._process.stdin.close()
+        self._process = None
+
+    @gen.coroutine
+    def compile(self, cwd, args, on_output=None):
+        """
+            Run a compile
+
+            :param cwd The directory to run the compile in
+            :param args The command line arguments of the compile
+            :param on_output A coroutine that is called with the name of the stream, out or err, and the output while the
+                             compile runs. When it is None, the output is collected and returned.
+            :return A tuple with the return code, stdout and stderr of the compile
+        """
+        if self._process is None:
+            # only count a start after an earlier process exited or was stopped
+            if self._started:
+                self.restarts += 1
+            self.start()
+
+        output = {"out": [], "err": []}
+        request = json.dumps({"cwd": cwd, "args": args}) + "\n"
+        try:
+            yield self._process.stdin.write(request.encode())
+            while True:
+                line = yield self._process.stdout.read_until(b"\n")
+                frame = json.loads(line.decode())
+                if "returncode" in frame:
+                    break
+
+                if on_output is None:
+                    output[frame["stream"]].append(frame["output"])
+                else:
+                    yield on_output(frame["stream"], frame["output"])
+        except StreamClosedError:
+            LOGGER.warning("The compiler service exited unexpectedly")
+            self._process = None
+            raise
+        except Exception:
+            # the rest of the reply of this compile is still on the way, do not use this service for the next compile
+            self.stop()
+            raise
+
+        self.compiles += 1
+        return frame["returncode"], "".join(output["out"]), "".join(output["err"])
+
+
+class CompilerServicePool(object):
+    """
+        A pool of compiler services. Each concurrent compile uses its own service. Services are started when a compile
+        finds no idle service.
+
+        :param cmd The command that starts a compiler service
+    """
+
+    def __init__(self, cmd):
+        self._cmd = cmd
+        self._idle = []
+        self._services = []
+
+    def stop(self):
+        for service in self._services:
+            service.stop()
+
+        self._idle = []
+        self._services = []
+
+    @gen.coroutine
+    def compile(self, cwd, args, on_output=None):
+        """
+            Run a compile on an idle service. A new service is started when all services are busy.
+        """
+        if len(self._idle) == 0:
+            service = CompilerService(self._cmd)
+            self._services.append(service)
+        else:
+            service = self._idle.pop()
+        try:
+            result = yield service.compile(cwd, args, on_output)
+            return result
+        finally:
+            self._idle.append(service)
+
+    def to_dict(self):
+        return {"services": len(self._services),
+                "idle": len(self._idle),
+                "compiles": sum([s.compiles for s in self._services]),
+                "restarts": sum([s.restarts for s in self._services]),
+                }
+
+
+def run_compile(cwd, args, on_output=None):
+    """
+        Run a compile in a child process, forked from this process. The child starts with everything that is loaded in
+        this process, but changes it makes, such as the plugins it loads, do not affect later compiles.
+
+        :param on_output A function that is called with the name of the stream, out or err, and the output while the
+                         compile runs. When it is None, the output is collected and returned.
+        :return A tuple with the return code, stdout and stderr of the compile
+    """
+    output = {"out": [], "err": []}
+    if on_output is None:
+        def on_output(stream, value):
+            output[stream].append(value)
+
+    pipes = {"out": os.pipe(), "err": os.pipe()}
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        returncode = 1
+        try:
+            os.dup2(pipes["out"][1], 1)
+            os.dup2(pipes["err"][1], 2)
+            for read_fd, write_fd in pipes.values():
+                os.close(read_fd)
+                os.close(write_fd)
+            sys.stdout = open(1, "w", closefd=False)
+            sys.stderr = open(2, "w", closefd=False)
+            os.chdir(cwd)
+            returncode = _compile(args)
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(returncode)
+
+    for _, write_fd in pipes.values():
+        os.close(write_fd)
+    _read_output({pipes[stream][0]: stream for stream in pipes}, on_output)
+
+    _, status = os.waitpid(pid, 0)
+    if os.WIFSIGNALED(status):
+        returncode = -os.WTERMSIG(status)
+    else:
+        returncode = os.WEXITSTATUS(status)
+
+    return returncode, "".join(output["out"]), "".join(output["err"])
+
+
+def _read_output(streams, on_output):
+    """
+        Pass everything that is read from the given file descriptors to on_output until they are all closed
+
+        :param streams A dict with the file descriptors as keys and the names of their streams as value
+    """
+    selector = selectors.DefaultSelector()
+    decoders = {}
+    for fd, stream in streams.items():
+        selector.register(fd, selectors.EVENT_READ, stream)
+        decoders[stream] = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    while len(selector.get_map()) > 0:
+        for key, _ in selector.select():
+            value = os.read(key.fd, READ_SIZE)
+            if len(value) == 0:
+                selector.unregister(key.fd)
+                os.close(key.fd)
+
+            value = decoders[key.data].decode(value, len(value) == 0)
+            if len(value) > 0:
+                on_output(key.data, value)
+
+    selector.close()
+
+
+def _compile(args):
+    from inmanta import app
+
+    sys.argv = ["inmanta"] + args
+    try:
+        app.app()
+    except SystemExit as e:
+        if e.code is None:
+            return 0
+        if isinstance(e.code, int):
+            return e.code
+        print(e.code, file=sys.stderr)
+        return 1
+
+    return 0
+
+
+def warm_up(cwd):
+    """
+        Parse the model of the project in cwd into the parse cache, so the next compile of the project only parses the
+        files that changed since.
+    """
+    from inmanta.module import Project
+
+    start = time.time()
+    try:
+        Project(cwd).get_complete_ast()
+        LOGGER.debug("Parsed the model of %s in %.2f seconds", cwd, time.time() - start)
+    except Exception:
+        LOGGER.debug("Unable to parse the model of %s", cwd, exc_info=True)
+
+
+def serve():
+    """
+        Run a compiler service. It reads compile requests from stdin and writes the output and the return code of each
+        compile to stdout, one json document per line.
+    """
+    # load the compiler before the first compile is forked
+    importlib.import_module("inmanta.compiler")
+    importlib.import_module("inmanta.export")
+    from inmanta.parser import plyInmantaParser
+    plyInmantaParser.enable_cache()
+
+    # only the results of compiles go to stdout
+    replies = os.fdopen(os.dup(1), "w")
+    os.dup2(2, 1)
+
+    for line in sys.stdin:
+        if line.strip() == "":
+            continue
+
+        def send_output(stream, value):
+            replies.write(json.dumps({"stream": stream, "output": value}) + "\n")
+            replies.flush()
+
+        request = json.loads(line)
+        returncode, _, _ = run_compile(request["cwd"], request["args"], send_output)
+        replies.write(json.dumps({"returncode": returncode}) + "\n")
+        replies.flush()
+
+        warm_up(request["cwd"])
@@ -106,18 +106,40 @@ server_fact_resource_block = \
 server_autrecompile_wait = \
     Option("server", "auto-recompile-wait ", 10,
            """The number of seconds to wait before the server may attempt to do a new recompile.
-           Recompiles are triggered after facts updates for example.""", is_time)
+           Recompiles are triggered after facts updates for example. Requests within this time are delayed and merged.""",
+           is_time)
 
 server_purge_version_interval = \
     Option("server", "purge-versions-interval", 3600,
            """The number of seconds between version purging,
 see :inmanta.config:option:`server.available-versions-to-keep`""", is_time)
 
+server_purge_version_pause = \
+    Option("server", "purge-versions-pause", 1,
+           """The number of seconds to wait between deleting two versions during a purge, so purging many versions does not
+compete with the other requests to the server.""", is_time)
+
 server_version_to_keep = \
     Option("server", "available-versions-to-keep", 2,
            """On boot and at regular intervals the server will purge versions that have not been deployed.
 This is the number of most recent undeployed versions to keep available.""", is_int)
 
+server_purge_resource_action_interval = \
+    Option("server", "purge-resource-action-interval", 3600,
+           """The number of seconds between applying the retention policy of the resource action log,
+see :inmanta.config:option:`server.resource-action-retention` and :inmanta.config:option:`server.resource-actions-to-keep`""",
+           is_time)
+
+server_resource_action_retention = \
+    Option("server", "resource-action-retention", 0,
+           """The number of seconds the actions on resources (store, pull, deploy, ...) are kept in each environment.
+Set to 0 to keep them forever.""", is_time)
+
+server_resource_action_keep = \
+    Option("server", "resource-actions-to-keep", 0,
+           """The maximal number of actions on resources to keep in each environment, the oldest are removed first.
+Set to 0 to keep all actions.""", is_int)
+
 server_autostart_on_start = \
     Option("server", "autostart-on-start", True,
            "Automatically start agents when the server starts instead of only just in time.", is_bool)
@@ -141,6 +163,43 @@ server_no_recompile = \
     Option("server", "no-recompile", False,
            """Prevent all server side compiles""", is_bool)
 
+server_compile_workers = \
+    Option("server", "compile-workers", 2,
+           """The maximal number of environments that are compiled concurrently by the server""", is_int)
+
+server_compile_output_limit = \
+    Option("server", "compile-output-limit", 16 * 1024 * 1024,
+           """The maximal number of characters of the output of a compile stage that is stored for each stream. When a
+stage reports more, the oldest output is removed.""", is_int)
+
+server_compiler_service = \
+    Option("server", "compiler-service", True,
+           """Compile the configuration model in long running compiler services, at most one for each compile worker. They
+keep the compiler loaded and the parsed model files cached between compiles. When disabled, a new process is started for
+each compile.""", is_bool)
+
+server_cache_ttl = \
+    Option("server", "cache-ttl", 60,
+           """The number of seconds environments and the latest released and deployed versions are cached by the server.
+Set to 0 to disable the cache.""", is_time)
+
+server_max_file_size = \
+    Option("server", "max-file-size", 10 * 1024 ** 3,
+           """The maximal size in bytes of a file uploaded as a stream""", is_int)
+
+server_compress_files = \
+    Option("server", "compress-files", True,
+           """Compress the files stored by the server with gzip""", is_bool)
+
+server_file_cache_size = \
+    Option("server", "file-cache-size", 64 * 1024 * 1024,
+           """The maximal size in bytes of the cache of recently retrieved files. Files larger than a tenth of the cache are
+not cached. Set to 0 to disable the cache.""", is_int)
+
+server_diff_cache_size = \
+    Option("server", "diff-cache-size", 16 * 1024 * 1024,
+           """The maximal size in bytes of the cache of computed file diffs. Set to 0 to disable the cache.""", is_int)
+
 #############################
 # Dashboard
 #############################
@@ -165,3 +224,12 @@ def default_hangtime():
 agent_hangtime = \
     Option("server", "agent-hold", default_hangtime,
            "Maximal time the server will hold an agent heartbeat call", is_time)
+
+agent_call_queue_limit = \
+    Option("server", "agent-call-queue-limit", 1000,
+           "Maximal number of calls to an agent of each priority that wait to be delivered. Calls that do not fit in the "
+           "queue are rejected", is_int)
+
+agent_call_batch_size = \
+    Option("server", "agent-call-batch-size", 100,
+           "Maximal number of calls the server delivers to an agent in the reply to one heartbeat", is_int)
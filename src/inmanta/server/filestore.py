@@ -0,0 +1,269 @@
+"""
+    Copyright 2016 Inmanta
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Contact: code@inmanta.com
+"""
+
+import gzip
+import hashlib
+import logging
+import os
+import tempfile
+
+LOGGER = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+COMPRESSED_SUFFIX = ".gz"
+
+
+class FileUpload(object):
+    """
+        A file that is being added to the store. The content is hashed and compressed while it is written to a temporary
+        file. The file only becomes visible in the store when the upload is committed.
+    """
+
+    def __init__(self, store, file_id, verify=True):
+        self._store = store
+        self.file_id = file_id
+        self.verify = verify
+        self.compressed = store.compress
+        self.size = 0
+
+        fd, self._tmp_name = tempfile.mkstemp(dir=store.path, prefix=".upload-")
+        self._fd = os.fdopen(fd, "wb")
+        if self.compressed:
+            self._writer = gzip.GzipFile(fileobj=self._fd, mode="wb", compresslevel=store.compress_level)
+        else:
+            self._writer = self._fd
+
+        self._sha1sum = hashlib.sha1()
+
+    def write(self, chunk):
+        self._sha1sum.update(chunk)
+        self.size += len(chunk)
+        self._writer.write(chunk)
+
+    def commit(self):
+        """
+            Add the uploaded file to the store
+
+            :return False when the content does not match the id of the file. The upload is discarded in that case.
+        """
+        self._close()
+        try:
+            if self.verify and self._sha1sum.hexdigest() != self.file_id:
+                return False
+
+            self._store._add(self.file_id, self._tmp_name, self.compressed)
+            return True
+        finally:
+            self.abort()
+
+    def abort(self):
+        """
+            Discard the upload
+        """
+        self._close()
+        if os.path.exists(self._tmp_name):
+            os.remove(self._tmp_name)
+
+    def _close(self):
+        if not self._fd.closed:
+            if self._writer is not self._fd:
+                self._writer.close()
+            self._fd.close()
+
+
+class FileStore(object):
+    """
+        A content addressed store for the files of the server. Files are stored in directories sharded on the first two
+        pairs of characters of their id and are gzip compressed when compress is set. The ids of all files are indexed in
+        memory when the store is opened, so checking which files exist does not touch the disk.
+
+        Files in the root directory of the store, written by older versions of the server, are still served. migrate
+        moves them into the sharded layout.
+    """
+
+    def __init__(self, path, compress=True, compress_level=6):
+        self.path = path
+        self.compress = compress
+        self.compress_level = compress_level
+        self._index = set()
+        self._legacy = set()
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        self.build_index()
+
+    def build_index(self):
+        """
+            Scan the store and index the ids of all files
+        """
+        self._index = set()
+        self._legacy = set()
+
+        for entry in os.scandir(self.path):
+            if entry.name.startswith("."):
+                continue
+
+            if entry.is_file():
+                self._legacy.add(entry.name)
+            elif entry.is_dir():
+                for shard in os.scandir(entry.path):
+                    if not shard.is_dir():
+                        continue
+
+                    for item in os.scandir(shard.path):
+                        if item.is_file() and not item.name.startswith("."):
+                            self._index.add(self._id_from_name(item.name))
+
+        self._index.update(self._legacy)
+        LOGGER.info("Indexed %d files in %s (%d not migrated)", len(self._index), self.path, len(self._legacy))
+
+    def _id_from_name(self, name):
+        if name.endswith(COMPRESSED_SUFFIX):
+            return name[:-len(COMPRESSED_SUFFIX)]
+        return name
+
+    def _shard_dir(self, file_id):
+        return os.path.join(self.path, file_id[0:2], file_id[2:4])
+
+    def _get_path(self, file_id):
+        """
+            Get the path of a file and whether it is compressed. The path is None when the file is not on disk.
+        """
+        if file_id in self._legacy:
+            return os.path.join(self.path, file_id), False
+
+        path = os.path.join(self._shard_dir(file_id), file_id)
+        if os.path.exists(path + COMPRESSED_SUFFIX):
+            return path + COMPRESSED_SUFFIX, True
+
+        if os.path.exists(path):
+            return path, False
+
+        return None, False
+
+    def __contains__(self, file_id):
+        return file_id in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    @property
+    def unmigrated(self):
+        """
+            The number of files that are still stored in the root directory
+        """
+        return len(self._legacy)
+
+    def missing(self, file_ids):
+        """
+            Return the ids in the given list that are not in the store
+        """
+        return [file_id for file_id in file_ids if file_id not in self._index]
+
+    def open(self, file_id):
+        """
+            Open the file with the given id for reading. Compressed files are decompressed while they are read.
+
+            :raise KeyError The file does not exist
+        """
+        if file_id not in self._index:
+            raise KeyError(file_id)
+
+        path, compressed = self._get_path(file_id)
+        if path is None:
+            LOGGER.warning("File %s is indexed but does not exist on disk", file_id)
+            self._index.discard(file_id)
+            raise KeyError(file_id)
+
+        if compressed:
+            return gzip.open(path, "rb")
+
+        return open(path, "rb")
+
+    def read(self, file_id):
+        """
+            Read the entire content of the file with the given id
+
+            :raise KeyError The file does not exist
+        """
+        with self.open(file_id) as fd:
+            return fd.read()
+
+    def new_upload(self, file_id, verify=True):
+        """
+            Start adding a file to the store
+
+            :param verify Only accept the content when its sha1 hash matches the id
+        """
+        return FileUpload(self, file_id, verify)
+
+    def put(self, file_id, content, verify=True):
+        """
+            Add a file to the store
+
+            :return False when verify is set and the content does not match the id
+        """
+        upload = self.new_upload(file_id, verify)
+        try:
+            upload.write(content)
+        except Exception:
+            upload.abort()
+            raise
+
+        return upload.commit()
+
+    def _add(self, file_id, tmp_name, compressed):
+        shard_dir = self._shard_dir(file_id)
+        if not os.path.exists(shard_dir):
+            os.makedirs(shard_dir)
+
+        file_name = os.path.join(shard_dir, file_id)
+        if compressed:
+            file_name += COMPRESSED_SUFFIX
+
+        os.rename(tmp_name, file_name)
+        self._index.add(file_id)
+
+    def migrate(self):
+        """
+            Move the files in the root of the store into the sharded layout and compress them when compress is set. This
+            should only run when the server is stopped.
+
+            :return The number of migrated files
+        """
+        count = 0
+        for file_id in sorted(self._legacy):
+            path = os.path.join(self.path, file_id)
+            upload = self.new_upload(file_id, verify=False)
+            try:
+                with open(path, "rb") as fd:
+                    chunk = fd.read(CHUNK_SIZE)
+                    while len(chunk) > 0:
+                        upload.write(chunk)
+                        chunk = fd.read(CHUNK_SIZE)
+            except Exception:
+                upload.abort()
+                raise
+
+            upload.commit()
+            self._legacy.remove(file_id)
+            os.remove(path)
+            count += 1
+
+        return count
@@ -20,7 +20,7 @@ import base64
 from collections import defaultdict
 import datetime
 import difflib
-import json
+import io
 import logging
 import os
 import re
@@ -43,6 +43,11 @@ from inmanta import protocol
 from inmanta.ast import type
 from inmanta.resources import Id
 from inmanta.server.agentmanager import AgentManager
+from inmanta.server.cache import ServerCache, LRUCache
+from inmanta.server.compilequeue import CompileQueue, PRIORITY_LOW, PRIORITY_NORMAL, PRIORITY_HIGH
+from inmanta.server.compilerservice import CompilerServicePool
+from inmanta.server.compileoutput import OutputCollector
+from inmanta.server.filestore import FileStore
 from inmanta.server import config as opt
 
 
@@ -50,6 +55,31 @@ LOGGER = logging.getLogger(__name__)
 agent_lock = locks.Lock()
 
 DBLIMIT = 100000
+COMPILE_OUTPUT_PAGE = 1024 * 1024
+
+
+class PhaseTimer(object):
+    """
+        Measure the time spent in the consecutive phases of a (long running) request
+    """
+
+    def __init__(self):
+        self._last = time.time()
+        self._phases = []
+
+    def lap(self, name):
+        """
+            Mark the end of the phase with the given name. The next phase starts now.
+        """
+        now = time.time()
+        self._phases.append((name, now - self._last))
+        self._last = now
+
+    def to_dict(self):
+        return {name: round(duration, 4) for name, duration in self._phases}
+
+    def __str__(self):
+        return ", ".join(["%s=%.3fs" % (name, duration) for name, duration in self._phases])
 
 
 class Server(protocol.ServerEndpoint):
@@ -61,9 +91,14 @@ class Server(protocol.ServerEndpoint):
     """
 
     def __init__(self, io_loop, database_host=None, database_port=None):
-        super().__init__("server", io_loop=io_loop, interval=opt.agent_timeout.get(), hangtime=opt.agent_hangtime.get())
+        super().__init__("server", io_loop=io_loop, interval=opt.agent_timeout.get(), hangtime=opt.agent_hangtime.get(),
+                         max_queue=opt.agent_call_queue_limit.get(), max_batch=opt.agent_call_batch_size.get())
         LOGGER.info("Starting server endpoint")
         self._server_storage = self.check_storage()
+        self._file_store = FileStore(self._server_storage["files"], compress=opt.server_compress_files.get())
+        if self._file_store.unmigrated > 0:
+            LOGGER.warning("%d files are stored in the old flat layout. Run inmanta migrate-files while the server is stopped "
+                           "to move them to the sharded file store.", self._file_store.unmigrated)
 
         self._db = None
         if database_host is None:
@@ -76,6 +111,11 @@ class Server(protocol.ServerEndpoint):
         LOGGER.info("Connected to mongodb database %s on %s:%d", opt.db_name.get(),
                     database_host, database_port)
 
+        self.cache = ServerCache(opt.server_cache_ttl.get())
+        file_cache_size = opt.server_file_cache_size.get()
+        self.file_cache = LRUCache(file_cache_size, max_item_size=file_cache_size // 10)
+        self.diff_cache = LRUCache(opt.server_diff_cache_size.get(), size_of=lambda diff: sum(len(line) for line in diff))
+
         self._fact_expire = opt.server_fact_expire.get()
         self._fact_renew = opt.server_fact_renew.get()
 
@@ -83,19 +123,34 @@ class Server(protocol.ServerEndpoint):
 
         self.schedule(self.renew_expired_facts, self._fact_renew)
         self.schedule(self._purge_versions, opt.server_purge_version_interval.get())
+        self.schedule(self._purge_resource_actions, opt.server_purge_resource_action_interval.get())
+
+        self._compile_queue = CompileQueue(io_loop, self._recompile_environment, workers=opt.server_compile_workers.get(),
+                                           min_interval=opt.server_autrecompile_wait.get())
+        self._compile_stages = {}
+        self._compiler_service = None
+        if opt.server_compiler_service.get():
+            self._compiler_service = CompilerServicePool([sys.executable, os.path.abspath(sys.argv[0]), "compiler-service"])
+        self._purge_status = {"running": False, "started": None, "finished": None, "total": 0, "deleted": 0}
+        # resource versions stored before the agent was stored on them may not have an agent until the migration is done
+        self._agents_migrated = False
+        # serializes storing the attributes of a new version with pruning the unused attributes of its environment
+        self._attribute_locks = defaultdict(locks.Lock)
 
         self._io_loop.add_callback(self._purge_versions)
-
-        self._recompiles = defaultdict(lambda: None)
+        self._io_loop.add_callback(self._migrate_resource_versions)
+        self._io_loop.add_callback(data.ResourceAction.create_indexes)
+        self._io_loop.add_callback(data.DryRunResource.create_indexes)
+        self._io_loop.add_callback(data.ReportOutput.create_indexes)
+        self._io_loop.add_callback(data.ResourceAttributes.create_indexes)
 
         self.agentmanager = AgentManager(self,
                                          autostart=opt.server_autostart_on_start.get(),
-                                         fact_back_off=opt.server_fact_resource_block.get())
+                                         fact_back_off=opt.server_fact_resource_block.get(),
+                                         cache=self.cache)
 
         self.setup_dashboard()
 
-        self.dryrun_lock = locks.Lock()
-
     def new_session(self, sid, tid, endpoint_names, nodename):
         session = protocol.ServerEndpoint.new_session(self, sid, tid, endpoint_names, nodename)
         self.agentmanager.new_session(session)
@@ -112,10 +167,14 @@ class Server(protocol.ServerEndpoint):
     def start(self):
         super().start()
         self.agentmanager.start()
+        self._compile_queue.start()
 
     def stop(self):
         super().stop()
         self.agentmanager.stop()
+        self._compile_queue.stop()
+        if self._compiler_service is not None:
+            self._compiler_service.stop()
         disconnect()
 
     def get_agent_client(self, tid: UUID, endpoint):
@@ -138,22 +197,83 @@ class Server(protocol.ServerEndpoint):
     @gen.coroutine
     def _purge_versions(self):
         """
-            Purge versions from the database
+            Purge versions from the database. The server pauses between two versions, so a large purge does not compete
+            with live traffic. The progress is reported in the server status.
         """
+        if self._purge_status["running"]:
+            LOGGER.debug("Version purge is still running, skipping this run")
+            return
+
+        self._purge_status = {"running": True, "started": datetime.datetime.now().isoformat(), "finished": None,
+                              "total": 0, "deleted": 0}
+        try:
+            n_versions = opt.server_version_to_keep.get()
+            pause = opt.server_purge_version_pause.get()
+
+            delete_list = []
+            purged_envs = []
+            envs = yield data.Environment.objects.find_all()  # @UndefinedVariable
+            for env_item in envs:
+                # get available versions
+                versions = yield (data.ConfigurationModel.objects.filter(released=False,  # @UndefinedVariable
+                                                                         environment=env_item).find_all())
+                if len(versions) > n_versions:
+                    LOGGER.info("Removing %s available versions from environment %s", len(versions) - n_versions,
+                                env_item.uuid)
+                    versions = sorted(versions, key=lambda x: x.version)
+                    delete_list.extend([(env_item.uuid, v) for v in versions[:-n_versions]])
+                    purged_envs.append(env_item)
+
+            self._purge_status["total"] = len(delete_list)
+            for tid, version in delete_list:
+                if self._purge_status["deleted"] > 0 and pause > 0:
+                    yield gen.sleep(pause)
+
+                yield version.delete_cascade()
+                self.cache.invalidate_versions(tid)
+                self._purge_status["deleted"] += 1
+
+            for env_item in purged_envs:
+                with (yield self._attribute_locks[env_item.uuid].acquire()):
+                    yield data.ResourceAttributes.delete_unused(env_item)
+
+        finally:
+            self._purge_status["running"] = False
+            self._purge_status["finished"] = datetime.datetime.now().isoformat()
+
+        if len(delete_list) > 0:
+            LOGGER.info("Purged %d versions", len(delete_list))
+
+    @gen.coroutine
+    def _purge_resource_actions(self):
+        """
+            Apply the retention policy of the resource action log to all environments
+        """
+        max_age = opt.server_resource_action_retention.get()
+        max_count = opt.server_resource_action_keep.get()
+        if max_age <= 0 and max_count <= 0:
+            return
+
         envs = yield data.Environment.objects.find_all()  # @UndefinedVariable
         for env_item in envs:
-            # get available versions
-            n_versions = opt.server_version_to_keep.get()
-            versions = yield data.ConfigurationModel.objects.filter(released=False,  # @UndefinedVariable
-                                                                    environment=env_item).find_all()  # @UndefinedVariable
-            if len(versions) > n_versions:
-                LOGGER.info("Removing %s available versions from environment %s", len(versions) - n_versions, env_item.uuid)
-                version_dict = {x.version: x for x in versions}
-                delete_list = sorted(version_dict.keys())
-                delete_list = delete_list[:-n_versions]
+            count = yield data.ResourceAction.purge(env_item, max_age=max_age, max_count=max_count)
+            if count > 0:
+                LOGGER.info("Removed %d resource actions from environment %s", count, env_item.uuid)
 
-                for v in delete_list:
-                    yield version_dict[v].delete_cascade()
+    @gen.coroutine
+    def _migrate_resource_versions(self):
+        """
+            Store the agent on resource versions created before it was stored, so agents can query on it, and the
+            environment on resource actions created before it was stored, so the retention policy applies to them.
+        """
+        count = yield data.ResourceVersion.set_missing_agents()
+        self._agents_migrated = True
+        if count > 0:
+            LOGGER.info("Stored the agent name on %d existing resource versions", count)
+
+        count = yield data.ResourceAction.set_missing_environments()
+        if count > 0:
+            LOGGER.info("Stored the environment on %d existing resource actions", count)
 
     def check_storage(self):
         """
@@ -201,39 +321,37 @@ class Server(protocol.ServerEndpoint):
         LOGGER.info("Renewing expired parameters")
 
         updated_before = datetime.datetime.now() - datetime.timedelta(0, (self._fact_expire - self._fact_renew))
-        expired_params = yield data.Parameter.objects.filter(updated__lt=updated_before).find_all()  # @UndefinedVariable
+        expired_params, unknown_parameters = yield [
+            data.Parameter.objects.filter(updated__lt=updated_before).limit(DBLIMIT).find_all(),  # @UndefinedVariable
+            data.UnknownParameter.objects.filter(resolved=False).limit(DBLIMIT).find_all()]  # @UndefinedVariable
 
-        LOGGER.debug("Renewing %d expired parameters" % len(expired_params))
+        LOGGER.debug("Renewing %d expired parameters and %d unknown parameters", len(expired_params), len(unknown_parameters))
 
-        for param in expired_params:
-            yield param.load_references()
-            if param.environment is None:
+        # resolve the environments with one query instead of loading the references of each parameter
+        envs = yield data.Environment.objects.limit(DBLIMIT).find_all()  # @UndefinedVariable
+        env_dict = {env._id: env for env in envs}
+
+        resources_per_env = defaultdict(set)
+        for param in expired_params + unknown_parameters:
+            env_id = param.get_field_value("environment")
+            if env_id not in env_dict:
                 LOGGER.warning("Found parameter without environment (%s for resource %s). Deleting it.",
                                param.name, param.resource_id)
                 yield param.delete()
             else:
-                LOGGER.debug("Requesting new parameter value for %s of resource %s in env %s", param.name, param.resource_id,
-                             param.environment.uuid)
-                yield self.agentmanager._request_parameter(param.environment, param.resource_id)
-
-        unknown_parameters = yield data.UnknownParameter.objects.filter(resolved=False).find_all()  # @UndefinedVariable
-        for u in unknown_parameters:
-            yield u.load_references()
-            if u.environment is None:
-                LOGGER.warning("Found unknown parameter without environment (%s for resource %s). Deleting it.",
-                               u.name, u.resource_id)
-                yield u.delete()
-            else:
-                LOGGER.debug("Requesting value for unknown parameter %s of resource %s in env %s", u.name, u.resource_id,
-                             u.environment.uuid)
-                yield self.agentmanager._request_parameter(u.environment, u.resource_id)
+                resources_per_env[env_id].add(param.resource_id)
+
+        for env_id, resource_ids in resources_per_env.items():
+            LOGGER.debug("Requesting new values for parameters of %d resources in env %s", len(resource_ids),
+                         env_dict[env_id].uuid)
+            yield self.agentmanager._request_parameters(env_dict[env_id], resource_ids)
 
         LOGGER.info("Done renewing expired parameters")
 
     @protocol.handle(methods.ParameterMethod.get_param)
     @gen.coroutine
     def get_param(self, tid, id, resource_id=None):
-        env = yield data.Environment.get_uuid(tid)
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
@@ -303,13 +421,13 @@ class Server(protocol.ServerEndpoint):
     @protocol.handle(methods.ParameterMethod.set_param)
     @gen.coroutine
     def set_param(self, tid, id, source, value, resource_id, metadata):
-        env = yield data.Environment.get_uuid(tid)
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
         result = yield self._update_param(env, id, value, source, resource_id, metadata)
         if result:
-            self._async_recompile(tid, False, opt.server_wait_after_param.get())
+            self._async_recompile(tid, False, opt.server_wait_after_param.get(), priority=PRIORITY_LOW)
 
         if resource_id is None:
             resource_id = ""
@@ -322,7 +440,7 @@ class Server(protocol.ServerEndpoint):
     @protocol.handle(methods.ParametersMethod.set_parameters)
     @gen.coroutine
     def set_parameters(self, tid, parameters):
-        env = yield data.Environment.get_uuid(tid)
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
@@ -339,14 +457,14 @@ class Server(protocol.ServerEndpoint):
                 recompile = True
 
         if recompile:
-            self._async_recompile(tid, False, opt.server_wait_after_param.get())
+            self._async_recompile(tid, False, opt.server_wait_after_param.get(), priority=PRIORITY_LOW)
 
         return 200
 
     @protocol.handle(methods.ParameterMethod.list_params)
     @gen.coroutine
     def list_param(self, tid, query):
-        env = yield data.Environment.get_uuid(tid)
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
@@ -366,7 +484,7 @@ class Server(protocol.ServerEndpoint):
     @protocol.handle(methods.FormMethod.put_form)
     @gen.coroutine
     def put_form(self, tid: uuid.UUID, id: str, form: dict):
-        env = yield data.Environment.get_uuid(tid)
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
@@ -393,7 +511,7 @@ class Server(protocol.ServerEndpoint):
     @protocol.handle(methods.FormMethod.get_form)
     @gen.coroutine
     def get_form(self, tid, id):
-        env = yield data.Environment.get_uuid(tid)
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
@@ -407,7 +525,7 @@ class Server(protocol.ServerEndpoint):
     @protocol.handle(methods.FormMethod.list_forms)
     @gen.coroutine
     def list_forms(self, tid):
-        env = yield data.Environment.get_uuid(tid)
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
@@ -418,7 +536,7 @@ class Server(protocol.ServerEndpoint):
     @protocol.handle(methods.FormRecords.list_records)
     @gen.coroutine
     def list_records(self, tid, form_type, include_record):
-        env = yield data.Environment.get_uuid(tid)
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
@@ -442,7 +560,7 @@ class Server(protocol.ServerEndpoint):
     @protocol.handle(methods.FormRecords.get_record)
     @gen.coroutine
     def get_record(self, tid, id):
-        env = yield data.Environment.get_uuid(tid)
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
@@ -456,7 +574,7 @@ class Server(protocol.ServerEndpoint):
     @protocol.handle(methods.FormRecords.update_record)
     @gen.coroutine
     def update_record(self, tid, id, form):
-        f1 = data.Environment.get_uuid(tid)
+        f1 = self.cache.get_environment(tid)
         f2 = data.FormRecord.get_uuid(id)
         env, record = yield [f1, f2]
 
@@ -489,7 +607,7 @@ class Server(protocol.ServerEndpoint):
     @protocol.handle(methods.FormRecords.create_record)
     @gen.coroutine
     def create_record(self, tid, form_type, form):
-        env = yield data.Environment.get_uuid(tid)
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
@@ -525,7 +643,7 @@ class Server(protocol.ServerEndpoint):
     @protocol.handle(methods.FormRecords.delete_record)
     @gen.coroutine
     def delete_record(self, tid, id):
-        env = yield data.Environment.get_uuid(tid)
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
@@ -537,37 +655,101 @@ class Server(protocol.ServerEndpoint):
     @protocol.handle(methods.FileMethod.upload_file)
     @gen.coroutine
     def upload_file(self, id, content):
-        file_name = os.path.join(self._server_storage["files"], id)
-
-        if os.path.exists(file_name):
+        if id in self._file_store:
             return 500, {"message": "A file with this id already exists."}
 
-        with open(file_name, "wb+") as fd:
-            fd.write(base64.b64decode(content))
-
+        self._file_store.put(id, base64.b64decode(content), verify=False)
         return 200
 
     @protocol.handle(methods.FileMethod.stat_file)
     @gen.coroutine
     def stat_file(self, id):
-        file_name = os.path.join(self._server_storage["files"], id)
-
-        if os.path.exists(file_name):
+        if id in self._file_store:
             return 200
         else:
             return 404
 
+    def _read_file(self, file_id):
+        """
+            Read a file through the file cache
+
+            :raise KeyError The file does not exist
+        """
+        hit, content = self.file_cache.get(file_id)
+        if not hit:
+            content = self._file_store.read(file_id)
+            self.file_cache.put(file_id, content)
+
+        return content
+
     @protocol.handle(methods.FileMethod.get_file)
     @gen.coroutine
     def get_file(self, id):
-        file_name = os.path.join(self._server_storage["files"], id)
+        try:
+            content = self._read_file(id)
+        except KeyError:
+            return 404
+
+        return 200, {"content": base64.b64encode(content).decode("ascii")}
+
+    @protocol.handle(methods.FileStreamMethod.upload_file_stream)
+    @gen.coroutine
+    def upload_file_stream(self, id, stream):
+        if id in self._file_store:
+            return 500, {"message": "A file with this id already exists."}
+
+        upload = self._file_store.new_upload(id)
+        try:
+            chunk = yield stream.read()
+            while len(chunk) > 0:
+                upload.write(chunk)
+                chunk = yield stream.read()
+        except protocol.StreamAborted as e:
+            upload.abort()
+            LOGGER.warning("Upload of file %s was aborted: %s", id, e)
+            return 400, {"message": "The upload was aborted"}
+        except Exception:
+            upload.abort()
+            raise
+
+        if not upload.commit():
+            return 400, {"message": "The content of the file does not match its hash %s" % id}
+
+        return 200
+
+    @protocol.handle(methods.FileStreamMethod.get_file_stream)
+    @gen.coroutine
+    def get_file_stream(self, id, stream):
+        hit, content = self.file_cache.get(id)
+        if hit:
+            for i in range(0, len(content), protocol.STREAM_CHUNK_SIZE):
+                yield stream.write(content[i:i + protocol.STREAM_CHUNK_SIZE])
+            return 200
 
-        if not os.path.exists(file_name):
+        try:
+            fd = self._file_store.open(id)
+        except KeyError:
             return 404
 
-        else:
-            with open(file_name, "rb") as fd:
-                return 200, {"content": base64.b64encode(fd.read()).decode("ascii")}
+        # keep the chunks of small files to add them to the cache
+        chunks = []
+        size = 0
+        with fd:
+            chunk = fd.read(protocol.STREAM_CHUNK_SIZE)
+            while len(chunk) > 0:
+                size += len(chunk)
+                if chunks is not None:
+                    chunks.append(chunk)
+                    if size > self.file_cache.max_item_size:
+                        chunks = None
+
+                yield stream.write(chunk)
+                chunk = fd.read(protocol.STREAM_CHUNK_SIZE)
+
+        if chunks is not None:
+            self.file_cache.put(id, b"".join(chunks))
+
+        return 200
 
     @protocol.handle(methods.FileMethod.stat_files)
     @gen.coroutine
@@ -575,46 +757,47 @@ class Server(protocol.ServerEndpoint):
         """
             Return which files in the list exist on the server
         """
-        response = []
-        for f in files:
-            f_path = os.path.join(self._server_storage["files"], f)
-            if not os.path.exists(f_path):
-                response.append(f)
+        return 200, {"files": self._file_store.missing(files)}
+
+    def _read_lines(self, file_id):
+        """
+            Read a file of the file store as a list of lines. Returns None when the file does not exist.
+        """
+        try:
+            content = self._read_file(file_id)
+        except KeyError:
+            return None
 
-        return 200, {"files": response}
+        return io.TextIOWrapper(io.BytesIO(content)).readlines()
 
     @protocol.handle(methods.FileDiff.diff)
     @gen.coroutine
     def file_diff(self, a, b):
         """
-            Diff the two files identified with the two hashes
+            Diff the two files identified with the two hashes. Files never change, so diffs are cached on the pair of
+            hashes.
         """
+        hit, diff = self.diff_cache.get((a, b))
+        if hit:
+            return 200, {"diff": diff}
+
         if a == "" or a == "0":
             a_lines = []
         else:
-            a_path = os.path.join(self._server_storage["files"], a)
-            if not os.path.exists(a_path):
+            a_lines = self._read_lines(a)
+            if a_lines is None:
                 return 404
 
-            with open(a_path, "r") as fd:
-                a_lines = fd.readlines()
-
         if b == "" or b == "0":
             b_lines = []
         else:
-            b_path = os.path.join(self._server_storage["files"], b)
-            if not os.path.exists(b_path):
+            b_lines = self._read_lines(b)
+            if b_lines is None:
                 return 404
 
-            with open(b_path, "r") as fd:
-                b_lines = fd.readlines()
-
-        try:
-            diff = difflib.unified_diff(a_lines, b_lines, fromfile=a, tofile=b)
-        except FileNotFoundError:
-            return 404
-
-        return 200, {"diff": list(diff)}
+        diff = list(difflib.unified_diff(a_lines, b_lines, fromfile=a, tofile=b))
+        self.diff_cache.put((a, b), diff)
+        return 200, {"diff": diff}
 
     @protocol.handle(methods.NodeMethod.get_agent_process)
     @gen.coroutine
@@ -644,7 +827,7 @@ class Server(protocol.ServerEndpoint):
     @protocol.handle(methods.ResourceMethod.get_resource)
     @gen.coroutine
     def get_resource(self, tid, id, logs, status):
-        env = yield data.Environment.get_uuid(tid)
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
         # @UndefinedVariable
@@ -653,6 +836,8 @@ class Server(protocol.ServerEndpoint):
         if len(resv) == 0:
             return 404, {"message": "The resource with the given id does not exist in the given environment"}
 
+        yield data.ResourceVersion.load_attributes(env, resv)
+
 #         ra = data.ResourceAction(resource_version=resv[0], action="pull", level="INFO", timestamp=datetime.datetime.now(),
 #                                  message="Individual resource version pulled by client")
 #         yield ra.save()
@@ -671,19 +856,18 @@ class Server(protocol.ServerEndpoint):
 
     @protocol.handle(methods.ResourceMethod.get_resources_for_agent)
     @gen.coroutine
-    def get_resources_for_agent(self, tid, agent, version):
-        env = yield data.Environment.get_uuid(tid)
+    def get_resources_for_agent(self, tid, agent, version, known_version=None):
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
         if version is None:
-            versions = yield (data.ConfigurationModel.objects.filter(environment=env, released=True).  # @UndefinedVariable
-                              order_by("version", direction=DESCENDING).limit(1).find_all())  # @UndefinedVariable
-
-            if len(versions) == 0:
+            cm = yield self.cache.get_latest_version(env)
+            if cm is None:
                 return 404
 
-            cm = versions[0]
+            if known_version is not None and known_version == cm.version:
+                return 304
 
         else:
             versions = yield (data.ConfigurationModel.objects.filter(environment=env, version=version).  # @UndefinedVariable
@@ -693,18 +877,21 @@ class Server(protocol.ServerEndpoint):
 
             cm = versions[0]
 
-        deploy_model = []
-        # @UndefinedVariable
-        resources = yield data.ResourceVersion.objects.filter(environment=env, model=cm).limit(DBLIMIT).find_all()
-
-        for rv in resources:
-            rv_dict = rv.to_dict()
-
-            if rv_dict["id_fields"]["agent_name"] == agent:
-                deploy_model.append(rv_dict)
-                ra = data.ResourceAction(resource_version=rv, action="pull", level="INFO", timestamp=datetime.datetime.now(),
-                                         message="Resource version pulled by client for agent %s state" % agent)
-                yield ra.save()
+        resources = yield (data.ResourceVersion.objects.filter(environment=env, model=cm, agent=agent)  # @UndefinedVariable
+                           .limit(DBLIMIT).find_all())
+        if not self._agents_migrated:
+            missing = yield (data.ResourceVersion.objects.filter(environment=env, model=cm,  # @UndefinedVariable
+                                                                 agent__exists=False).limit(DBLIMIT).find_all())
+            resources.extend([rv for rv in missing if Id.parse_id(rv.rid).get_agent_name() == agent])
+        yield data.ResourceVersion.load_attributes(env, resources)
+        deploy_model = [rv.to_dict() for rv in resources]
+
+        if len(resources) > 0:
+            now = datetime.datetime.now()
+            message = "Resource version pulled by client for agent %s state" % agent
+            ra_list = [data.ResourceAction(environment=env, resource_version=rv, action="pull", level="INFO", timestamp=now,
+                                           message=message) for rv in resources]
+            yield data.ResourceAction.objects.bulk_insert(ra_list)  # @UndefinedVariable
 
         return 200, {"environment": tid, "agent": agent, "version": cm.version, "resources": deploy_model}
 
@@ -714,20 +901,24 @@ class Server(protocol.ServerEndpoint):
         if (start is None and limit is not None) or (limit is None and start is not None):
             return 500, {"message": "Start and limit should always be set together."}
 
-        env = yield data.Environment.get_uuid(tid)
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
-        models = yield (data.ConfigurationModel.objects.filter(environment=env).  # @UndefinedVariable
-                        order_by("version", direction=DESCENDING).find_all())  # @UndefinedVariable
-        count = len(models)
-
+        # the per resource status is not needed in the list and grows with the size of the model
+        query = (data.ConfigurationModel.objects.filter(environment=env).exclude("status").  # @UndefinedVariable
+                 order_by("version", direction=DESCENDING))
         if start is not None:
-            models = models[int(start):int(limit) + int(start)]
+            query = query.skip(int(start)).limit(int(limit))
+        else:
+            query = query.limit(DBLIMIT)
+
+        models, count = yield [query.find_all(),
+                               data.ConfigurationModel.objects.filter(environment=env).count()]  # @UndefinedVariable
 
         d = {"versions": []}
         for m in models:
-            model_dict = yield m.to_dict()
+            model_dict = yield m.to_dict(environment=env)
             d["versions"].append(model_dict)
 
         if start is not None:
@@ -740,8 +931,11 @@ class Server(protocol.ServerEndpoint):
 
     @protocol.handle(methods.CMVersionMethod.get_version)
     @gen.coroutine
-    def get_version(self, tid, id, include_logs=None, log_filter=None, limit=None):
-        env = yield data.Environment.get_uuid(tid)
+    def get_version(self, tid, id, include_logs=None, log_filter=None, limit=None, resource_start=None, resource_limit=None):
+        if (resource_start is None) != (resource_limit is None):
+            return 500, {"message": "resource_start and resource_limit should always be set together."}
+
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
@@ -749,31 +943,42 @@ class Server(protocol.ServerEndpoint):
         if version is None:
             return 404, {"message": "The given configuration model does not exist yet."}
 
-        resources = yield data.ResourceVersion.objects.filter(model=version).limit(DBLIMIT).find_all()  # @UndefinedVariable
+        query = data.ResourceVersion.objects.filter(model=version)  # @UndefinedVariable
+        if resource_start is not None:
+            query = query.order_by("rid").skip(int(resource_start)).limit(int(resource_limit))
+            # the status of all resources in the version, not only the requested ones
+            statuses = yield (data.ResourceVersion.objects.filter(model=version).only("rid", "status")  # @UndefinedVariable
+                              .limit(DBLIMIT).find_all())
+        else:
+            query = query.limit(DBLIMIT)
+
+        resources = yield query.find_all()
+        if resource_start is None:
+            statuses = resources
+
+        yield data.ResourceVersion.load_attributes(env, resources)
 
-        version_dict = yield version.to_dict()
+        version_dict = yield version.to_dict(environment=env)
+        version_dict["status"] = {res.rid: res.status for res in statuses if res.status != ""}
         d = {"model": version_dict}
 
+        if bool(include_logs):
+            action_limit = int(limit) if limit is not None else None
+            actions = yield data.ResourceAction.get_for_resource_versions(resources, action=log_filter, limit=action_limit)
+
         d["resources"] = []
         for res in resources:
             res_dict = res.to_dict()
 
             if bool(include_logs):
-                if log_filter is not None:
-                    actions = yield (data.ResourceAction.objects.filter(resource_version=res,  # @UndefinedVariable
-                                                                        action=log_filter)
-                                     .order_by("timestamp", direction=DESCENDING).find_all())  # @UndefinedVariable
-                else:
-                    actions = yield (data.ResourceAction.objects.filter(resource_version=res)  # @UndefinedVariable
-                                     .order_by("timestamp", direction=DESCENDING).find_all())  # @UndefinedVariable
-
-                if limit is not None:
-                    actions = actions[0:int(limit)]
-
-                res_dict["actions"] = [x.to_dict() for x in actions]
+                res_dict["actions"] = [x.to_dict() for x in actions.get(res._id, [])]
 
             d["resources"].append(res_dict)
 
+        if resource_start is not None:
+            d["resource_start"] = resource_start
+            d["resource_limit"] = resource_limit
+
         unp = yield (data.UnknownParameter.objects.  # @UndefinedVariable
                      filter(environment=env, version=version.version).find_all())  # @UndefinedVariable
         d["unknowns"] = [x.to_dict() for x in unp]
@@ -783,7 +988,7 @@ class Server(protocol.ServerEndpoint):
     @protocol.handle(methods.CMVersionMethod.delete_version)
     @gen.coroutine
     def delete_version(self, tid, id):
-        env = yield data.Environment.get_uuid(tid)
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
@@ -792,12 +997,15 @@ class Server(protocol.ServerEndpoint):
             return 404, {"message": "The given configuration model does not exist yet."}
 
         yield version.delete()
+        self.cache.invalidate_versions(tid)
         return 200
 
     @protocol.handle(methods.CMVersionMethod.put_version)
     @gen.coroutine
     def put_version(self, tid, version, resources, unknowns, version_info):
-        env = yield data.Environment.get_uuid(tid)
+        timer = PhaseTimer()
+
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
@@ -810,22 +1018,24 @@ class Server(protocol.ServerEndpoint):
         yield cm.save()
 
         # Force motorengine to create the indexes required to speed up this operation
-        yield data.ResourceVersion.objects.ensure_index()  # @UndefinedVariable
-        yield data.Resource.objects.ensure_index()  # @UndefinedVariable
-        yield data.ResourceAction.objects.ensure_index()  # @UndefinedVariable
-        yield data.UnknownParameter.objects.ensure_index()  # @UndefinedVariable
-
-        all_resources = yield data.Resource.objects.filter(environment=env).find_all()  # @UndefinedVariable
+        yield [data.ResourceVersion.objects.ensure_index(),  # @UndefinedVariable
+               data.Resource.objects.ensure_index(),  # @UndefinedVariable
+               data.ResourceAttributes.objects.ensure_index(),  # @UndefinedVariable
+               data.ResourceAction.objects.ensure_index(),  # @UndefinedVariable
+               data.UnknownParameter.objects.ensure_index()]  # @UndefinedVariable
+        timer.lap("setup")
+
+        all_resources = yield data.Resource.objects.filter(environment=env).limit(DBLIMIT).find_all()  # @UndefinedVariable
         resources_dict = {x.resource_id: x for x in all_resources}
+        timer.lap("load")
 
         agents = set()
-        rv_list = []
-
-        ra_list = []
-        # lookup for all RV's, lookup by resource id
-        rv_dict = {}
-        # list of all resources which have a cross agent dependency, as a tuple, (dependant,requires)
-        cross_agent_dep = []
+        # resources that do not exist yet, that already exist and that already exist but start to hold state
+        new_resources = []
+        updated = []
+        new_stateful = []
+        # full id, id object, attributes and resource document of each resource in this version
+        parsed = []
 
         for res_dict in resources:
             # parse and extract ID
@@ -836,18 +1046,20 @@ class Server(protocol.ServerEndpoint):
             agents.add(resource_obj.get_agent_name())
 
             # does this resource already exists
-            if resource_id in resources_dict:
-                # update it
+            exists = resource_id in resources_dict
+            if exists:
                 res_obj = resources_dict[resource_id]
                 res_obj.version_latest = version
+                updated.append(resource_id)
 
             else:
-                # create it
                 res_obj = data.Resource(environment=env, resource_id=resource_id,
                                         resource_type=resource_obj.get_entity_type(),
                                         agent=resource_obj.get_agent_name(),
                                         attribute_name=resource_obj.get_attribute(),
                                         attribute_value=resource_obj.get_attribute_value(), version_latest=version)
+                resources_dict[resource_id] = res_obj
+                new_resources.append(res_obj)
 
             # for state handling
             if "state_id" in res_dict:
@@ -855,24 +1067,77 @@ class Server(protocol.ServerEndpoint):
                     res_dict["state_id"] = resource_id
                 if not res_obj.holds_state:
                     res_obj.holds_state = True
-
-            # save it
-            yield res_obj.save()
+                    if exists:
+                        new_stateful.append(resource_id)
 
             attributes = {}
             for field, value in res_dict.items():
                 if field != "id":
                     attributes[field] = value
 
-            rv = data.ResourceVersion(environment=env, rid=res_dict['id'], resource=res_obj, model=cm, attributes=attributes)
+            parsed.append((res_dict['id'], resource_obj, attributes, res_obj))
+
+        # search for deleted resources with purge_on_delete set, based on the last version they were part of
+        deleted = {"%s,v=%s" % (res.resource_id, res.version_latest): res for res in all_resources
+                   if res.version_latest < version}
+        purged = []
+        if len(deleted) > 0:
+            previous = yield (data.ResourceVersion.objects.filter(environment=env,  # @UndefinedVariable
+                                                                  rid__in=list(deleted.keys()))
+                              .limit(DBLIMIT).find_all())
+            yield data.ResourceVersion.load_attributes(env, previous)
+            for rv in previous:
+                if "purge_on_delete" in rv.attributes and rv.attributes["purge_on_delete"]:
+                    res = deleted[rv.rid]
+                    LOGGER.warning("Purging %s, purged resource based on %s" % (res.resource_id, rv.rid))
+
+                    res.version_latest = version
+                    updated.append(res.resource_id)
+                    attributes = rv.attributes.copy()
+                    attributes["purged"] = "true"
+                    # TODO: handle delete relations
+                    attributes["requires"] = []
+                    purged.append((res, attributes))
+        timer.lap("parse")
+
+        # upsert the resources: insert all new resources and bump the latest version of all others in one operation
+        if len(new_resources) > 0:
+            yield data.Resource.objects.bulk_insert(new_resources)  # @UndefinedVariable
+
+        if len(updated) > 0:
+            yield (data.Resource.objects.filter(environment=env, resource_id__in=updated)  # @UndefinedVariable
+                   .update({"version_latest": version}))
+
+        if len(new_stateful) > 0:
+            yield (data.Resource.objects.filter(environment=env, resource_id__in=new_stateful)  # @UndefinedVariable
+                   .update({"holds_state": True}))
+        timer.lap("resources")
+
+        rv_list = []
+        # lookup for all RV's, lookup by resource id
+        rv_dict = {}
+        # list of all resources which have a cross agent dependency, as a tuple, (dependant,requires)
+        cross_agent_dep = []
+        now = datetime.datetime.now()
+
+        # the attributes are stored once for each distinct content, resource versions refer to them by hash
+        attribute_list = []
+
+        def store_attributes(attributes):
+            normalized = data.ResourceAttributes.normalize(attributes, version)
+            attribute_hash = data.ResourceAttributes.hash_attributes(normalized)
+            attribute_list.append((attribute_hash, normalized))
+            return attribute_hash
+
+        for full_id, resource_obj, attributes, res_obj in parsed:
+            resource_id = resource_obj.resource_str()
+            agent = resource_obj.get_agent_name()
+            rv = data.ResourceVersion(environment=env, rid=full_id, resource=res_obj, model=cm, agent=agent,
+                                      attribute_hash=store_attributes(attributes))
             rv_list.append(rv)
             rv_dict[resource_id] = rv
 
-            ra = data.ResourceAction(resource_version=rv, action="store", level="INFO", timestamp=datetime.datetime.now())
-            ra_list.append(ra)
-
             # find cross agent dependencies
-            agent = resource_obj.get_agent_name()
             if "requires" not in attributes:
                 LOGGER.warning("Received resource without requires attribute (%s)" % resource_id)
             else:
@@ -882,44 +1147,35 @@ class Server(protocol.ServerEndpoint):
                         # it is a CAD
                         cross_agent_dep.append((resource_obj, rid))
 
+        for res, attributes in purged:
+            rv_list.append(data.ResourceVersion(environment=env, rid="%s,v=%s" % (res.resource_id, version),
+                                                resource=res, model=cm, agent=res.agent,
+                                                attribute_hash=store_attributes(attributes)))
+
         # hook up all CAD's
         for f, t in cross_agent_dep:
             rv_dict[t.resource_str()].provides.append(str(f))
 
-        if len(rv_list) > 0:
-            yield data.ResourceVersion.objects.bulk_insert(rv_list)  # @UndefinedVariable
+        # attributes that already exist are not stored again, so they must not be pruned before the new resource versions
+        # that use them are stored
+        with (yield self._attribute_locks[env.uuid].acquire()):
+            yield data.ResourceAttributes.store(env, attribute_list)
+            timer.lap("attributes")
+
+            if len(rv_list) > 0:
+                yield data.ResourceVersion.objects.bulk_insert(rv_list)  # @UndefinedVariable
 
-        if len(ra_list) > 0:
+        if len(rv_list) > 0:
+            ra_list = [data.ResourceAction(environment=env, resource_version=rv, action="store", level="INFO", timestamp=now)
+                       for rv in rv_list]
             yield data.ResourceAction.objects.bulk_insert(ra_list)  # @UndefinedVariable
 
-        # search for deleted resources
-        for res in all_resources:
-            if res.version_latest < version:
-                rv = yield (data.ResourceVersion.objects.filter(environment=env, resource=res).  # @UndefinedVariable
-                            order_by("rid", direction=DESCENDING).limit(1).find_all())  # @UndefinedVariable
-                if len(rv) > 0:
-                    rv = rv[0]
-                    if "purge_on_delete" in rv.attributes and rv.attributes["purge_on_delete"]:
-                        LOGGER.warning("Purging %s, purged resource based on %s" % (res.resource_id, rv.rid))
-
-                        res.version_latest = version
-                        yield res.save()
-
-                        attributes = rv.attributes.copy()
-                        attributes["purged"] = "true"
-                        # TODO: handle delete relations
-                        attributes["requires"] = []
-                        rv = data.ResourceVersion(environment=env, rid="%s,v=%s" % (res.resource_id, version),
-                                                  resource=res, model=cm, attributes=attributes)
-                        yield rv.save()
-
-                        ra = data.ResourceAction(resource_version=rv, action="store", level="INFO",
-                                                 timestamp=datetime.datetime.now())
-                        yield ra.save()
-
-                        cm.resources_total += 1
-                        yield cm.save()
+        if len(purged) > 0:
+            cm.resources_total += len(purged)
+            yield cm.save()
+        timer.lap("versions")
 
+        up_list = []
         for uk in unknowns:
             if "resource" not in uk:
                 uk["resource"] = ""
@@ -927,21 +1183,26 @@ class Server(protocol.ServerEndpoint):
             if "metadata" not in uk:
                 uk["metadata"] = {}
 
-            up = data.UnknownParameter(resource_id=uk["resource"], name=uk["parameter"], source=uk["source"], environment=env,
-                                       version=version, metadata=uk["metadata"])
-            yield up.save()
+            up_list.append(data.UnknownParameter(resource_id=uk["resource"], name=uk["parameter"], source=uk["source"],
+                                                 environment=env, version=version, metadata=uk["metadata"]))
+
+        if len(up_list) > 0:
+            yield data.UnknownParameter.objects.bulk_insert(up_list)  # @UndefinedVariable
+        timer.lap("unknowns")
 
         for agent in agents:
             yield self.agentmanager.ensure_agent_registered(env, agent)
+        timer.lap("agents")
 
-        LOGGER.debug("Successfully stored version %d" % version)
+        self.cache.invalidate_versions(tid)
+        LOGGER.debug("Successfully stored version %d (%s)", version, timer)
 
-        return 200
+        return 200, {"timings": timer.to_dict()}
 
     @protocol.handle(methods.CMVersionMethod.release_version)
     @gen.coroutine
     def release_version(self, tid, id, push):
-        env = yield data.Environment.get_uuid(tid)
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
@@ -952,14 +1213,13 @@ class Server(protocol.ServerEndpoint):
         model.released = True
         model.result = "deploying"
         yield model.save()
+        self.cache.invalidate_versions(tid)
 
         if push:
             # fetch all resource in this cm and create a list of distinct agents
-            rvs = yield data.ResourceVersion.objects.filter(model=model, environment=env).find_all()  # @UndefinedVariable
-            agents = set()
-            for rv in rvs:
-                rv_dict = rv.to_dict()
-                agents.add(rv_dict["id_fields"]["agent_name"])
+            rvs = (yield data.ResourceVersion.objects.filter(model=model, environment=env).  # @UndefinedVariable
+                   only("agent").limit(DBLIMIT).find_all())
+            agents = set([rv.agent for rv in rvs])
 
             yield self.agentmanager._ensure_agents(str(tid), agents)
 
@@ -978,7 +1238,7 @@ class Server(protocol.ServerEndpoint):
     @protocol.handle(methods.DryRunMethod.dryrun_request)
     @gen.coroutine
     def dryrun_request(self, tid, id):
-        env = yield data.Environment.get_uuid(tid)
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
@@ -996,10 +1256,7 @@ class Server(protocol.ServerEndpoint):
         dryrun.resource_total = len(rvs)
         dryrun.resource_todo = dryrun.resource_total
 
-        agents = set()
-        for rv in rvs:
-            rv_dict = rv.to_dict()
-            agents.add(rv_dict["id_fields"]["agent_name"])
+        agents = set([rv.agent for rv in rvs])
 
         yield self.agentmanager._ensure_agents(str(tid), agents)
 
@@ -1021,7 +1278,7 @@ class Server(protocol.ServerEndpoint):
     @gen.coroutine
     def dryrun_list(self, tid, version=None):
         query_args = {}
-        env = yield data.Environment.get_uuid(tid)
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
@@ -1045,8 +1302,8 @@ class Server(protocol.ServerEndpoint):
 
     @protocol.handle(methods.DryRunMethod.dryrun_report)
     @gen.coroutine
-    def dryrun_report(self, tid, id):
-        env = yield data.Environment.get_uuid(tid)
+    def dryrun_report(self, tid, id, resource_start=None, resource_limit=None):
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
@@ -1054,39 +1311,34 @@ class Server(protocol.ServerEndpoint):
         if dryrun is None:
             return 404, {"message": "The given dryrun does not exist!"}
 
-        dryrun_dict = yield dryrun.to_dict()
+        dryrun_dict = yield dryrun.to_dict(resource_start=resource_start if resource_start is not None else 0,
+                                           resource_limit=resource_limit)
         return 200, {"dryrun": dryrun_dict}
 
     @protocol.handle(methods.DryRunMethod.dryrun_update)
     @gen.coroutine
     def dryrun_update(self, tid, id, resource, changes, log_msg=None):
-        env = yield data.Environment.get_uuid(tid)
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
-        with (yield self.dryrun_lock.acquire()):
-            dryrun = yield data.DryRun.get_uuid(id)
-            if dryrun is None:
-                return 404, {"message": "The given dryrun does not exist!"}
-
-            if resource in dryrun.resources:
-                return 500, {"message": "A dryrun was already stored for this resource."}
+        dryrun = yield data.DryRun.get_uuid(id)
+        if dryrun is None:
+            return 404, {"message": "The given dryrun does not exist!"}
 
-            payload = {"changes": changes,
-                       "log": log_msg,
-                       "id_fields": Id.parse_id(resource).to_dict()
-                       }
+        if dryrun.resources is not None and resource in dryrun.resources:
+            return 500, {"message": "A dryrun was already stored for this resource."}
 
-            dryrun.resources[resource] = payload
-            dryrun.resource_todo -= 1
-            yield dryrun.save()
+        stored = yield dryrun.add_result(resource, changes, log_msg)
+        if not stored:
+            return 500, {"message": "A dryrun was already stored for this resource."}
 
         return 200
 
     @protocol.handle(methods.CodeMethod.upload_code)
     @gen.coroutine
     def upload_code(self, tid, id, resource, sources):
-        env = yield data.Environment.get_uuid(tid)
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
@@ -1102,7 +1354,7 @@ class Server(protocol.ServerEndpoint):
     @protocol.handle(methods.CodeMethod.get_code)
     @gen.coroutine
     def get_code(self, tid, id, resource):
-        env = yield data.Environment.get_uuid(tid)
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
@@ -1115,7 +1367,7 @@ class Server(protocol.ServerEndpoint):
     @protocol.handle(methods.ResourceMethod.resource_updated)
     @gen.coroutine
     def resource_updated(self, tid, id, level, action, message, status, extra_data):
-        env = yield data.Environment.get_uuid(tid)
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
@@ -1124,38 +1376,19 @@ class Server(protocol.ServerEndpoint):
             return 404, {"message": "The resource with the given id does not exist in the given environment"}
 
         resv = resv[0]
-        resv.status = status
-        yield resv.save()
-
-        extra_data = json.dumps(extra_data)
+        old_status = yield resv.set_status(status)
 
         now = datetime.datetime.now()
-        ra = data.ResourceAction(resource_version=resv, action=action, message=message, data=extra_data, level=level,
-                                 timestamp=now, status=status)
+        ra = data.ResourceAction(environment=env, resource_version=resv, action=action, message=message,
+                                 data=data.ResourceAction.encode_data(extra_data), level=level, timestamp=now, status=status)
         yield ra.save()
 
-        with (yield agent_lock.acquire()):
-            yield resv.load_references()
-            model = resv.model
-            rid = resv.rid
-            if rid not in model.status:
-                model.resources_done += 1
-
-            model.status[rid] = status
-            yield model.save()
-
-        resv.resource.version_deployed = model.version
-        resv.resource.last_deploy = now
-        yield resv.resource.save()
-
-        if model.resources_done == model.resources_total:
-            model.result = "success"
-            for status in model.status:
-                if status != "deployed":
-                    model.result = "failed"
-
-            model.deployed = True
-            yield model.save()
+        res_id = Id.parse_id(id)
+        deployed = yield data.ConfigurationModel.update_progress(env, res_id.get_version(), old_status, status)
+        if deployed:
+            self.cache.invalidate_versions(tid)
+        yield data.Resource.objects.filter(environment=env, resource_id=res_id.resource_str()).update(  # @UndefinedVariable
+            {"version_deployed": res_id.get_version(), "last_deploy": now})
 
         waitingagents = set([Id.parse_id(prov).get_agent_name() for prov in resv.provides])
 
@@ -1164,6 +1397,17 @@ class Server(protocol.ServerEndpoint):
 
         return 200
 
+    @protocol.handle(methods.ServerStatus.get_server_status)
+    @gen.coroutine
+    def get_server_status(self):
+        caches = self.cache.to_dict()
+        caches["files"] = self.file_cache.to_dict()
+        caches["diffs"] = self.diff_cache.to_dict()
+        sessions = {str(sid): session.get_queue_stats() for sid, session in self._sessions.items()}
+        return 200, {"cache": caches, "purge": self._purge_status, "compiles": self._compile_queue.to_dict(),
+                     "compiler_service": self._compiler_service.to_dict() if self._compiler_service is not None else None,
+                     "sessions": sessions}
+
     # Project handlers
     @protocol.handle(methods.Project.create_project)
     @gen.coroutine
@@ -1277,6 +1521,7 @@ class Server(protocol.ServerEndpoint):
             env.repo_branch = branch
 
         yield env.save()
+        self.cache.invalidate_environment(id)
         return 200, {"environment": env.to_dict()}
 
     @protocol.handle(methods.Environment.get_environment)
@@ -1324,22 +1569,19 @@ class Server(protocol.ServerEndpoint):
         if env is None:
             return 404, {"message": "The environment with given id does not exist."}
 
-        agents = yield data.Agent.objects.filter(environment=env).find_all()  # @UndefinedVariable
-        for agent in agents:
-            yield agent.delete()
-
-        compiles = yield data.Compile.objects.filter(environment=env).find_all()  # @UndefinedVariable
-        for compile in compiles:
-            yield compile.delete()
+        yield [data.Agent.objects.filter(environment=env).delete(),  # @UndefinedVariable
+               data.Compile.objects.filter(environment=env).delete(),  # @UndefinedVariable
+               data.ReportOutput.objects.filter(environment=env).delete()]  # @UndefinedVariable
 
         yield env.delete_cascade()
+        self.cache.invalidate_environment(id)
 
         return 200
 
     @protocol.handle(methods.NotifyMethod.is_compiling)
     @gen.coroutine
     def is_compiling(self, id):
-        if self._recompiles[id] is self:
+        if self._compile_queue.is_compiling(id):
             return 200
 
         return 204
@@ -1348,33 +1590,20 @@ class Server(protocol.ServerEndpoint):
     @gen.coroutine
     def notify_change(self, id, update):
         LOGGER.info("Received change notification for environment %s", id)
-        self._async_recompile(id, update > 0)
+        self._async_recompile(id, update > 0, priority=PRIORITY_HIGH)
 
         return 200
 
-    def _async_recompile(self, environment_id, update_repo, wait=0):
+    def _async_recompile(self, environment_id, update_repo, wait=0, priority=PRIORITY_NORMAL):
         """
-            Recompile an environment in a different thread and taking wait time into account.
+            Queue a recompile of an environment. A request for an environment that is already queued or compiling results
+            in one follow-up compile.
         """
         if opt.server_no_recompile.get():
             LOGGER.info("Skipping compile due to no-recompile=True")
             return
-        last_recompile = self._recompiles[environment_id]
-        wait_time = opt.server_autrecompile_wait.get()
-        if last_recompile is self:
-            LOGGER.info("Already recompiling")
-            return
 
-        if last_recompile is None or (datetime.datetime.now() - datetime.timedelta(0, wait_time)) > last_recompile:
-            if last_recompile is None:
-                LOGGER.info("First recompile")
-            else:
-                LOGGER.info("Last recompile longer than %s ago (last was at %s)", wait_time, last_recompile)
-
-            self._recompiles[environment_id] = self
-            self._io_loop.add_callback(self._recompile_environment, environment_id, update_repo, wait)
-        else:
-            LOGGER.info("Not recompiling, last recompile less than %s ago (last was at %s)", wait_time, last_recompile)
+        self._compile_queue.request(environment_id, update_repo, wait, priority)
 
     def _fork_inmanta(self, args, cwd=None):
         """
@@ -1385,30 +1614,66 @@ class Server(protocol.ServerEndpoint):
                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         return proc
 
+    def _start_stage(self, environment, name, cmd):
+        """
+            Create the report of a compile stage and the collectors that store its output
+        """
+        report = data.Report(uuid=uuid.uuid4(), started=datetime.datetime.now(), name=name, command=" ".join(cmd))
+        limit = opt.server_compile_output_limit.get()
+        out = OutputCollector(environment, report.uuid, "out", limit)
+        err = OutputCollector(environment, report.uuid, "err", limit)
+        self._compile_stages[str(environment.uuid)] = report
+        return report, out, err
+
+    def _end_stage(self, environment, report, out, err, returncode):
+        del self._compile_stages[str(environment.uuid)]
+        report.completed = datetime.datetime.now()
+        report.outsize = out.size
+        report.errsize = err.size
+        report.returncode = returncode
+        return report
+
+    @gen.coroutine
+    def _run_compile_stage(self, environment, name, cmd, cwd, **kwargs):
+        report, out, err = self._start_stage(environment, name, cmd)
+        returncode = None
+        try:
+            sub_process = process.Subprocess(cmd, stdout=process.Subprocess.STREAM, stderr=process.Subprocess.STREAM,
+                                             cwd=cwd, **kwargs)
+
+            returncode, _, _ = yield [sub_process.wait_for_exit(raise_error=False), out.read_from(sub_process.stdout),
+                                      err.read_from(sub_process.stderr)]
+        finally:
+            report = self._end_stage(environment, report, out, err, returncode)
+
+        return report
+
     @gen.coroutine
-    def _run_compile_stage(self, name, cmd, cwd, **kwargs):
-        start = datetime.datetime.now()
+    def _run_compiler_service(self, environment, name, inmanta_path, args, cwd):
+        """
+            Run an inmanta command on a compiler service. The report shows the command as if it ran in its own process. The
+            service sends the output while the command runs, so it is stored as it arrives.
+        """
+        report, out, err = self._start_stage(environment, name, inmanta_path + args)
+        collectors = {"out": out, "err": err}
 
-        sub_process = process.Subprocess(cmd, stdout=process.Subprocess.STREAM, stderr=process.Subprocess.STREAM,
-                                         cwd=cwd, **kwargs)
+        def on_output(stream, output):
+            return collectors[stream].write(output)
 
-        log_out, log_err, returncode = yield [gen.Task(sub_process.stdout.read_until_close),
-                                              gen.Task(sub_process.stderr.read_until_close),
-                                              sub_process.wait_for_exit(raise_error=False)]
-        returncode
+        returncode = None
+        try:
+            returncode, _, _ = yield self._compiler_service.compile(cwd, args, on_output)
+            yield [out.write("", final=True), err.write("", final=True)]
+        finally:
+            report = self._end_stage(environment, report, out, err, returncode)
 
-        stop = datetime.datetime.now()
-        return data.Report(started=start, completed=stop, name=name, command=" ".join(cmd),
-                           errstream=log_err.decode(), outstream=log_out.decode(), returncode=returncode)
+        return report
 
     @gen.coroutine
-    def _recompile_environment(self, environment_id, update_repo=False, wait=0):
+    def _recompile_environment(self, environment_id, update_repo=False):
         """
-            Recompile an environment
+            Recompile an environment. This is called by the compile queue.
         """
-        if wait > 0:
-            yield gen.sleep(wait)
-
         env = yield data.Environment.get_uuid(environment_id)
         if env is None:
             LOGGER.error("Environment %s does not exist.", environment_id)
@@ -1428,14 +1693,15 @@ class Server(protocol.ServerEndpoint):
             # checkout repo
             if not os.path.exists(os.path.join(project_dir, ".git")):
                 LOGGER.info("Cloning repository into environment directory %s", project_dir)
-                result = yield self._run_compile_stage("Cloning repository", ["git", "clone", env.repo_url, "."], project_dir)
+                result = yield self._run_compile_stage(env, "Cloning repository", ["git", "clone", env.repo_url, "."],
+                                                       project_dir)
                 stages.append(result)
                 if result.returncode > 0:
                     return
 
             elif update_repo:
                 LOGGER.info("Fetching changes from repo %s", env.repo_url)
-                result = yield self._run_compile_stage("Fetching changes", ["git", "fetch", env.repo_url], project_dir)
+                result = yield self._run_compile_stage(env, "Fetching changes", ["git", "fetch", env.repo_url], project_dir)
                 stages.append(result)
 
             # verify if branch is correct
@@ -1445,31 +1711,40 @@ class Server(protocol.ServerEndpoint):
             o = re.search("\* ([^\s]+)$", out.decode(), re.MULTILINE)
             if o is not None and env.repo_branch != o.group(1):
                 LOGGER.info("Repository is at %s branch, switching to %s", o.group(1), env.repo_branch)
-                result = yield self._run_compile_stage("switching branch", ["git", "checkout", env.repo_branch], project_dir)
+                result = yield self._run_compile_stage(env, "switching branch", ["git", "checkout", env.repo_branch],
+                                                       project_dir)
                 stages.append(result)
 
             if update_repo:
-                result = yield self._run_compile_stage("Pulling updates", ["git", "pull"], project_dir)
+                result = yield self._run_compile_stage(env, "Pulling updates", ["git", "pull"], project_dir)
                 stages.append(result)
                 LOGGER.info("Installing and updating modules")
-                result = yield self._run_compile_stage("Installing modules", inmanta_path + ["modules", "install"], project_dir,
-                                                       env=os.environ.copy())
+                result = yield self._run_compile_stage(env, "Installing modules", inmanta_path + ["modules", "install"],
+                                                       project_dir, env=os.environ.copy())
                 stages.append(result)
-                result = yield self._run_compile_stage("Updating modules", inmanta_path + ["modules", "update"], project_dir,
-                                                       env=os.environ.copy())
+                result = yield self._run_compile_stage(env, "Updating modules", inmanta_path + ["modules", "update"],
+                                                       project_dir, env=os.environ.copy())
                 stages.append(result)
 
             LOGGER.info("Recompiling configuration model")
             server_address = opt.server_address.get()
-            result = yield self._run_compile_stage("Recompiling configuration model",
-                                                   inmanta_path + ["-vvv", "export", "-e", str(environment_id),
-                                                                   "--server_address", server_address, "--server_port",
-                                                                   opt.transport_port.get()],
-                                                   project_dir, env=os.environ.copy())
+            args = ["-vvv", "export", "-e", str(environment_id), "--server_address", server_address, "--server_port",
+                    str(opt.transport_port.get())]
+            result = None
+            if self._compiler_service is not None:
+                try:
+                    result = yield self._run_compiler_service(env, "Recompiling configuration model", inmanta_path,
+                                                              args, project_dir)
+                except Exception:
+                    LOGGER.exception("The compiler service failed to compile environment %s, starting a new compiler process",
+                                     environment_id)
+
+            if result is None:
+                result = yield self._run_compile_stage(env, "Recompiling configuration model", inmanta_path + args,
+                                                       project_dir, env=os.environ.copy())
             stages.append(result)
         finally:
             end = datetime.datetime.now()
-            self._recompiles[environment_id] = end
             for stage in stages:
                 yield stage.save()
 
@@ -1513,12 +1788,39 @@ class Server(protocol.ServerEndpoint):
             report_dict = yield m.to_dict()
             reports.append(report_dict)
 
-        return 200, {"reports": reports}
+        result = {"reports": reports}
+        if environment is not None:
+            running = self._compile_stages.get(str(environment))
+            result["running"] = None
+            if running is not None:
+                result["running"] = {"id": running.uuid, "name": running.name, "command": running.command,
+                                     "started": running.started.isoformat()}
+
+        return 200, result
+
+    @protocol.handle(methods.CompileReport.get_report_output)
+    @gen.coroutine
+    def get_report_output(self, id, stream="out", start=None, limit=None):
+        if stream not in ("out", "err"):
+            return 400, {"message": "The stream should be out or err"}
+
+        if limit is None:
+            limit = COMPILE_OUTPUT_PAGE
+
+        output = yield data.ReportOutput.get_output(id, stream, start, limit)
+        running = any([report.uuid == id for report in self._compile_stages.values()])
+        if output["size"] == 0 and not running:
+            reports = yield data.Report.objects.filter(uuid=id).find_all()  # @UndefinedVariable
+            if len(reports) == 0:
+                return 404, {"message": "A compile stage with the given id does not exist"}
+
+        output["running"] = running
+        return 200, output
 
     @protocol.handle(methods.Snapshot.list_snapshots)
     @gen.coroutine
     def list_snapshots(self, tid):
-        env = yield data.Environment.get_uuid(tid)
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
@@ -1533,7 +1835,7 @@ class Server(protocol.ServerEndpoint):
     @protocol.handle(methods.Snapshot.get_snapshot)
     @gen.coroutine
     def get_snapshot(self, tid, id):
-        env = yield data.Environment.get_uuid(tid)
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
@@ -1553,19 +1855,15 @@ class Server(protocol.ServerEndpoint):
     @protocol.handle(methods.Snapshot.create_snapshot)
     @gen.coroutine
     def create_snapshot(self, tid, name):
-        env = yield data.Environment.get_uuid(tid)
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
         # get the latest deployed configuration model
-        versions = yield (data.ConfigurationModel.objects.filter(environment=env, deployed=True).  # @UndefinedVariable
-                          order_by("version", direction=DESCENDING).limit(1).find_all())  # @UndefinedVariable
-
-        if len(versions) == 0:
+        version = yield self.cache.get_latest_version(env, deployed=True)
+        if version is None:
             return 500, {"message": "There is no deployed configuration model to create a snapshot."}
 
-        version = versions[0]
-
         LOGGER.info("Creating a snapshot from version %s in environment %s", version.version, tid)
 
         # create the snapshot
@@ -1577,7 +1875,8 @@ class Server(protocol.ServerEndpoint):
         resources_to_snapshot = defaultdict(list)
         resource_list = []
         resource_states = yield (data.ResourceVersion.objects.filter(environment=env, model=version).  # @UndefinedVariable
-                                 find_all())  # @UndefinedVariable
+                                 limit(DBLIMIT).find_all())  # @UndefinedVariable
+        yield data.ResourceVersion.load_attributes(env, resource_states)
         for rs in resource_states:
             yield rs.load_references()
             if rs.resource.holds_state and "state_id" in rs.attributes:
@@ -1610,7 +1909,7 @@ class Server(protocol.ServerEndpoint):
     @protocol.handle(methods.Snapshot.update_snapshot)
     @gen.coroutine
     def update_snapshot(self, tid, id, resource_id, snapshot_data, start, stop, size, success, error, msg):
-        env = yield data.Environment.get_uuid(tid)
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
@@ -1649,7 +1948,7 @@ class Server(protocol.ServerEndpoint):
     @protocol.handle(methods.Snapshot.delete_snapshot)
     @gen.coroutine
     def delete_snapshot(self, tid, id):
-        env = yield data.Environment.get_uuid(tid)
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
@@ -1664,7 +1963,7 @@ class Server(protocol.ServerEndpoint):
     @protocol.handle(methods.RestoreSnapshot.restore_snapshot)
     @gen.coroutine
     def restore_snapshot(self, tid, snapshot):
-        f1 = data.Environment.get_uuid(tid)
+        f1 = self.cache.get_environment(tid)
         f2 = data.Snapshot.get_uuid(snapshot)
         env, snapshot = yield [f1, f2]
 
@@ -1678,15 +1977,13 @@ class Server(protocol.ServerEndpoint):
         snap_resources = yield data.ResourceSnapshot.objects.filter(snapshot=snapshot).find_all()  # @UndefinedVariable
 
         # get all resource that support state in the current environment
-        env_versions = yield (data.ConfigurationModel.objects.filter(environment=env, deployed=True).  # @UndefinedVariable
-                              order_by("version", direction=DESCENDING).limit(1).find_all())  # @UndefinedVariable
-
-        if len(env_versions) == 0:
+        env_version = yield self.cache.get_latest_version(env, deployed=True)
+        if env_version is None:
             return 500, {"message": "There is no deployed configuration model in this environment."}
-        else:
-            env_version = env_versions[0]
 
-        env_resources = yield data.ResourceVersion.objects.filter(model=env_version).find_all()  # @UndefinedVariable
+        env_resources = yield (data.ResourceVersion.objects.filter(model=env_version)  # @UndefinedVariable
+                               .limit(DBLIMIT).find_all())
+        yield data.ResourceVersion.load_attributes(env, env_resources)
         env_states = {}
         for r in env_resources:
             if "state_id" in r.attributes:
@@ -1727,7 +2024,7 @@ class Server(protocol.ServerEndpoint):
     @protocol.handle(methods.RestoreSnapshot.list_restores)
     @gen.coroutine
     def list_restores(self, tid):
-        env = yield data.Environment.get_uuid(tid)
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
@@ -1738,7 +2035,7 @@ class Server(protocol.ServerEndpoint):
     @protocol.handle(methods.RestoreSnapshot.get_restore_status)
     @gen.coroutine
     def get_restore_status(self, tid, id):
-        env = yield data.Environment.get_uuid(tid)
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
@@ -1758,7 +2055,7 @@ class Server(protocol.ServerEndpoint):
     @protocol.handle(methods.RestoreSnapshot.update_restore)
     @gen.coroutine
     def update_restore(self, tid, id, resource_id, success, error, msg, start, stop):
-        env = yield data.Environment.get_uuid(tid)
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
@@ -1787,7 +2084,7 @@ class Server(protocol.ServerEndpoint):
     @protocol.handle(methods.RestoreSnapshot.delete_restore)
     @gen.coroutine
     def delete_restore(self, tid, id):
-        env = yield data.Environment.get_uuid(tid)
+        env = yield self.cache.get_environment(tid)
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
@@ -1806,7 +2103,7 @@ class Server(protocol.ServerEndpoint):
             return 404, {"message": "The given environment id does not exist!"}
 
         version = int(time.time())
-        result = yield self.put_version(id, version, [], [], {})
+        result, _ = yield self.put_version(id, version, [], [], {})
         return result, {"version": version}
 
     @protocol.handle(methods.Decommision.clear_environment)
@@ -1819,32 +2116,18 @@ class Server(protocol.ServerEndpoint):
         if env is None:
             return 404, {"message": "The given environment id does not exist!"}
 
-        agents = yield data.Agent.objects.filter(environment=env).find_all()  # @UndefinedVariable
-        for agent in agents:
-            yield agent.delete()
-
         models = yield data.ConfigurationModel.objects.filter(environment=env).find_all()  # @UndefinedVariable
         for model in models:
             yield model.delete_cascade()
 
-        resources = yield data.Resource.objects.filter(environment=env).find_all()  # @UndefinedVariable
-        for resource in resources:
-            yield resource.delete()
-
-        parameters = yield data.Parameter.objects.filter(environment=env).find_all()  # @UndefinedVariable
-        for parameter in parameters:
-            yield parameter.delete()
-
-        forms = yield data.Form.objects.filter(environment=env).find_all()  # @UndefinedVariable
-        for form in forms:
-            yield form.delete()
-
-        records = yield data.FormRecord.objects.filter(environment=env).find_all()  # @UndefinedVariable
-        for record in records:
-            yield record.delete()
-
-        compiles = yield data.Compile.objects.filter(environment=env).find_all()  # @UndefinedVariable
-        for compile in compiles:
-            yield compile.delete()
+        yield [data.Agent.objects.filter(environment=env).delete(),  # @UndefinedVariable
+               data.Resource.objects.filter(environment=env).delete(),  # @UndefinedVariable
+               data.ResourceAttributes.objects.filter(environment=env).delete(),  # @UndefinedVariable
+               data.Parameter.objects.filter(environment=env).delete(),  # @UndefinedVariable
+               data.Form.objects.filter(environment=env).delete(),  # @UndefinedVariable
+               data.FormRecord.objects.filter(environment=env).delete(),  # @UndefinedVariable
+               data.Compile.objects.filter(environment=env).delete(),  # @UndefinedVariable
+               data.ReportOutput.objects.filter(environment=env).delete()]  # @UndefinedVariable
 
+        self.cache.invalidate_versions(id)
         return 200
@@ -43,6 +43,14 @@ class StatusMethod(methods.Method):
         pass
 
 
+class ReportMethod(methods.Method):
+    __method_name__ = "report"
+
+    @methods.protocol(operation="POST", id=True, mt=True, agent_server=True)
+    def report(self, tid: uuid.UUID, id: str, value: int):
+        pass
+
+
 # Methods need to be defined before the Client class is loaded by Python
 from inmanta import protocol  # NOQA
 
@@ -52,6 +60,7 @@ class Server(protocol.ServerEndpoint):
     def __init__(self, name, io_loop, interval=60):
         protocol.ServerEndpoint.__init__(self, name, io_loop, interval=interval)
         self.expires = 0
+        self.reports = []
 
     @protocol.handle(StatusMethod.get_statusX)
     @gen.coroutine
@@ -65,6 +74,15 @@ class Server(protocol.ServerEndpoint):
 
         return 200, {"agents": status_list}
 
+    @protocol.handle(ReportMethod.report)
+    @gen.coroutine
+    def report(self, tid, id, value):
+        if value < 0:
+            return 500, {"message": "Invalid value"}
+
+        self.reports.append((id, value))
+        return 200, {"id": id}
+
     def expire(self, session, timeout):
         protocol.ServerEndpoint.expire(self, session, timeout)
         print(session._sid)
@@ -217,3 +235,83 @@ def test_timeout():
         io_loop.stop()
     server.stop()
     agent.stop()
+
+
+def test_batch_call():
+    from inmanta.config import Config
+
+    import inmanta.agent.config  # nopep8
+    import inmanta.server.config  # nopep8
+
+    io_loop = IOLoop()
+    io_loop.make_current()
+    Config.load_config()
+    server = Server("server", io_loop)
+    server.start()
+
+    agent = Agent("agent", io_loop, batch_window=0.05)
+    agent.add_end_point_name("agent")
+    agent.set_environment(uuid.uuid4())
+    agent.start()
+
+    @gen.coroutine
+    def do_call():
+        yield retry_limited(lambda: agent.sessionid in server._sessions, 1)
+
+        client = agent._batch_client
+        calls = [client.report(tid=agent.environment, id="r%d" % i, value=i) for i in range(5)]
+        calls.append(client.report(tid=agent.environment, id="r5", value=-1))
+        results = yield calls
+        return results
+
+    try:
+        results = io_loop.run_sync(do_call, timeout=5)
+    finally:
+        agent.stop()
+        server.stop()
+        io_loop.clear_current()
+
+    assert [r.code for r in results] == [200] * 5 + [500]
+    assert [r.result["id"] for r in results[:5]] == ["r%d" % i for i in range(5)]
+    assert server.reports == [("r%d" % i, i) for i in range(5)]
+    assert agent._batch_client.batches == 1
+    assert agent._batch_client.calls == 6
+
+
+def test_websocket():
+    from inmanta.config import Config
+
+    import inmanta.agent.config  # nopep8
+    import inmanta.server.config  # nopep8
+
+    io_loop = IOLoop()
+    io_loop.make_current()
+    Config.load_config()
+    server = Server("server", io_loop)
+    server.start()
+
+    agent = Agent("agent", io_loop, websocket=True)
+    agent.add_end_point_name("agent")
+    agent.set_environment(uuid.uuid4())
+    agent.start()
+
+    @gen.coroutine
+    def do_call():
+        yield retry_limited(lambda: agent.sessionid in server._sessions, 1)
+        session = server._sessions[agent.sessionid]
+        assert session._channel is not None
+
+        client = protocol.Client("client")
+        status = yield client.get_statusX(str(agent.environment))
+        return status
+
+    try:
+        status = io_loop.run_sync(do_call, timeout=5)
+    finally:
+        agent.stop()
+        server.stop()
+        io_loop.clear_current()
+
+    assert status.code == 200
+    assert status.result["agents"] == [{"status": "ok", "agents": ["agent"]}]
+    assert agent.websocket
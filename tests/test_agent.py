@@ -15,7 +15,9 @@
 
     Contact: code@inmanta.com
 """
-from inmanta import protocol, agent
+import time
+
+from inmanta import protocol, agent, resources
 import pytest
 from utils import retry_limited
 from inmanta.agent import reporting
@@ -48,3 +50,41 @@ def testagent_get_status(io_loop, server):
     status = status.get_result()
     for name in reporting.reports.keys():
         assert name in status and status[name] != "ERROR"
+
+
+@resources.resource("test::DeployHash", agent="agent", id_attribute="key")
+class DeployHash(resources.Resource):
+    fields = ("key", "value", "agent")
+
+
+def make_resource(version, value, requires=[]):
+    return resources.Resource.deserialize({"id": "test::DeployHash[agent1,key=k1],v=%d" % version, "key": "k1",
+                                           "value": value, "agent": "agent1", "purged": False,
+                                           "purge_on_delete": False, "requires": requires})
+
+
+def test_incremental_deploy_state():
+    assert agent.agent.desired_state_hash(make_resource(1, "a")) == agent.agent.desired_state_hash(make_resource(2, "a"))
+    assert agent.agent.desired_state_hash(make_resource(1, "a")) != agent.agent.desired_state_hash(make_resource(1, "b"))
+    assert (agent.agent.desired_state_hash(make_resource(1, "a")) !=
+            agent.agent.desired_state_hash(make_resource(1, "a", ["test::DeployHash[agent1,key=k2],v=1"])))
+
+    scheduler = agent.agent.ResourceScheduler(None, None, "agent1", None, None, repair_interval=60)
+    resource = make_resource(1, "a")
+    state_hash = agent.agent.desired_state_hash(resource)
+    resource_id = resource.id.resource_str()
+    assert not scheduler._is_converged(resource_id, state_hash)
+
+    scheduler.deployed(resource, state_hash)
+    assert scheduler._is_converged(resource_id, state_hash)
+    assert not scheduler._is_converged(resource_id, agent.agent.desired_state_hash(make_resource(2, "b")))
+    assert scheduler.deployed_version(resource) == 1
+
+    # a skipped resource keeps the time of its last deploy, so it is repaired after the repair interval
+    scheduler._deployed[resource_id] = (state_hash, 1, time.time() - 120)
+    scheduler.deployed(make_resource(2, "a"), state_hash, skipped=True)
+    assert scheduler.deployed_version(resource) == 2
+    assert not scheduler._is_converged(resource_id, state_hash)
+
+    scheduler.forget(resource)
+    assert scheduler.deployed_version(resource) is None
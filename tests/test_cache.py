@@ -15,6 +15,7 @@
 
     Contact: code@inmanta.com
 """
+import threading
 import unittest
 from time import sleep
 
@@ -199,6 +200,30 @@ class CacheTests(unittest.TestCase):
         assert len(called) == 1
         assert value2 == cache.get_or_else("test", creator, resource=resource, version=version, param=value2)
 
+    def testGetOrElseThreads(self):
+        barrier = threading.Barrier(2)
+
+        def creator(param, resource, version):
+            # both threads miss the cache before either one stores its value
+            barrier.wait()
+            return param
+
+        cache = AgentCache()
+        resource = Id("test::Resource", "test", "key", "test", 100).get_instance()
+        version = 100
+        cache.open_version(version)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_else("test", creator, resource=resource,
+                                                                                    version=version, param="x")))
+                   for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert results == ["x", "x"]
+        assert len(cache.cache) == 1
+
     def testGetOrElseNone(self):
         called = []
 
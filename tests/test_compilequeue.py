@@ -0,0 +1,86 @@
+"""
+    Copyright 2016 Inmanta
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Contact: code@inmanta.com
+"""
+import pytest
+from tornado import gen
+
+from inmanta.server.compilequeue import CompileQueue, PRIORITY_HIGH, PRIORITY_LOW
+
+
+@pytest.mark.gen_test
+def test_compile_queue(io_loop):
+    compiles = []
+    running = []
+    max_running = []
+
+    @gen.coroutine
+    def compile_env(environment_id, update_repo):
+        running.append(environment_id)
+        max_running.append(len(running))
+        yield gen.sleep(0.1)
+        compiles.append((environment_id, update_repo))
+        running.remove(environment_id)
+
+    queue = CompileQueue(io_loop, compile_env, workers=2)
+    queue.start()
+
+    queue.request("env1")
+    queue.request("env2", priority=PRIORITY_LOW)
+    queue.request("env3", priority=PRIORITY_HIGH)
+    yield gen.sleep(0.05)
+    assert queue.is_compiling("env2")
+
+    # requests during a compile result in exactly one follow-up compile
+    queue.request("env1", update_repo=True)
+    queue.request("env1")
+
+    while queue.completed < 4:
+        yield gen.sleep(0.05)
+
+    queue.stop()
+
+    assert max(max_running) == 2
+    assert compiles[0:2] in ([("env1", False), ("env3", False)], [("env3", False), ("env1", False)])
+    assert compiles[2:] in ([("env2", False), ("env1", True)], [("env1", True), ("env2", False)])
+    assert not queue.is_compiling("env1")
+
+    status = queue.to_dict()
+    assert status["depth"] == 0
+    assert status["coalesced"] == 1
+    assert status["completed"] == 4
+
+
+@pytest.mark.gen_test
+def test_compile_queue_interval(io_loop):
+    compiles = []
+
+    @gen.coroutine
+    def compile_env(environment_id, update_repo):
+        compiles.append(io_loop.time())
+
+    queue = CompileQueue(io_loop, compile_env, workers=1, min_interval=0.5)
+    queue.start()
+
+    queue.request("env1")
+    yield gen.sleep(0.1)
+    queue.request("env1")
+
+    while queue.completed < 2:
+        yield gen.sleep(0.05)
+
+    queue.stop()
+    assert compiles[1] - compiles[0] >= 0.4
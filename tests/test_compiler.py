@@ -16,12 +16,13 @@
     Contact: code@inmanta.com
 """
 
+import os
 import re
 
 from inmanta.ast import Namespace
 from inmanta.ast.statements import define, Literal
 from inmanta.parser.plyInmantaParser import parse
-from inmanta.parser import ParserException
+from inmanta.parser import ParserException, plyInmantaParser
 from inmanta.ast.statements.define import DefineImplement, DefineTypeConstraint, DefineTypeDefault, DefineIndex, DefineEntity
 from inmanta.ast.constraint.expression import GreaterThan, Regex, Not, And, IsDefined
 from inmanta.ast.statements.generator import Constructor
@@ -641,3 +642,36 @@ def test_Bad2():
         parse_code("""
 a=|
 """)
+
+
+def test_parse_cache(tmpdir):
+    model_file = str(tmpdir.join("main.cf"))
+    with open(model_file, "w") as fd:
+        fd.write("""
+entity Test:
+    string name
+end
+a = Test(name="a")
+""")
+
+    plyInmantaParser.enable_cache()
+    try:
+        root_ns = Namespace("__root__")
+        main_ns = Namespace("__config__", root_ns)
+        first = parse(main_ns, model_file)
+
+        other_ns = Namespace("__config__", Namespace("__root__"))
+        second = parse(other_ns, model_file)
+        assert len(second) == len(first)
+        assert second[0] is not first[0]
+        assert second[0].namespace is other_ns
+        assert second[0].fullName == "__config__::Test"
+
+        # a changed file is parsed again
+        with open(model_file, "a") as fd:
+            fd.write("b = Test(name=\"b\")\n")
+        os.utime(model_file, (0, 0))
+        third = parse(main_ns, model_file)
+        assert len(third) == len(first) + 1
+    finally:
+        plyInmantaParser.cache = None
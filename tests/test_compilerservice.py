@@ -0,0 +1,62 @@
+"""
+    Copyright 2016 Inmanta
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Contact: code@inmanta.com
+"""
+import sys
+
+import pytest
+from tornado import gen
+
+from inmanta.server.compilerservice import CompilerServicePool, run_compile
+
+
+def test_run_compile(tmpdir):
+    returncode, out, err = run_compile(str(tmpdir), ["list-commands"])
+    assert returncode == 0
+    assert "export" in out
+
+    returncode, out, err = run_compile(str(tmpdir), ["unknown-command"])
+    assert returncode == 2
+    assert "invalid choice" in err
+
+
+@pytest.mark.gen_test(timeout=60)
+def test_compiler_service(tmpdir):
+    pool = CompilerServicePool([sys.executable, "-c", "from inmanta.app import app; app()", "compiler-service"])
+    try:
+        for _ in range(2):
+            returncode, out, err = yield pool.compile(str(tmpdir), ["list-commands"])
+            assert returncode == 0
+            assert "export" in out
+
+        # the output is passed on while the compile runs
+        output = []
+
+        @gen.coroutine
+        def on_output(stream, value):
+            output.append((stream, value))
+
+        returncode, out, err = yield pool.compile(str(tmpdir), ["list-commands"], on_output)
+        assert returncode == 0
+        assert out == ""
+        assert "export" in "".join([value for stream, value in output if stream == "out"])
+
+        status = pool.to_dict()
+        assert status["services"] == 1
+        assert status["compiles"] == 3
+        assert status["restarts"] == 0
+    finally:
+        pool.stop()
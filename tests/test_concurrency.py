@@ -0,0 +1,54 @@
+"""
+    Copyright 2016 Inmanta
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Contact: code@inmanta.com
+"""
+import pytest
+from tornado import gen
+
+from inmanta.agent.concurrency import ConcurrencyLimiter
+
+
+@pytest.mark.gen_test
+def test_concurrency_limiter(io_loop):
+    limiter = ConcurrencyLimiter(3, 2)
+    running = {"agent1": 0, "agent2": 0}
+    max_running = {"agent1": 0, "agent2": 0}
+    order = []
+
+    @gen.coroutine
+    def deploy(name):
+        with (yield limiter.acquire(name)):
+            order.append(name)
+            running[name] += 1
+            max_running[name] = max(max_running[name], running[name])
+            yield gen.sleep(0.01)
+            running[name] -= 1
+            limiter.feedback(name, True)
+
+    # agent1 asks for its slots first, but agent2 still gets its turn
+    yield [deploy("agent1") for _ in range(10)] + [deploy("agent2") for _ in range(2)]
+    assert "agent2" in order[:3]
+    # an instance starts with one slot and gets more slots when its resources deploy successfully
+    assert max_running == {"agent1": 2, "agent2": 1}
+
+    stats = limiter.to_dict()
+    assert stats["running"] == 0 and stats["waiting"] == 0
+    assert stats["instances"]["agent1"]["started"] == 10
+
+    # failures lower the limit of an instance
+    limiter.feedback("agent1", False)
+    assert limiter.to_dict()["instances"]["agent1"]["limit"] == 1
+    assert limiter.to_dict()["instances"]["agent2"]["limit"] == 2
@@ -20,6 +20,7 @@ import datetime
 
 from inmanta import data
 from inmanta.data import AgentInstance, Agent
+from inmanta.server.compileoutput import OutputCollector
 import pytest
 
 
@@ -87,3 +88,270 @@ class TestProjectTestCase:
         yield agent.load_references()
         yield agent.primary.load_references()
         assert agent.primary.process.uuid == agentProc.uuid
+
+    @pytest.mark.gen_test
+    def testModelProgress(self):
+        project = data.Project(name="test", uuid=uuid.uuid4())
+        project = yield project.save()
+
+        env = yield data.Environment.objects.create(uuid=uuid.uuid4(),  # @UndefinedVariable
+                                                    name="dev", project_id=project.uuid, repo_url="", repo_branch="")
+
+        model = data.ConfigurationModel(environment=env, version=1, date=datetime.datetime.now(), resources_total=2)
+        yield model.save()
+
+        yield data.ConfigurationModel.update_progress(env, 1, "", "failed")
+        model = yield data.ConfigurationModel.get_version(env, 1)
+        assert model.resources_done == 1
+        assert model.resources_failed == 1
+        assert not model.deployed
+
+        # a second report for the same resource does not count as done again
+        yield data.ConfigurationModel.update_progress(env, 1, "failed", "deployed")
+        yield data.ConfigurationModel.update_progress(env, 1, "", "deployed")
+        model = yield data.ConfigurationModel.get_version(env, 1)
+        assert model.resources_done == 2
+        assert model.resources_failed == 0
+        assert model.deployed
+        assert model.result == "success"
+
+    @pytest.mark.gen_test
+    def testDryRunResults(self):
+        project = data.Project(name="test", uuid=uuid.uuid4())
+        project = yield project.save()
+
+        env = yield data.Environment.objects.create(uuid=uuid.uuid4(),  # @UndefinedVariable
+                                                    name="dev", project_id=project.uuid, repo_url="", repo_branch="")
+
+        model = data.ConfigurationModel(environment=env, version=1, date=datetime.datetime.now(), resources_total=5)
+        yield model.save()
+
+        dryrun_id = uuid.uuid4()
+        dryrun = data.DryRun(uuid=dryrun_id, environment=env, model=model, date=datetime.datetime.now(), resources={},
+                             resource_total=5, resource_todo=5)
+        yield dryrun.save()
+        yield data.DryRunResource.create_indexes()
+
+        dryrun = yield data.DryRun.get_uuid(dryrun_id)
+        for i in range(5):
+            stored = yield dryrun.add_result("std::File[agent1,path=/etc/file%d],v=1" % i, {"hash": [i, i + 1]})
+            assert stored
+
+        # a second result for the same resource is rejected
+        stored = yield dryrun.add_result("std::File[agent1,path=/etc/file0],v=1", {})
+        assert not stored
+
+        dryrun = yield data.DryRun.get_uuid(dryrun_id)
+        assert dryrun.resource_todo == 0
+
+        report = yield dryrun.to_dict()
+        assert len(report["resources"]) == 5
+        assert report["resources"]["std::File[agent1,path=/etc/file3],v=1"]["changes"] == {"hash": [3, 4]}
+        assert report["resources"]["std::File[agent1,path=/etc/file3],v=1"]["id_fields"]["attribute_value"] == "/etc/file3"
+
+        report = yield dryrun.to_dict(resource_start=3, resource_limit=10)
+        assert sorted(report["resources"].keys()) == ["std::File[agent1,path=/etc/file3],v=1",
+                                                      "std::File[agent1,path=/etc/file4],v=1"]
+
+        yield model.delete_cascade()
+        assert (yield data.DryRunResource.objects.count()) == 0  # @UndefinedVariable
+
+    @pytest.mark.gen_test
+    def testReportOutput(self):
+        project = data.Project(name="test", uuid=uuid.uuid4())
+        project = yield project.save()
+
+        env = yield data.Environment.objects.create(uuid=uuid.uuid4(),  # @UndefinedVariable
+                                                    name="dev", project_id=project.uuid, repo_url="", repo_branch="")
+        yield data.ReportOutput.create_indexes()
+
+        report_id = uuid.uuid4()
+        collector = OutputCollector(env, report_id, "out", limit=25, chunk_size=10, flush_interval=60)
+        yield collector.write(b"0123456789abc")
+        yield collector.write("def".encode())
+        # output is stored while it arrives, buffered output only when the stream ends
+        output = yield data.ReportOutput.get_output(report_id, "out")
+        assert output["output"] == "0123456789"
+
+        yield collector.write(b"ghijklmnopqrstuvwxyz", final=True)
+        assert collector.size == 36
+
+        # only the last chunks within the limit are kept
+        output = yield data.ReportOutput.get_output(report_id, "out")
+        assert output == {"output": "klmnopqrstuvwxyz", "start": 20, "end": 36, "size": 36, "available": 20}
+
+        output = yield data.ReportOutput.get_output(report_id, "out", start=22, limit=5)
+        assert output["output"] == "mnopq"
+        assert output["end"] == 27
+
+        output = yield data.ReportOutput.get_output(report_id, "out", limit=4)
+        assert output["output"] == "wxyz"
+
+        output = yield data.ReportOutput.get_output(report_id, "err")
+        assert output["size"] == 0
+
+    @pytest.mark.gen_test
+    def testModelDeleteCascade(self):
+        project = data.Project(name="test", uuid=uuid.uuid4())
+        project = yield project.save()
+
+        env = yield data.Environment.objects.create(uuid=uuid.uuid4(),  # @UndefinedVariable
+                                                    name="dev", project_id=project.uuid, repo_url="", repo_branch="")
+
+        model = data.ConfigurationModel(environment=env, version=1, date=datetime.datetime.now(), resources_total=5)
+        yield model.save()
+
+        for i in range(5):
+            res_id = "std::File[agent1,path=/etc/file%d]" % i
+            resource = data.Resource(environment=env, resource_id=res_id, resource_type="std::File", agent="agent1",
+                                     attribute_name="path", attribute_value="/etc/file%d" % i)
+            yield resource.save()
+            rv = data.ResourceVersion(environment=env, rid="%s,v=1" % res_id, resource=resource, model=model,
+                                      agent="agent1", attributes={})
+            yield rv.save()
+            yield data.ResourceAction(resource_version=rv, action="store", level="INFO",
+                                      timestamp=datetime.datetime.now()).save()
+
+        count = yield data.ResourceVersion.delete_for_model(model, batch_size=2)
+        assert count == 5
+
+        yield model.delete_cascade()
+
+        rvs = yield data.ResourceVersion.objects.find_all()  # @UndefinedVariable
+        actions = yield data.ResourceAction.objects.find_all()  # @UndefinedVariable
+        models = yield data.ConfigurationModel.objects.find_all()  # @UndefinedVariable
+        assert len(rvs) == 0
+        assert len(actions) == 0
+        assert len(models) == 0
+
+    @pytest.mark.gen_test
+    def testResourceActionRetention(self):
+        project = data.Project(name="test", uuid=uuid.uuid4())
+        project = yield project.save()
+
+        env = yield data.Environment.objects.create(uuid=uuid.uuid4(),  # @UndefinedVariable
+                                                    name="dev", project_id=project.uuid, repo_url="", repo_branch="")
+
+        now = datetime.datetime.now()
+        for i in range(5):
+            yield data.ResourceAction(environment=env, action="deploy", level="INFO", data={"changes": {"path": i}},
+                                      timestamp=now - datetime.timedelta(hours=i)).save()
+
+        count = yield data.ResourceAction.purge(env)
+        assert count == 0
+
+        count = yield data.ResourceAction.purge(env, max_count=4)
+        assert count == 1
+
+        count = yield data.ResourceAction.purge(env, max_age=int(2.5 * 3600))
+        assert count == 1
+
+        actions = yield data.ResourceAction.objects.order_by("timestamp").find_all()  # @UndefinedVariable
+        assert len(actions) == 3
+        assert actions[0].to_dict()["data"] == {"changes": {"path": 2}}
+
+    @pytest.mark.gen_test
+    def testSetMissingAgents(self):
+        project = data.Project(name="test", uuid=uuid.uuid4())
+        project = yield project.save()
+
+        env = yield data.Environment.objects.create(uuid=uuid.uuid4(),  # @UndefinedVariable
+                                                    name="dev", project_id=project.uuid, repo_url="", repo_branch="")
+        model = data.ConfigurationModel(environment=env, version=1, date=datetime.datetime.now(), resources_total=3)
+        yield model.save()
+
+        for i in range(3):
+            res_id = "std::File[agent%d,path=/etc/file]" % i
+            resource = data.Resource(environment=env, resource_id=res_id, resource_type="std::File", agent="agent%d" % i,
+                                     attribute_name="path", attribute_value="/etc/file")
+            yield resource.save()
+            yield data.ResourceVersion(environment=env, rid="%s,v=1" % res_id, resource=resource, model=model,
+                                       attributes={}).save()
+
+        count = yield data.ResourceVersion.set_missing_agents(batch_size=2)
+        assert count == 3
+
+        rvs = yield data.ResourceVersion.objects.filter(environment=env, agent="agent2").find_all()  # @UndefinedVariable
+        assert len(rvs) == 1
+
+    @pytest.mark.gen_test
+    def testResourceActionRetentionTies(self):
+        project = data.Project(name="test", uuid=uuid.uuid4())
+        project = yield project.save()
+
+        env = yield data.Environment.objects.create(uuid=uuid.uuid4(),  # @UndefinedVariable
+                                                    name="dev", project_id=project.uuid, repo_url="", repo_branch="")
+        model = data.ConfigurationModel(environment=env, version=1, date=datetime.datetime.now(), resources_total=1)
+        yield model.save()
+        res_id = "std::File[agent1,path=/etc/file1]"
+        resource = data.Resource(environment=env, resource_id=res_id, resource_type="std::File", agent="agent1",
+                                 attribute_name="path", attribute_value="/etc/file1")
+        yield resource.save()
+        rv = data.ResourceVersion(environment=env, rid="%s,v=1" % res_id, resource=resource, model=model, agent="agent1",
+                                  attributes={})
+        yield rv.save()
+
+        # actions that are stored in one batch share their timestamp
+        now = datetime.datetime.now()
+        actions = [data.ResourceAction(environment=env, resource_version=rv, action="store", message=str(i), timestamp=now)
+                   for i in range(5)]
+        yield data.ResourceAction.objects.bulk_insert(actions)  # @UndefinedVariable
+
+        count = yield data.ResourceAction.purge(env, max_count=3)
+        assert count == 2
+
+        actions = yield data.ResourceAction.objects.find_all()  # @UndefinedVariable
+        assert sorted([action.message for action in actions]) == ["2", "3", "4"]
+
+        # actions stored before the environment was stored on them get the environment of their resource version
+        yield data.ResourceAction(resource_version=rv, action="deploy", timestamp=now).save()
+        count = yield data.ResourceAction.set_missing_environments()
+        assert count == 1
+
+        count = yield data.ResourceAction.purge(env, max_count=1)
+        assert count == 3
+
+    @pytest.mark.gen_test
+    def testResourceAttributesDeleteUnused(self):
+        project = data.Project(name="test", uuid=uuid.uuid4())
+        project = yield project.save()
+
+        env = yield data.Environment.objects.create(uuid=uuid.uuid4(),  # @UndefinedVariable
+                                                    name="dev", project_id=project.uuid, repo_url="", repo_branch="")
+        yield data.ResourceAttributes.create_indexes()
+
+        attribute_list = [("h%d" % i, {"path": "/etc/file%d" % i}) for i in range(3)]
+        yield data.ResourceAttributes.store(env, attribute_list)
+        yield data.ResourceAttributes.store(env, attribute_list)
+        attrs = yield data.ResourceAttributes.objects.filter(environment=env).find_all()  # @UndefinedVariable
+        assert len(attrs) == 3
+
+        model = data.ConfigurationModel(environment=env, version=1, date=datetime.datetime.now(), resources_total=1)
+        yield model.save()
+        res_id = "std::File[agent1,path=/etc/file1]"
+        resource = data.Resource(environment=env, resource_id=res_id, resource_type="std::File", agent="agent1",
+                                 attribute_name="path", attribute_value="/etc/file1")
+        yield resource.save()
+        yield data.ResourceVersion(environment=env, rid="%s,v=1" % res_id, resource=resource, model=model, agent="agent1",
+                                   attribute_hash="h1").save()
+
+        count = yield data.ResourceAttributes.delete_unused(env, batch_size=2)
+        assert count == 2
+        attrs = yield data.ResourceAttributes.objects.filter(environment=env).find_all()  # @UndefinedVariable
+        assert [attr.hash for attr in attrs] == ["h1"]
+
+
+def test_resource_attributes_normalize():
+    attributes = {"path": "/etc/motd", "version": 3, "requires": ["std::File[agent1,path=/etc/a],v=3"]}
+    normalized = data.ResourceAttributes.normalize(attributes, 3)
+    assert normalized == {"path": "/etc/motd", "requires": ["std::File[agent1,path=/etc/a]"]}
+    assert normalized == data.ResourceAttributes.normalize(data.ResourceAttributes.denormalize(normalized, 4), 4)
+    assert data.ResourceAttributes.denormalize(normalized, 3) == attributes
+
+
+def test_resource_action_encode_data():
+    assert data.ResourceAction.encode_data({"changes": {"path": 1}}) == {"changes": {"path": 1}}
+    encoded = data.ResourceAction.encode_data({"changes": {"file.txt": 1}})
+    assert isinstance(encoded, str)
+    action = data.ResourceAction(action="deploy", timestamp=datetime.datetime.now(), data=encoded)
+    assert action.to_dict()["data"] == {"changes": {"file.txt": 1}}
@@ -0,0 +1,89 @@
+"""
+    Copyright 2016 Inmanta
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Contact: code@inmanta.com
+"""
+import hashlib
+import os
+
+import pytest
+
+from inmanta.server.filestore import FileStore
+
+
+def test_filestore(tmpdir):
+    path = str(tmpdir)
+    store = FileStore(path)
+
+    content = b"Hello world\n" * 100
+    file_id = hashlib.sha1(content).hexdigest()
+
+    assert file_id not in store
+    assert not store.put(file_id, b"other content")
+    assert file_id not in store
+
+    assert store.put(file_id, content)
+    assert file_id in store
+    assert store.read(file_id) == content
+    assert store.missing([file_id, "test"]) == ["test"]
+
+    # stored compressed in a shard
+    stored = os.path.join(path, file_id[0:2], file_id[2:4], file_id + ".gz")
+    assert os.path.exists(stored)
+    assert os.path.getsize(stored) < len(content)
+
+    # no temporary files are left behind
+    assert [name for name in os.listdir(path) if name.startswith(".")] == []
+
+    with pytest.raises(KeyError):
+        store.read("test")
+
+    # the index is rebuilt from disk
+    store = FileStore(path)
+    assert len(store) == 1
+    assert store.read(file_id) == content
+
+
+def test_filestore_uncompressed(tmpdir):
+    store = FileStore(str(tmpdir), compress=False)
+
+    content = b"Hello world\n"
+    file_id = hashlib.sha1(content).hexdigest()
+    assert store.put(file_id, content)
+    assert os.path.exists(os.path.join(str(tmpdir), file_id[0:2], file_id[2:4], file_id))
+
+    # a compressing store reads uncompressed files
+    store = FileStore(str(tmpdir))
+    assert store.read(file_id) == content
+
+
+def test_filestore_migrate(tmpdir):
+    path = str(tmpdir)
+    for i in range(10):
+        with open(os.path.join(path, "test%d" % i), "wb+") as fd:
+            fd.write(b"content %d" % i)
+
+    store = FileStore(path)
+    assert store.unmigrated == 10
+    assert store.read("test3") == b"content 3"
+
+    assert store.migrate() == 10
+    assert store.unmigrated == 0
+    assert not os.path.exists(os.path.join(path, "test3"))
+    assert store.read("test3") == b"content 3"
+
+    store = FileStore(path)
+    assert store.unmigrated == 0
+    assert len(store) == 10
@@ -17,8 +17,20 @@
 """
 import random
 import base64
+import datetime
+import hashlib
+import io
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock
 
 import pytest
+from tornado import gen, tcpclient
+
+from inmanta import methods, protocol
+from inmanta.agent.handler import ResourceHandler
+from inmanta.config import Config
 
 
 @pytest.mark.gen_test
@@ -53,3 +65,240 @@ def test_client_files(client):
     other_files = ["testtest"]
     result = yield client.stat_files(files=file_names + other_files)
     assert len(result.result["files"]) == len(other_files)
+
+
+@pytest.mark.gen_test
+def test_client_file_streams(client):
+    content = os.urandom(1024 * 1024)
+    file_id = hashlib.sha1(content).hexdigest()
+
+    result = yield client.get_file_stream(id=file_id, stream=io.BytesIO())
+    assert result.code == 404
+
+    # the content should match the id
+    result = yield client.upload_file_stream(id=file_id, stream=io.BytesIO(b"Hello world\n"))
+    assert result.code == 400
+
+    result = yield client.stat_file(id=file_id)
+    assert result.code == 404
+
+    result = yield client.upload_file_stream(id=file_id, stream=io.BytesIO(content))
+    assert result.code == 200
+
+    target = io.BytesIO()
+    result = yield client.get_file_stream(id=file_id, stream=target)
+    assert result.code == 200
+    assert target.getvalue() == content
+
+    # the file is shared with the json file api
+    result = yield client.get_file(id=file_id)
+    assert result.code == 200
+    assert base64.b64decode(result.result["content"]) == content
+
+
+@pytest.mark.gen_test(timeout=30)
+def test_client_file_stream_aborted(server, client):
+    """
+        Drop the connection halfway through an upload, the upload should end and its temporary file should be removed
+    """
+    content = os.urandom(1024 * 1024)
+    file_id = hashlib.sha1(content).hexdigest()
+
+    port = int(Config.get("server_rest_transport", "port"))
+    stream = yield tcpclient.TCPClient().connect("localhost", port)
+    yield stream.write(("PUT /filestream/%s HTTP/1.1\r\nHost: localhost:%d\r\nContent-Length: %d\r\n\r\n" %
+                        (file_id, port, len(content))).encode())
+    yield stream.write(content[:len(content) // 2])
+
+    def uploads():
+        return [name for name in os.listdir(server._file_store.path) if name.startswith(".upload-")]
+
+    # wait until the server has started writing the upload
+    while len(uploads()) == 0:
+        yield gen.sleep(0.1)
+
+    stream.close()
+
+    while len(uploads()) > 0:
+        yield gen.sleep(0.1)
+
+    result = yield client.stat_file(id=file_id)
+    assert result.code == 404
+
+    # the server still accepts the complete upload
+    result = yield client.upload_file_stream(id=file_id, stream=io.BytesIO(content))
+    assert result.code == 200
+
+
+@pytest.mark.gen_test(timeout=30)
+def test_handler_file_streams(server, client):
+    """
+        A handler only accepts a downloaded file when its content matches the hash
+    """
+    content = os.urandom(1024 * 1024)
+    file_id = hashlib.sha1(content).hexdigest()
+    result = yield client.upload_file_stream(id=file_id, stream=io.BytesIO(content))
+    assert result.code == 200
+
+    # the json file api does not verify the hash
+    bad_id = hashlib.sha1(b"Hello world\n").hexdigest()
+    result = yield client.upload_file(id=bad_id, content=base64.b64encode(content).decode("ascii"))
+    assert result.code == 200
+
+    handler = ResourceHandler(Mock(sessionid=uuid.uuid4()), io=Mock())
+    executor = ThreadPoolExecutor(1)
+    try:
+        assert (yield executor.submit(handler.get_file, file_id)) == content
+        assert (yield executor.submit(handler.get_file, hashlib.sha1(b"").hexdigest())) is None
+
+        with pytest.raises(Exception):
+            yield executor.submit(handler.get_file, bad_id)
+    finally:
+        executor.shutdown()
+
+
+def test_router():
+    config_get = ({}, None, None)
+    config_post = ({}, None, None)
+    router = protocol.Router({"/notify/%s" % protocol.ID_PATTERN: {"GET": config_get},
+                              "/agentstate": {"POST": config_post}})
+
+    assert router.match("/notify/abc%2Fdef?update=1", "GET") == ({"id": "abc/def"}, config_get)
+    assert router.match("/agentstate", "POST") == ({}, config_post)
+    assert router.match("/agentstate", "GET") == (None, None)
+    assert router.match("/notify", "GET") == (None, None)
+    assert router.match("/notify/abc/def", "GET") == (None, None)
+    assert router.match("/unknown", "POST") == (None, None)
+
+
+def test_method_signature():
+    signature = protocol.get_signature(methods.NotifyMethod.notify_change.__wrapped__)
+    assert signature is protocol.get_signature(methods.NotifyMethod.notify_change.__wrapped__)
+    assert signature.args == ["id", "update"]
+
+    env_id = uuid.uuid4()
+    message = {"id": str(env_id)}
+    assert signature.validate(message) is None
+    assert message == {"id": env_id, "update": 1}
+
+    assert "required" in signature.validate({})
+    assert "Invalid type" in signature.validate({"id": "abc"})
+    assert "not declared" in signature.validate({"id": str(env_id), "other": 1})
+
+
+@pytest.mark.parametrize("codec_name", ["json", "orjson"])
+def test_json_codec(codec_name):
+    if codec_name == "orjson":
+        pytest.importorskip("orjson")
+
+    codec = protocol.create_codec(codec_name)
+    env_id = uuid.uuid4()
+    now = datetime.datetime.now()
+
+    body = codec.encode({"id": env_id, "date": now, "html": "</script>", "values": [1, 2.5, None, True]})
+    assert isinstance(body, bytes)
+    assert b"</" not in body
+    assert codec.decode(body) == {"id": str(env_id), "date": now.isoformat(), "html": "</script>",
+                                  "values": [1, 2.5, None, True]}
+    assert codec.decode(body.decode()) == codec.decode(body)
+
+    # keys that are not strings are encoded as the json module does
+    assert codec.decode(codec.encode({1: "a"})) == {"1": "a"}
+
+    with pytest.raises(ValueError):
+        codec.decode(b"{")
+
+
+@pytest.mark.gen_test
+def test_request_compression(client):
+    content = base64.b64encode(b"Hello world\n" * 10000).decode("ascii")
+    hash_id = hashlib.sha1(b"Hello world\n" * 10000).hexdigest()
+
+    # the server announces that it accepts compressed requests in its responses
+    result = yield client.stat_file(id=hash_id)
+    assert result.code == 404
+    assert client._transport_instance._compress_requests
+
+    result = yield client.upload_file(id=hash_id, content=content)
+    assert result.code == 200
+
+    result = yield client.get_file(id=hash_id)
+    assert result.code == 200
+    assert result.result["content"] == content
+
+
+@pytest.mark.gen_test
+def test_client_pool(io_loop):
+    from tornado import gen, httpclient, httpserver, testing, web
+
+    class SlowHandler(web.RequestHandler):
+        @gen.coroutine
+        def get(self):
+            yield gen.sleep(0.1)
+            self.write("ok")
+
+    sock, port = testing.bind_unused_port()
+    server = httpserver.HTTPServer(web.Application([(r"/", SlowHandler)]))
+    server.add_sockets([sock])
+
+    pool = protocol.ClientPool(max_clients=2)
+    try:
+        url = "http://localhost:%d/" % port
+        responses = yield [pool.fetch(httpclient.HTTPRequest(url)) for _ in range(4)]
+        assert [r.body for r in responses] == [b"ok"] * 4
+    finally:
+        pool.close()
+        server.stop()
+
+    stats = pool.to_dict()
+    assert stats["requests"] == 4
+    assert stats["queued"] == 2
+    assert stats["active"] == 0 and stats["waiting"] == 0
+    assert stats["max_wait_time"] >= 0.09
+
+
+@pytest.mark.gen_test
+def test_session_queue(io_loop):
+    class SessionStore(object):
+        def expire(self, session, timeout):
+            pass
+
+    session = protocol.Session(SessionStore(), io_loop, uuid.uuid4(), 0.1, 60, uuid.uuid4(), ["agent"], "node",
+                               max_queue=2, max_batch=3)
+
+    def call(name, priority):
+        return session.put_call({"url": "/" + name, "method": "POST", "headers": {}, "body": None}, priority=priority)
+
+    call("facts1", methods.PRIORITY_LOW)
+    call("dryrun1", methods.PRIORITY_NORMAL)
+    call("dryrun2", methods.PRIORITY_NORMAL)
+    rejected = call("dryrun3", methods.PRIORITY_NORMAL)
+    call("trigger1", methods.PRIORITY_HIGH)
+    timed_out = call("facts2", methods.PRIORITY_LOW)
+    timed_out.set_exception(Exception())
+
+    assert rejected.done()
+    with pytest.raises(protocol.CallQueueFull):
+        rejected.result()
+
+    stats = session.get_queue_stats()
+    assert stats["depth"] == {"high": 1, "normal": 2, "low": 2}
+    assert stats["rejected"] == 1
+
+    # highest priority first and at most max_batch calls per poll
+    calls = yield session.get_calls()
+    assert [c["url"] for c in calls] == ["/trigger1", "/dryrun1", "/dryrun2"]
+
+    # calls that timed out in the queue are dropped
+    calls = yield session.get_calls()
+    assert [c["url"] for c in calls] == ["/facts1"]
+
+    calls = yield session.get_calls()
+    assert calls is None
+
+    stats = session.get_queue_stats()
+    assert stats["delivered"] == 4
+    assert stats["dropped"] == 1
+    assert stats["oldest_call"] == 0
+
+    session.expire(0)
@@ -16,13 +16,17 @@
     Contact: code@inmanta.com
 """
 
+import hashlib
+import io
 import time
 import logging
 
 from utils import retry_limited
 import pytest
 from inmanta.agent.agent import Agent
+from inmanta import data
 from inmanta.data import Environment
+from inmanta.server.cache import LRUCache
 
 LOGGER = logging.getLogger(__name__)
 
@@ -263,6 +267,9 @@ def test_get_resource_for_agent(io_loop, server_multi):
     assert result.code == 200
     assert len(result.result["resources"]) == 3
 
+    result = yield aclient.get_resources_for_agent(env_id, "vm1.dev.inmanta.com", known_version=version)
+    assert result.code == 304
+
     result = yield aclient.resource_updated(env_id,
                                             "std::File[vm1.dev.inmanta.com,path=/etc/sysconfig/network],v=%d" % version,
                                             "INFO", "deploy", "", "deployed", {})
@@ -280,3 +287,163 @@ def test_get_resource_for_agent(io_loop, server_multi):
     result = yield client.get_version(env_id, version)
     assert result.code == 200
     assert result.result["model"]["done"] == 2
+
+
+@pytest.mark.gen_test(timeout=30)
+def test_put_version_bulk(client, server):
+    """
+        Test storing versions with the bulk ingest path, including resource updates and purge on delete
+    """
+    result = yield client.create_project("env-test")
+    assert result.code == 200
+    project_id = result.result["project"]["id"]
+
+    result = yield client.create_environment(project_id=project_id, name="dev")
+    env_id = result.result["environment"]["id"]
+
+    def make_resources(version, names):
+        return [{'id': 'std::File[vm1.dev.inmanta.com,path=/etc/%s],v=%d' % (name, version),
+                 'path': '/etc/%s' % name,
+                 'purge_on_delete': True,
+                 'purged': False,
+                 'requires': [],
+                 'version': version} for name in names]
+
+    version = 1
+    res = yield client.put_version(tid=env_id, version=version, resources=make_resources(version, ["a", "b", "c"]),
+                                   unknowns=[{"parameter": "x", "source": "fact"}], version_info={})
+    assert res.code == 200
+    assert "resources" in res.result["timings"]
+
+    version = 2
+    res = yield client.put_version(tid=env_id, version=version, resources=make_resources(version, ["a", "b"]),
+                                   unknowns=[], version_info={})
+    assert res.code == 200
+
+    result = yield client.get_version(env_id, version)
+    assert result.code == 200
+    assert result.result["model"]["total"] == 3
+    fields = {x["id"]: x["fields"] for x in result.result["resources"]}
+    assert fields["std::File[vm1.dev.inmanta.com,path=/etc/c],v=2"]["purged"] == "true"
+    assert fields["std::File[vm1.dev.inmanta.com,path=/etc/a],v=2"]["version"] == 2
+
+    # unchanged resources share their attributes with the previous version, only the purged resource is new
+    attributes = yield data.ResourceAttributes.objects.find_all()  # @UndefinedVariable
+    assert len(attributes) == 4
+
+    result = yield client.get_version(env_id, 1)
+    assert len(result.result["unknowns"]) == 1
+
+    result = yield client.get_version(env_id, version, include_logs=True, limit=1, resource_start=1, resource_limit=2)
+    assert result.code == 200
+    assert [x["id_fields"]["attribute_value"] for x in result.result["resources"]] == ["/etc/b", "/etc/c"]
+    assert all(len(x["actions"]) == 1 for x in result.result["resources"])
+
+    result = yield client.list_versions(env_id, start=0, limit=1)
+    assert result.code == 200
+    assert result.result["count"] == 2
+    assert [x["version"] for x in result.result["versions"]] == [2]
+
+    result = yield client.get_environment(env_id, resources=1)
+    assert result.code == 200
+    assert len(result.result["environment"]["resources"]) == 3
+    assert all(x["latest_version"] == 2 for x in result.result["environment"]["resources"])
+
+
+@pytest.mark.gen_test(timeout=30)
+def test_server_cache(client, server):
+    """
+        Test caching of environments and the latest released version
+    """
+    result = yield client.create_project("env-test")
+    assert result.code == 200
+    project_id = result.result["project"]["id"]
+
+    result = yield client.create_environment(project_id=project_id, name="dev")
+    env_id = result.result["environment"]["id"]
+
+    result = yield client.list_versions(env_id)
+    assert result.code == 200
+    result = yield client.list_versions(env_id)
+    assert result.code == 200
+
+    result = yield client.get_server_status()
+    assert result.code == 200
+    assert result.result["cache"]["environments"]["hits"] >= 1
+
+    env = yield server.cache.get_environment(env_id)
+    model = yield server.cache.get_latest_version(env)
+    assert model is None
+
+    version = 1
+    res = yield client.put_version(tid=env_id, version=version, resources=[], unknowns=[], version_info={})
+    assert res.code == 200
+    result = yield client.release_version(env_id, version, push=False)
+    assert result.code == 200
+
+    model = yield server.cache.get_latest_version(env)
+    assert model.version == version
+
+    result = yield client.modify_environment(id=env_id, name="dev2")
+    assert result.code == 200
+    env = yield server.cache.get_environment(env_id)
+    assert env.name == "dev2"
+
+
+def test_lru_cache():
+    cache = LRUCache(10, max_item_size=5)
+
+    cache.put("a", b"aaaa")
+    cache.put("b", b"bbbb")
+    assert cache.get("a") == (True, b"aaaa")
+
+    # b is the least recently used entry
+    cache.put("c", b"cccc")
+    assert "b" not in cache
+    assert "a" in cache
+    assert cache.total_size == 8
+
+    cache.put("d", b"dddddd")
+    assert "d" not in cache
+
+    assert cache.get("b") == (False, None)
+    status = cache.to_dict()
+    assert status["hits"] == 1
+    assert status["misses"] == 1
+    assert status["hit_ratio"] == 0.5
+
+
+@pytest.mark.gen_test
+def test_file_cache(client, server):
+    """
+        Test caching of file contents and diffs
+    """
+    content_a = "line 1\nline 2\n".encode()
+    content_b = "line 1\nline 3\n".encode()
+    hash_a = hashlib.sha1(content_a).hexdigest()
+    hash_b = hashlib.sha1(content_b).hexdigest()
+
+    for file_id, content in [(hash_a, content_a), (hash_b, content_b)]:
+        result = yield client.upload_file_stream(id=file_id, stream=io.BytesIO(content))
+        assert result.code == 200
+
+    for _ in range(3):
+        target = io.BytesIO()
+        result = yield client.get_file_stream(id=hash_a, stream=target)
+        assert result.code == 200
+        assert target.getvalue() == content_a
+
+    result = yield client.diff(hash_a, hash_b)
+    assert result.code == 200
+    diff = result.result["diff"]
+    assert "-line 2\n" in diff
+    assert "+line 3\n" in diff
+
+    result = yield client.diff(hash_a, hash_b)
+    assert result.code == 200
+    assert result.result["diff"] == diff
+
+    result = yield client.get_server_status()
+    assert result.code == 200
+    assert result.result["cache"]["files"]["hits"] >= 2
+    assert result.result["cache"]["diffs"]["hits"] == 1